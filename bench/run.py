@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of RamaLama's pure Python hot paths.
+
+Every fixture is generated locally in a temporary directory, blobs are
+served by a local HTTP server, so the suite runs without network access.
+Results are printed as a table, or as JSON with --json or --output, and
+can be compared against the JSON of an earlier run with --compare to gate
+changes on them:
+
+    bench/run.py --output baseline.json
+    ... change ramalama ...
+    bench/run.py --compare baseline.json
+"""
+
+import argparse
+import contextlib
+import http.server
+import io
+import json
+import os
+import platform
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+from ramalama import common, model, store  # noqa: E402
+from ramalama.cli import Namespace, _list_models  # noqa: E402
+from ramalama.shortnames import Shortnames  # noqa: E402
+
+MB = 1024 * 1024
+
+benchmarks = []
+
+
+def benchmark(name, unit=None):
+    """
+    Register a benchmark.
+
+    The decorated function is called once with a work directory and the
+    fixture scale to build its fixtures, and returns the function timed on
+    every round and the amount of work it does per round in unit, if any,
+    to report a throughput.
+    """
+
+    def decorator(func):
+        benchmarks.append({"name": name, "unit": unit, "setup": func})
+        return func
+
+    return decorator
+
+
+class BlobHandler(http.server.BaseHTTPRequestHandler):
+    """Serve the blob of the server, honouring byte ranges like registries do."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        blob = self.server.blob
+        start, end = 0, len(blob) - 1
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), end) if match.group(2) else end
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(blob)}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        self.wfile.write(memoryview(blob)[start : end + 1])
+
+
+def blob_server(blob):
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), BlobHandler)
+    server.daemon_threads = True
+    server.blob = blob
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _download(workdir, scale, connections):
+    server = blob_server(os.urandom(MB) * int(64 * scale))
+    url = f"http://127.0.0.1:{server.server_port}/blob"
+    dest_path = os.path.join(workdir, "blob")
+
+    def run():
+        if os.path.exists(dest_path):
+            os.remove(dest_path)
+        common.download_file(url, dest_path, show_progress=False, connections=connections)
+
+    return run, len(server.blob) / MB
+
+
+@benchmark("download_file", "MB")
+def download_single(workdir, scale):
+    return _download(workdir, scale, 1)
+
+
+@benchmark("download_file_segmented", "MB")
+def download_segmented(workdir, scale):
+    return _download(workdir, scale, common.DEFAULT_CONNECTIONS)
+
+
+def _blob(directory, size):
+    """Write a blob of size random bytes named after its digest into directory."""
+    os.makedirs(directory, exist_ok=True)
+    data = os.urandom(size)
+    path = os.path.join(directory, "tmp")
+    with open(path, "wb") as f:
+        f.write(data)
+    blob_path = os.path.join(directory, f"sha256:{common.sha256sum(path)}")
+    os.replace(path, blob_path)
+    return blob_path
+
+
+@benchmark("verify_checksum", "MB")
+def verify_checksum(workdir, scale):
+    size = int(256 * scale) * MB
+    path = os.path.join(workdir, "blob")
+    with open(path, "wb") as f:
+        chunk = os.urandom(MB)
+        for _ in range(size // MB):
+            f.write(chunk)
+    blob_path = os.path.join(workdir, f"sha256:{common.sha256sum(path)}")
+    os.replace(path, blob_path)
+    return lambda: common.verify_checksum(blob_path), size / MB
+
+
+@benchmark("verify_checksum_cached", "blobs")
+def verify_checksum_cached(workdir, scale):
+    blobs = [_blob(os.path.join(workdir, "blobs"), 1024) for _ in range(int(1000 * scale))]
+    for blob in blobs:
+        common.verify_checksum(blob, store=workdir)
+
+    def run():
+        for blob in blobs:
+            common.verify_checksum(blob, policy="cached", store=workdir)
+
+    return run, len(blobs)
+
+
+def synthetic_store(workdir, scale):
+    """
+    Populate a store with Models sharing a pool of blobs, and unused blobs.
+
+    Returns:
+    tuple: the store directory and the number of Models in it.
+    """
+    store_dir = os.path.join(workdir, "store")
+    repos = os.path.join(store_dir, "repos", "ollama", "blobs")
+    blobs = [_blob(repos, 64) for _ in range(int(2000 * scale))]
+    models = int(4000 * scale)
+    for i in range(models):
+        # Every other blob is used by two Models, the rest by none
+        blob = blobs[i % (len(blobs) // 2) * 2]
+        symlink_path = os.path.join(store_dir, "models", "ollama", f"model{i // 100}", f"tag{i}")
+        os.makedirs(os.path.dirname(symlink_path), exist_ok=True)
+        os.symlink(os.path.relpath(blob, os.path.dirname(symlink_path)), symlink_path)
+        common.store_blob(store_dir, blob)
+
+    store.reindex(store_dir)
+    return store_dir, models
+
+
+@benchmark("_list_models", "models")
+def list_models(workdir, scale):
+    store_dir, models = synthetic_store(workdir, scale)
+    args = Namespace(store=store_dir)
+    return lambda: _list_models(args), models
+
+
+@benchmark("store.reindex", "models")
+def reindex(workdir, scale):
+    store_dir, models = synthetic_store(workdir, scale)
+    return lambda: store.reindex(store_dir), models
+
+
+@benchmark("garbage_collection", "models")
+def garbage_collection(workdir, scale):
+    store_dir, models = synthetic_store(workdir, scale)
+
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            model.garbage_collection(store_dir, dry_run=True)
+
+    return run, models
+
+
+def _shortnames(store_dir):
+    shortnames = Shortnames()
+    shortnames.file_paths = [os.path.join(root, "shortnames", "shortnames.conf")]
+    shortnames.store = store_dir
+    return shortnames.shortnames
+
+
+@benchmark("Shortnames")
+def shortnames_parse(workdir, scale):
+    return lambda: _shortnames(None), None
+
+
+@benchmark("Shortnames_cached")
+def shortnames_cached(workdir, scale):
+    _shortnames(workdir)
+    return lambda: _shortnames(workdir), None
+
+
+@benchmark("cli_startup")
+def cli_startup(workdir, scale):
+    # No container engine on PATH, so startup does not depend on the host
+    bindir = os.path.join(workdir, "bin")
+    os.makedirs(bindir)
+    env = {name: value for name, value in os.environ.items() if name != "RAMALAMA_CONTAINER_ENGINE"}
+    env["PATH"] = bindir
+    cmd = [sys.executable, os.path.join(root, "bin", "ramalama"), "--store", os.path.join(workdir, "store"), "ls"]
+    return lambda: subprocess.run(cmd, env=env, cwd=root, check=True, stdout=subprocess.DEVNULL), None
+
+
+def run_benchmark(bench, rounds, scale):
+    workdir = tempfile.mkdtemp(prefix="ramalama-bench-")
+    try:
+        run, work = bench["setup"](workdir, scale)
+        # The first round warms the page cache and the imports up
+        run()
+        times = []
+        for _ in range(rounds):
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    result = {
+        "name": bench["name"],
+        "rounds": rounds,
+        "min": min(times),
+        "max": max(times),
+        "mean": statistics.mean(times),
+        "median": statistics.median(times),
+        "stdev": statistics.stdev(times) if rounds > 1 else 0.0,
+    }
+    if bench["unit"]:
+        result["throughput"] = work / result["median"]
+        result["throughput_unit"] = f"{bench['unit']}/s"
+    return result
+
+
+def compare(results, baseline, threshold):
+    """Return the names of the benchmarks whose median regressed by more than threshold."""
+    previous = {result["name"]: result for result in baseline["benchmarks"]}
+    regressions = []
+    for result in results:
+        if result["name"] not in previous:
+            continue
+
+        change = result["median"] / previous[result["name"]]["median"] - 1
+        result["change"] = change
+        if change > threshold:
+            regressions.append(result["name"])
+
+    return regressions
+
+
+def print_results(results):
+    columns = ["NAME", "MEDIAN (ms)", "MIN (ms)", "STDEV (ms)", "THROUGHPUT", "CHANGE"]
+    rows = []
+    for result in results:
+        throughput = f"{result['throughput']:.1f} {result['throughput_unit']}" if "throughput" in result else "-"
+        change = f"{result['change']:+.1%}" if "change" in result else "-"
+        rows.append(
+            [
+                result["name"],
+                f"{result['median'] * 1000:.2f}",
+                f"{result['min'] * 1000:.2f}",
+                f"{result['stdev'] * 1000:.2f}",
+                throughput,
+                change,
+            ]
+        )
+
+    widths = [max([len(column)] + [len(row[i]) for row in rows]) for i, column in enumerate(columns)]
+    for row in [columns] + rows:
+        print(" ".join(f"{value:<{width}}" for value, width in zip(row, widths)).rstrip())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark RamaLama's pure Python hot paths.")
+    parser.add_argument("-k", "--filter", help="only run benchmarks whose name matches this regular expression")
+    parser.add_argument("--list", action="store_true", help="list the benchmarks and exit")
+    parser.add_argument("--rounds", type=int, default=5, help="timed rounds per benchmark (default: 5)")
+    parser.add_argument("--scale", type=float, default=1, help="scale the size of the fixtures (default: 1)")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    parser.add_argument("--output", help="also write the results as JSON to this file")
+    parser.add_argument("--compare", metavar="BASELINE", help="compare against the JSON results of an earlier run")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="fail when a median is this fraction slower than the baseline (default: 0.2)",
+    )
+    args = parser.parse_args()
+
+    selected = [bench for bench in benchmarks if not args.filter or re.search(args.filter, bench["name"])]
+    if args.list:
+        for bench in selected:
+            print(bench["name"])
+        return 0
+
+    results = []
+    for bench in selected:
+        print(f"Running {bench['name']}", file=sys.stderr)
+        results.append(run_benchmark(bench, args.rounds, args.scale))
+
+    regressions = []
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+
+    report = {
+        "machine": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "scale": args.scale,
+        "benchmarks": results,
+        "regressions": regressions,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+
+    if args.json:
+        print(json.dumps(report, indent=4))
+    else:
+        print_results(results)
+
+    for name in regressions:
+        print(f"Error: {name} regressed by more than {args.threshold:.0%}", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
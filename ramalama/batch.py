@@ -0,0 +1,173 @@
+"""Batch inference of the prompts of a JSONL file through a server of the Model."""
+
+import collections
+import concurrent.futures
+import http.client
+import json
+import queue
+import sys
+import threading
+
+from ramalama.common import perror
+
+# Prompts read ahead of the oldest one still running, per slot
+READ_AHEAD = 4
+
+
+def parse(line):
+    """
+    Return the id, API path and request of an input line.
+
+    A line is a JSON object with a prompt, sent to the completions API, or
+    with messages, sent to the chat completions API, and any other request
+    fields such as max_tokens. Its id, if any, is copied to its result. A
+    JSON string is a prompt. Raises ValueError on other lines.
+    """
+    request = json.loads(line)
+    if isinstance(request, str):
+        request = {"prompt": request}
+    if not isinstance(request, dict):
+        raise ValueError("expected a JSON object or string")
+
+    request = dict(request)
+    id = request.pop("id", None)
+    # Results are written whole
+    request.pop("stream", None)
+    if "messages" in request:
+        return id, "/v1/chat/completions", request
+    if "prompt" in request:
+        return id, "/v1/completions", request
+    raise ValueError("expected a prompt or messages field")
+
+
+def resume(path):
+    """
+    Return the number of the last input line with a result in the output at
+    path, 0 when there is none.
+
+    A result cut off by an interruption is removed, results are written in
+    input order so the lines up to the last result are done.
+    """
+    try:
+        f = open(path, "r+b")
+    except FileNotFoundError:
+        return 0
+
+    with f:
+        done = 0
+        end = 0
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                done = json.loads(line)["line"]
+            except (ValueError, KeyError, TypeError):
+                break
+            end = f.tell()
+        f.truncate(end)
+    return done
+
+
+class Batch:
+    """
+    Send the prompts of an input file to backend, parallel at a time, and
+    write the results in input order as they complete.
+    """
+
+    def __init__(self, backend, parallel):
+        self.backend = backend
+        self.parallel = parallel
+        self.local = threading.local()
+        self.work = queue.Queue()
+
+    def _send(self, path, request):
+        body = json.dumps(request).encode()
+        for attempt in range(2):
+            conn = getattr(self.local, "conn", None) or self.backend.connection()
+            self.local.conn = conn
+            try:
+                conn.request("POST", path, body=body, headers={"Content-Type": "application/json"})
+                response = conn.getresponse()
+                return response.status, response.read()
+            except (OSError, http.client.HTTPException):
+                # The kept-alive connection may have been closed, retry once on a new one
+                conn.close()
+                self.local.conn = None
+                if attempt:
+                    raise
+
+    def _process(self, number, line):
+        result = {"line": number}
+        try:
+            id, path, request = parse(line)
+        except ValueError as e:
+            result["error"] = f"invalid input: {e}"
+            return result
+
+        if id is not None:
+            result["id"] = id
+        status, body = self._send(path, request)
+        if status >= 500:
+            raise OSError(f"server failed: HTTP {status} {body.decode(errors='replace')}")
+        try:
+            response = json.loads(body)
+        except ValueError:
+            response = body.decode(errors="replace")
+        result["error" if status != 200 else "response"] = response
+        return result
+
+    def _worker(self):
+        while True:
+            future, number, line = self.work.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(self._process(number, line))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def run(self, input_path, output_path):
+        """Run the prompts of input_path, skipping those with a result in output_path already."""
+        done = resume(output_path) if output_path != "-" else 0
+        if done:
+            perror(f"Resuming after line {done} of {input_path}")
+
+        for _ in range(self.parallel):
+            threading.Thread(target=self._worker, daemon=True).start()
+
+        counts = collections.Counter()
+        pending = collections.deque()
+        output = sys.stdout if output_path == "-" else open(output_path, "a")
+
+        def write(number, future):
+            try:
+                result = future.result()
+            except (OSError, http.client.HTTPException) as e:
+                raise KeyError(f"line {number} of {input_path} failed: {e}, run again to resume")
+            counts["failed" if "error" in result else "completed"] += 1
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+
+        try:
+            with open(input_path) as f:
+                for number, line in enumerate(f, 1):
+                    if number <= done or not line.strip():
+                        continue
+
+                    future = concurrent.futures.Future()
+                    self.work.put((future, number, line))
+                    pending.append((number, future))
+                    # Results are written in input order, prompts are read ahead of the oldest one running
+                    while pending and (pending[0][1].done() or len(pending) >= self.parallel * READ_AHEAD):
+                        write(*pending.popleft())
+
+            while pending:
+                write(*pending.popleft())
+        finally:
+            for _, future in pending:
+                future.cancel()
+            if output is not sys.stdout:
+                output.close()
+
+        perror(f"Completed {counts['completed']} prompts, {counts['failed']} failed")
+        return counts
@@ -0,0 +1,275 @@
+"""Load generator for OpenAI compatible endpoints served by RamaLama."""
+
+import datetime
+import http.client
+import json
+import os
+import random
+import threading
+import time
+import urllib.parse
+
+# Words prompts are made of, roughly one token each
+vocabulary = """the model answer question light river stone system green number
+house paper music water field cloud story north glass table""".split()
+
+percentiles = [50, 95, 99]
+
+
+def parse_distribution(value):
+    """Parse a token count N or a uniform range MIN-MAX into a (min, max) tuple."""
+    low, _, high = value.partition("-")
+    try:
+        low = int(low)
+        high = int(high) if high else low
+    except ValueError:
+        raise ValueError(f"invalid token count {value}, expected N or MIN-MAX")
+
+    if low < 1 or high < low:
+        raise ValueError(f"invalid token count {value}, expected N or MIN-MAX")
+    return low, high
+
+
+def percentile(values, p):
+    """Return the p-th percentile of values, interpolating between closest ranks."""
+    if not values:
+        return None
+
+    values = sorted(values)
+    rank = (len(values) - 1) * p / 100
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def summarize(values):
+    summary = {f"p{p}": percentile(values, p) for p in percentiles}
+    summary["mean"] = sum(values) / len(values) if values else None
+    return summary
+
+
+class Request:
+    """Timings of one streamed completion."""
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.tokens = []
+        self.end = None
+        self.output_tokens = 0
+        self.error = None
+
+    @property
+    def ttft(self):
+        return self.tokens[0] - self.start if self.tokens else None
+
+    @property
+    def itl(self):
+        return [b - a for a, b in zip(self.tokens, self.tokens[1:])]
+
+
+class Bench:
+    """
+    Drive concurrent streamed completions at an OpenAI compatible endpoint.
+
+    Every worker keeps one connection open and sends requests back to back
+    until the duration elapses or the request budget is spent. The time of
+    each streamed chunk is recorded to derive the time to first token and
+    the inter-token latencies.
+    """
+
+    def __init__(self, url, model, concurrency, duration, prompt_tokens, output_tokens, requests=None, seed=None):
+        self.url = urllib.parse.urlsplit(url)
+        self.model = model
+        self.concurrency = concurrency
+        self.duration = duration
+        self.prompt_tokens = prompt_tokens
+        self.output_tokens = output_tokens
+        self.requests = requests
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.results = []
+        self.sent = 0
+        self.deadline = None
+
+    def _take(self):
+        with self.lock:
+            if time.monotonic() >= self.deadline or (self.requests and self.sent >= self.requests):
+                return None
+
+            self.sent += 1
+            prompt = " ".join(self.random.choices(vocabulary, k=self.random.randint(*self.prompt_tokens)))
+            return prompt, self.random.randint(*self.output_tokens)
+
+    def _connection(self):
+        if self.url.scheme == "https":
+            return http.client.HTTPSConnection(self.url.hostname, self.url.port, timeout=600)
+        return http.client.HTTPConnection(self.url.hostname, self.url.port or 80, timeout=600)
+
+    def _send(self, conn, prompt, max_tokens):
+        body = json.dumps(
+            {
+                "model": self.model,
+                "prompt": prompt,
+                "max_tokens": max_tokens,
+                "ignore_eos": True,
+                "stream": True,
+            }
+        ).encode()
+        path = self.url.path.rstrip("/") + "/v1/completions"
+        request = Request()
+        conn.request("POST", path, body=body, headers={"Content-Type": "application/json"})
+        response = conn.getresponse()
+        if response.status != 200:
+            response.read()
+            raise http.client.HTTPException(f"HTTP {response.status} {response.reason}")
+
+        for line in response:
+            line = line.strip()
+            if not line.startswith(b"data:"):
+                continue
+
+            data = line[5:].strip()
+            if data == b"[DONE]":
+                break
+
+            chunk = json.loads(data)
+            usage = chunk.get("usage")
+            if usage and usage.get("completion_tokens"):
+                request.output_tokens = usage["completion_tokens"]
+            choices = chunk.get("choices") or [{}]
+            if choices[0].get("text"):
+                request.tokens.append(time.monotonic())
+
+        # Drain the rest of the stream so the connection can be reused
+        response.read()
+        request.end = time.monotonic()
+        request.output_tokens = request.output_tokens or len(request.tokens)
+        return request
+
+    def _worker(self):
+        conn = self._connection()
+        try:
+            while True:
+                work = self._take()
+                if not work:
+                    return
+
+                try:
+                    request = self._send(conn, *work)
+                except (OSError, ValueError, http.client.HTTPException) as e:
+                    conn.close()
+                    conn = self._connection()
+                    request = Request()
+                    request.error = str(e)
+                with self.lock:
+                    self.results.append(request)
+        finally:
+            conn.close()
+
+    def run(self):
+        """Run the benchmark and return its results."""
+        start = time.monotonic()
+        self.deadline = start + self.duration
+        workers = [threading.Thread(target=self._worker, daemon=True) for _ in range(self.concurrency)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.monotonic() - start
+
+        completed = [request for request in self.results if not request.error]
+        output_tokens = sum(request.output_tokens for request in completed)
+        itl = [gap for request in completed for gap in request.itl]
+        return {
+            "time": datetime.datetime.now().isoformat(timespec="seconds"),
+            "url": urllib.parse.urlunsplit(self.url),
+            "model": self.model,
+            "concurrency": self.concurrency,
+            "prompt_tokens": list(self.prompt_tokens),
+            "output_tokens": list(self.output_tokens),
+            "elapsed": elapsed,
+            "requests": len(completed),
+            "failed": len(self.results) - len(completed),
+            "errors": sorted({request.error for request in self.results if request.error}),
+            "total_output_tokens": output_tokens,
+            "tokens_per_second": output_tokens / elapsed if elapsed else 0,
+            "requests_per_second": len(completed) / elapsed if elapsed else 0,
+            "ttft": summarize([request.ttft for request in completed if request.ttft is not None]),
+            "itl": summarize(itl),
+            "latency": summarize([request.end - request.start for request in completed]),
+        }
+
+
+def save(store, result):
+    """Store result in the store so runs can be compared, return its path."""
+    directory = os.path.join(store, "bench")
+    os.makedirs(directory, exist_ok=True)
+    # Named after the time it was saved at, so runs sort in order
+    name = datetime.datetime.now().strftime("%Y%m%dT%H%M%S%f")
+    if result.get("label"):
+        name += "-" + "".join(c if c.isalnum() or c in "._-" else "_" for c in result["label"])
+    path = os.path.join(directory, f"{name}.json")
+    with open(path, "w") as f:
+        json.dump(result, f, indent=4)
+    return path
+
+
+def history(store):
+    """Return the stored results, oldest first."""
+    results = []
+    directory = os.path.join(store, "bench")
+    if not os.path.isdir(directory):
+        return results
+
+    for file in sorted(os.listdir(directory)):
+        if not file.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(directory, file)) as f:
+                results.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+
+    return results
+
+
+def _ms(seconds):
+    return "-" if seconds is None else f"{seconds * 1000:.1f}"
+
+
+def print_result(result):
+    print(f"Requests:          {result['requests']} ({result['failed']} failed)")
+    for error in result["errors"]:
+        print(f"  {error}")
+    print(f"Duration:          {result['elapsed']:.1f}s")
+    print(f"Output tokens:     {result['total_output_tokens']}")
+    print(f"Tokens/s:          {result['tokens_per_second']:.1f}")
+    print(f"Requests/s:        {result['requests_per_second']:.2f}")
+    print(f"{'':<18} {'MEAN':>9}" + "".join(f" {f'P{p}':>9}" for p in percentiles))
+    for name, key in [("TTFT (ms)", "ttft"), ("ITL (ms)", "itl"), ("Latency (ms)", "latency")]:
+        summary = result[key]
+        row = f"{name:<18} {_ms(summary['mean']):>9}"
+        row += "".join(f" {_ms(summary[f'p{p}']):>9}" for p in percentiles)
+        print(row)
+
+
+def print_history(results):
+    columns = ["TIME", "LABEL", "CONCURRENCY", "TOKENS/S", "TTFT P50", "TTFT P95", "ITL P50", "ITL P99"]
+    rows = []
+    for result in results:
+        rows.append(
+            [
+                result["time"],
+                result.get("label") or "-",
+                str(result["concurrency"]),
+                f"{result['tokens_per_second']:.1f}",
+                _ms(result["ttft"]["p50"]),
+                _ms(result["ttft"]["p95"]),
+                _ms(result["itl"]["p50"]),
+                _ms(result["itl"]["p99"]),
+            ]
+        )
+
+    widths = [max([len(column)] + [len(row[i]) for row in rows]) for i, column in enumerate(columns)]
+    for row in [columns] + rows:
+        print(" ".join(f"{value:<{width}}" for value, width in zip(row, widths)).rstrip())
@@ -0,0 +1,218 @@
+"""Cache of the responses of served Models to deterministic requests."""
+
+import collections
+import hashlib
+import json
+import os
+import threading
+import time
+
+# Request fields that do not change the response
+ignored_fields = ["user"]
+
+# Seconds a request waits for the response to the same request in flight
+WAIT_TIMEOUT = 600
+
+
+def cacheable(request):
+    """Return whether request is deterministic: greedy sampling, always picking the likeliest token."""
+    if not isinstance(request, dict):
+        return False
+    return request.get("temperature") == 0 or request.get("top_k") == 1
+
+
+class Entry:
+    """A complete response: status, content type, body, and whether it was streamed."""
+
+    def __init__(self, status, content_type, body, streamed, created=None):
+        self.status = status
+        self.content_type = content_type
+        self.body = bytes(body)
+        self.streamed = streamed
+        self.created = created or time.time()
+
+    def header(self):
+        return {
+            "status": self.status,
+            "content_type": self.content_type,
+            "streamed": self.streamed,
+            "created": self.created,
+        }
+
+
+class ResponseCache:
+    """
+    LRU cache of responses, keyed by the normalized request.
+
+    Up to size bytes of responses are kept in memory. With a directory and
+    disk_size, responses evicted from memory are spilled to files in it,
+    up to disk_size bytes, and moved back to memory when hit. Responses
+    expire ttl seconds after they were received, 0 keeps them until they
+    are evicted.
+
+    Concurrent identical requests are answered once: the first one is
+    forwarded, the others wait for its response.
+    """
+
+    def __init__(self, size, ttl=0, directory=None, disk_size=0):
+        self.size = size
+        self.ttl = ttl
+        self.directory = directory if disk_size else None
+        self.disk_size = disk_size
+        self.entries = collections.OrderedDict()
+        self.used = 0
+        self.disk = collections.OrderedDict()
+        self.disk_used = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.pending = {}
+        if self.directory:
+            self._scan()
+
+    def key(self, model, path, request, revision=None):
+        """
+        Return the key of request, None when its response is not cached.
+
+        revision identifies the weights of the Model, so responses of a
+        Model pulled again are not replayed.
+        """
+        if not cacheable(request):
+            return None
+
+        normalized = {name: value for name, value in request.items() if name not in ignored_fields}
+        # Every name of the Model shares its responses
+        normalized["model"] = model
+        data = json.dumps([path.split("?")[0], normalized, revision], sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def _expired(self, entry):
+        return self.ttl and time.time() - entry.created > self.ttl
+
+    def get(self, key):
+        """
+        Return the response cached for key, or None.
+
+        On None the caller forwards the request, and must then call done()
+        whether or not it put() the response.
+        """
+        deadline = time.monotonic() + WAIT_TIMEOUT
+        while True:
+            with self.lock:
+                entry = self.entries.get(key) or self._load(key)
+                if entry and self._expired(entry):
+                    self._remove(key)
+                    entry = None
+                if entry:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return entry
+
+                event = self.pending.get(key)
+                if event is None or time.monotonic() >= deadline:
+                    self.pending.setdefault(key, threading.Event())
+                    self.misses += 1
+                    return None
+
+            event.wait(max(deadline - time.monotonic(), 0))
+
+    def done(self, key):
+        with self.lock:
+            event = self.pending.pop(key, None)
+        if event:
+            event.set()
+
+    def put(self, key, entry):
+        if len(entry.body) > self.size:
+            return
+
+        with self.lock:
+            self._remove(key)
+            self._insert(key, entry)
+
+    def _insert(self, key, entry):
+        self.entries[key] = entry
+        self.used += len(entry.body)
+        while self.used > self.size:
+            old_key, old_entry = self.entries.popitem(last=False)
+            self.used -= len(old_entry.body)
+            self._spill(old_key, old_entry)
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry:
+            self.used -= len(entry.body)
+        if key in self.disk:
+            self.disk_used -= self.disk.pop(key)
+            try:
+                os.remove(os.path.join(self.directory, key))
+            except OSError:
+                pass
+
+    def _scan(self):
+        """Index the responses spilled to disk by an earlier run, oldest first."""
+        try:
+            files = [entry for entry in os.scandir(self.directory) if entry.is_file() and "." not in entry.name]
+        except OSError:
+            return
+        for file in sorted(files, key=lambda file: file.stat().st_mtime):
+            self.disk[file.name] = file.stat().st_size
+            self.disk_used += file.stat().st_size
+
+    def _spill(self, key, entry):
+        if not self.directory or self._expired(entry) or len(entry.body) > self.disk_size:
+            return
+
+        path = os.path.join(self.directory, key)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}"
+            with open(tmp_path, "wb") as f:
+                f.write(json.dumps(entry.header()).encode() + b"\n")
+                f.write(entry.body)
+                size = f.tell()
+            os.replace(tmp_path, path)
+        except OSError:
+            # A read-only store only costs the response
+            return
+
+        self.disk[key] = size
+        self.disk_used += size
+        while self.disk_used > self.disk_size:
+            old_key, old_size = self.disk.popitem(last=False)
+            self.disk_used -= old_size
+            try:
+                os.remove(os.path.join(self.directory, old_key))
+            except OSError:
+                pass
+
+    def _load(self, key):
+        """Move the response spilled to disk for key back to memory."""
+        if key not in self.disk:
+            return None
+
+        path = os.path.join(self.directory, key)
+        try:
+            with open(path, "rb") as f:
+                header = json.loads(f.readline())
+                entry = Entry(body=f.read(), **header)
+        except (OSError, ValueError, TypeError):
+            self._remove(key)
+            return None
+
+        self._remove(key)
+        if self._expired(entry) or len(entry.body) > self.size:
+            return None
+        self._insert(key, entry)
+        return entry
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.entries),
+                "size": self.used,
+                "disk_entries": len(self.disk),
+                "disk_size": self.disk_used,
+            }
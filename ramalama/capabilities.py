@@ -0,0 +1,227 @@
+"""Snapshot of the capabilities of the system RamaLama runs on."""
+
+import glob
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+
+from ramalama.common import available, container_manager, in_container, run_cmd
+from ramalama.version import version
+
+# Container engines and tools whose binaries invalidate the snapshot when replaced
+engines = ["podman", "docker"]
+tools = ["huggingface-cli", "omlmd"]
+devices = ["/dev/dri", "/dev/kfd"]
+cpu_features = ["avx", "avx2", "avx512f", "avx512_bf16", "avx_vnni", "amx_tile", "f16c", "fma", "asimd", "sve"]
+
+
+def fingerprint():
+    """
+    Return what the snapshot depends on, cheap to compute without probing.
+
+    A snapshot is reused as long as PATH, the PCI devices and the engine
+    and tool binaries are unchanged.
+    """
+    try:
+        pci_devices = sorted(os.listdir("/sys/bus/pci/devices"))
+    except OSError:
+        pci_devices = []
+
+    binaries = {}
+    for name in engines + tools:
+        path = shutil.which(name)
+        binaries[name] = os.stat(path).st_mtime_ns if path else None
+
+    return {
+        "version": str(version()),
+        "platform": sys.platform,
+        "in_container": in_container(),
+        "path": os.getenv("PATH", ""),
+        "pci_devices": pci_devices,
+        "binaries": binaries,
+    }
+
+
+def probe_gpu():
+    i = 0
+    gpu_num = 0
+    gpu_bytes = 0
+    for fp in sorted(glob.glob('/sys/bus/pci/devices/*/mem_info_vram_total')):
+        with open(fp, 'r') as file:
+            content = int(file.read())
+            if content > 1073741824 and content > gpu_bytes:
+                gpu_bytes = content
+                gpu_num = i
+
+        i += 1
+
+    if gpu_bytes:  # this is the ROCm/AMD case
+        return "HIP_VISIBLE_DEVICES", gpu_num
+
+    return None, None
+
+
+def probe_cpu():
+    """Return the relevant CPU features and the number of physical cores."""
+    flags = set()
+    cores = set()
+    physical_id = None
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                name = name.strip()
+                if name in ["flags", "Features"]:
+                    flags.update(value.split())
+                elif name == "physical id":
+                    physical_id = value.strip()
+                elif name == "core id":
+                    cores.add((physical_id, value.strip()))
+    except OSError:
+        pass
+
+    return [feature for feature in cpu_features if feature in flags], len(cores) or os.cpu_count()
+
+
+def probe_huggingface_cli():
+    try:
+        run_cmd(["huggingface-cli", "version"])
+        return True
+    except (FileNotFoundError, subprocess.CalledProcessError):
+        return False
+
+
+def probe(host=None):
+    """
+    Probe the system.
+
+    Inside a container, facts about the host are taken from the snapshot the
+    host passed in rather than probed again.
+    """
+    host = host or {}
+    if "gpu" in host:
+        gpu = host["gpu"]
+    else:
+        gpu = list(probe_gpu())
+
+    if "cpu_features" in host:
+        features, cores = host["cpu_features"], host["cpu_cores"]
+    else:
+        features, cores = probe_cpu()
+
+    return {
+        "gpu": gpu,
+        "devices": [device for device in devices if os.path.exists(device)],
+        "cpu_features": features,
+        "cpu_cores": cores,
+        "tools": {},
+    }
+
+
+# Tools are only probed when first needed
+tool_probes = {
+    "huggingface-cli": probe_huggingface_cli,
+    "omlmd": lambda: available("omlmd"),
+}
+
+
+class Capabilities:
+    """
+    Capabilities of the system, probed once and cached in the store.
+
+    The snapshot is written to cache/capabilities/ in the store, named after
+    its fingerprint, and reused until the fingerprint changes. The store is
+    mounted into the RamaLama container, which reads the host snapshot named
+    by RAMALAMA_HOST_CAPABILITIES instead of probing the host again and
+    caches its own snapshot next to it. Tools are probed the first time they
+    are needed and added to the snapshot.
+    """
+
+    def __init__(self):
+        self.store = None
+        self.lock = threading.Lock()
+        self._snapshot = None
+        self._path = None
+        self._key = None
+
+    def __getitem__(self, name):
+        return self.snapshot()[name]
+
+    @property
+    def engine(self):
+        """
+        The container engine, None inside a container.
+
+        It depends on the state of the engine, such as whether a podman
+        machine runs, so it is resolved by every process and not cached.
+        """
+        return None if in_container() else container_manager()
+
+    @property
+    def path(self):
+        """Path of the snapshot in the store."""
+        self.snapshot()
+        return self._path
+
+    def tool(self, name):
+        """Return whether the tool is available, probing it the first time."""
+        snapshot = self.snapshot()
+        with self.lock:
+            if name not in snapshot["tools"]:
+                snapshot["tools"][name] = tool_probes[name]()
+                self._save(snapshot)
+            return snapshot["tools"][name]
+
+    def snapshot(self):
+        with self.lock:
+            if self._snapshot is None:
+                self._snapshot = self._load()
+            return self._snapshot
+
+    def _load(self):
+        key = fingerprint()
+        self._key = key
+        digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+        if self.store:
+            self._path = os.path.join(self.store, "cache", "capabilities", f"{digest[:16]}.json")
+            try:
+                with open(self._path) as f:
+                    snapshot = json.load(f)
+                if snapshot.pop("key", None) == key:
+                    return snapshot
+            except (OSError, ValueError):
+                pass
+
+        host = None
+        host_path = os.getenv("RAMALAMA_HOST_CAPABILITIES")
+        if host_path and in_container():
+            try:
+                with open(host_path) as f:
+                    host = json.load(f)
+            except (OSError, ValueError):
+                pass
+
+        snapshot = probe(host)
+        self._save(snapshot)
+        return snapshot
+
+    def _save(self, snapshot):
+        if not self._path:
+            return
+
+        try:
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            tmp_path = f"{self._path}.{os.getpid()}"
+            with open(tmp_path, "w") as f:
+                json.dump(dict(snapshot, key=self._key), f, sort_keys=True, indent=4)
+            os.replace(tmp_path, self._path)
+        except OSError:
+            # A read-only store only costs probing again next time
+            pass
+
+
+capabilities = Capabilities()
@@ -1,6 +1,5 @@
-from pathlib import Path
 import argparse
-import glob
+import concurrent.futures
 import json
 import os
 import subprocess
@@ -8,19 +7,36 @@ import sys
 import time
 import atexit
 
+from ramalama import bench, gguf
+from ramalama.cache import ResponseCache
+from ramalama.capabilities import capabilities
 from ramalama.huggingface import Huggingface
+from ramalama.model import garbage_collection
 from ramalama.common import (
-    container_manager,
+    DEFAULT_CONNECTIONS,
+    DEFAULT_MAX_CONNECTIONS,
     default_image,
+    download_scheduler,
+    dry_run,
     find_working_directory,
     genname,
+    http_client,
+    human_readable_size,
     in_container,
+    parse_rate,
+    parse_size,
     perror,
+    report_spawned,
     run_cmd,
 )
 from ramalama.oci import OCI
+from ramalama.metrics import Metrics
+from ramalama.planner import MEMORY_SHARE
 from ramalama.ollama import Ollama
+from ramalama.proxy import Router, serve
 from ramalama.shortnames import Shortnames
+from ramalama.store import add_model, list_models, reindex
+from ramalama.tune import available_memory
 from ramalama.version import version, print_version
 
 shortnames = Shortnames()
@@ -38,7 +54,29 @@ def use_container():
     if in_container():
         return False
 
-    return container_manager()
+    return capabilities.engine
+
+
+class Namespace(argparse.Namespace):
+    """
+    Parsed arguments whose defaults are computed when first read.
+
+    Detecting the container engine runs podman on some platforms, so it is
+    only done when the subcommand uses the engine.
+    """
+
+    lazy_defaults = {
+        "container": use_container,
+        "engine": lambda: capabilities.engine,
+    }
+
+    def __getattr__(self, name):
+        if name not in self.lazy_defaults:
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+
+        value = self.lazy_defaults[name]()
+        setattr(self, name, value)
+        return value
 
 
 class ArgumentParserWithDefaults(argparse.ArgumentParser):
@@ -47,7 +85,7 @@ class ArgumentParserWithDefaults(argparse.ArgumentParser):
             kwargs['help'] = help
         if default is not None and args[0] != '-h':
             kwargs['default'] = default
-            if help is not None and help != "==SUPPRESS==":
+            if help is not None and help != "==SUPPRESS==" and default != argparse.SUPPRESS:
                 kwargs['help'] += ' (default: {})'.format(default)
         super().add_argument(*args, **kwargs)
 
@@ -79,7 +117,7 @@ with software on the local system.
     parser.add_argument(
         "--container",
         dest="container",
-        default=use_container(),
+        default=argparse.SUPPRESS,
         action="store_true",
         help="""run RamaLama in the default container.
 The RAMALAMA_IN_CONTAINER environment variable modifies default behaviour.""",
@@ -96,7 +134,6 @@ The RAMALAMA_IN_CONTAINER environment variable modifies default behaviour.""",
     parser.add_argument(
         "--engine",
         dest="engine",
-        default=container_manager(),
         help="""run RamaLama using the specified container engine.
 The RAMALAMA_CONTAINER_ENGINE environment variable modifies default behaviour.""",
     )
@@ -108,7 +145,7 @@ The RAMALAMA_CONTAINER_ENGINE environment variable modifies default behaviour.""
     parser.add_argument(
         "--nocontainer",
         dest="container",
-        default=False,
+        default=argparse.SUPPRESS,
         action="store_false",
         help="""do not run RamaLama in the default container.
 The RAMALAMA_IN_CONTAINER environment variable modifies default behaviour.""",
@@ -126,8 +163,11 @@ The RAMALAMA_IN_CONTAINER environment variable modifies default behaviour.""",
     subparsers.required = False
 
     help_parser(subparsers)
+    bench_parser(subparsers)
     containers_parser(subparsers)
+    gc_parser(subparsers)
     info_parser(subparsers)
+    inspect_parser(subparsers)
     list_parser(subparsers)
     login_parser(subparsers)
     logout_parser(subparsers)
@@ -137,9 +177,20 @@ The RAMALAMA_IN_CONTAINER environment variable modifies default behaviour.""",
     run_parser(subparsers)
     serve_parser(subparsers)
     stop_parser(subparsers)
+    store_parser(subparsers)
     version_parser(subparsers)
     # Parse CLI
     args = parser.parse_args()
+    # argparse probes every destination while parsing, so only hand over
+    # to the lazy Namespace once the arguments are parsed
+    lazy = Namespace.lazy_defaults
+    args = Namespace(**{name: value for name, value in vars(args).items() if value is not None or name not in lazy})
+
+    http_client.debug = args.debug
+    capabilities.store = args.store
+    shortnames.store = args.store
+    if args.debug:
+        atexit.register(report_spawned)
 
     # create stores directories
     mkdirs(args.store)
@@ -205,6 +256,7 @@ def logout_cli(args):
 def mkdirs(store):
     # List of directories to create
     directories = [
+        "blobs/sha256",
         "models/huggingface",
         "repos/huggingface",
         "models/oci",
@@ -252,8 +304,64 @@ def human_duration(d):
         return f"{d // 31536000} years"
 
 
-def list_files_by_modification():
-    return sorted(Path().rglob("*"), key=lambda p: os.path.getmtime(p), reverse=True)
+def bench_parser(subparsers):
+    parser = subparsers.add_parser("bench", help="benchmark the REST API of a served AI Model")
+    parser.add_argument("--concurrency", type=int, default=4, help="number of requests in flight")
+    parser.add_argument("--container", default=False, action="store_false", help=argparse.SUPPRESS)
+    parser.add_argument("--duration", type=float, default=60, help="seconds to send requests for")
+    parser.add_argument("--history", action="store_true", help="list the results of previous runs")
+    parser.add_argument("--json", dest="json", action="store_true", help="print using json")
+    parser.add_argument("--label", help="label stored with the results, e.g. the image or flags served with")
+    parser.add_argument("--model", default="default", help="Model name sent in requests")
+    parser.add_argument(
+        "--output-tokens",
+        dest="outputtokens",
+        type=bench.parse_distribution,
+        default="128",
+        help="tokens generated per request, N or a uniformly distributed range MIN-MAX",
+    )
+    parser.add_argument(
+        "--prompt-tokens",
+        dest="prompttokens",
+        type=bench.parse_distribution,
+        default="128",
+        help="approximate prompt length in tokens, N or a uniformly distributed range MIN-MAX",
+    )
+    parser.add_argument("--requests", type=int, help="stop after sending this many requests")
+    parser.add_argument("--seed", type=int, help="seed of the random prompt and output lengths")
+    parser.add_argument("--url", default="http://127.0.0.1:8080", help="URL of the served AI Model")
+    parser.set_defaults(func=bench_cli)
+
+
+def bench_cli(args):
+    if args.history:
+        results = bench.history(args.store)
+        if args.json:
+            print(json.dumps(results, indent=4))
+        else:
+            bench.print_history(results)
+        return
+
+    runner = bench.Bench(
+        args.url,
+        args.model,
+        args.concurrency,
+        args.duration,
+        args.prompttokens,
+        args.outputtokens,
+        requests=args.requests,
+        seed=args.seed,
+    )
+    result = runner.run()
+    result["label"] = args.label
+    bench.save(args.store, result)
+    if args.json:
+        print(json.dumps(result, indent=4))
+    else:
+        bench.print_result(result)
+
+    if not result["requests"]:
+        raise KeyError(f"no request to {args.url} succeeded")
 
 
 def containers_parser(subparsers):
@@ -301,6 +409,24 @@ def info_parser(subparsers):
     parser.set_defaults(func=info_cli)
 
 
+def gc_parser(subparsers):
+    parser = subparsers.add_parser("gc", help="remove blobs no longer used by any AI Model")
+    parser.add_argument("--container", default=False, action="store_false", help=argparse.SUPPRESS)
+    parser.add_argument(
+        "--dry-run", dest="dry_run", action="store_true", help="list the blobs to remove without removing them"
+    )
+    parser.set_defaults(func=gc_cli)
+
+
+def gc_cli(args):
+    dryrun = args.dry_run or args.dryrun
+    size = garbage_collection(args.store, dryrun)
+    if dryrun:
+        print(f"Reclaimable: {human_readable_size(size)}")
+    else:
+        print(f"Reclaimed: {human_readable_size(size)}")
+
+
 def list_parser(subparsers):
     parser = subparsers.add_parser("list", aliases=["ls"], help="list all downloaded AI Models")
     parser.add_argument("--container", default=False, action="store_false", help=argparse.SUPPRESS)
@@ -310,43 +436,91 @@ def list_parser(subparsers):
     parser.set_defaults(func=list_cli)
 
 
-def human_readable_size(size):
-    for unit in ["B", "KB", "MB", "GB", "TB"]:
-        if size < 1024:
-            size = round(size, 2)
-            return f"{size} {unit}"
+# Facts of GGUF Models listed by ramalama list --json
+list_details = ["architecture", "parameters", "quantization", "context_length"]
 
-        size /= 1024
 
-    return f"{size} PB"
+def _list_models(args, details=False):
+    models = []
+    for model in list_models(args.store):
+        listed = {
+            "name": model["name"],
+            "modified": int(time.time() - model["pulled"]),
+            "size": human_readable_size(model["size"]),
+        }
+        if details:
+            summary = gguf.summary(os.path.join(args.store, "models", model["path"]), args.store) or {}
+            listed.update({key: summary.get(key) for key in list_details})
+        models.append(listed)
 
+    return models
 
-def get_size(file):
-    return human_readable_size(os.path.getsize(file))
 
+def inspect_parser(subparsers):
+    parser = subparsers.add_parser("inspect", help="display the metadata of an AI Model")
+    parser.add_argument("--all", action="store_true", help="also list the tensors of the Model")
+    parser.add_argument("--container", default=False, action="store_false", help=argparse.SUPPRESS)
+    parser.add_argument("--json", dest="json", action="store_true", help="print using json")
+    parser.add_argument("MODEL")  # positional argument
+    parser.set_defaults(func=inspect_cli)
 
-def _list_models(args):
-    mycwd = os.getcwd()
-    os.chdir(f"{args.store}/models/")
-    models = []
 
-    # Collect model data
-    for path in list_files_by_modification():
-        if path.is_symlink():
-            name = str(path).replace("/", "://", 1)
-            file_epoch = path.lstat().st_mtime
-            modified = int(time.time() - file_epoch)
-            size = get_size(path)
+def human_readable_count(count):
+    for unit in ["", "K", "M", "B"]:
+        if count < 1000:
+            return f"{round(count, 2)}{unit}"
 
-            # Store data for later use
-            models.append({"name": name, "modified": modified, "size": size})
+        count /= 1000
 
-    os.chdir(mycwd)
-    return models
+    return f"{round(count, 2)}T"
+
+
+def inspect_cli(args):
+    path = args.MODEL
+    if not os.path.isfile(path):
+        try:
+            path = New(args.MODEL, args).symlink_path(args)
+        except OSError:
+            path = None
+        if not path or not os.path.exists(path):
+            raise KeyError(f"{args.MODEL} does not exist in local storage")
+
+    try:
+        model = gguf.GGUF(path)
+    except ValueError as e:
+        raise KeyError(f"unable to inspect {args.MODEL}: {e}")
+
+    info = model.to_dict()
+    if args.json:
+        if not args.all:
+            del info["tensors"]
+        print(json.dumps(info, indent=4))
+        return
+
+    summary = info["summary"]
+    print(f"Name:           {summary['name'] or args.MODEL}")
+    print(f"Architecture:   {summary['architecture']}")
+    print(f"Parameters:     {human_readable_count(summary['parameters'])}")
+    print(f"Quantization:   {summary['quantization']}")
+    print(f"Context length: {summary['context_length']}")
+    print(f"Weights size:   {human_readable_size(summary['weights_size'])}")
+    print(f"GGUF version:   {summary['version']}")
+    print("Metadata:")
+    for key, value in info["metadata"].items():
+        if isinstance(value, dict):
+            value = f"[{value['length']} {value['type']} values]"
+        print(f"  {key}: {value}")
+
+    print(f"Tensors:        {summary['tensor_count']}")
+    if args.all:
+        for tensor in info["tensors"]:
+            shape = "x".join(str(dim) for dim in tensor["shape"])
+            print(f"  {tensor['name']}: {tensor['type']} {shape}")
 
 
 def info_cli(args):
     info = {
+        "Capabilities": capabilities.snapshot(),
         "Engine": args.engine,
         "Image": args.image,
         "Runtime": args.runtime,
@@ -357,7 +531,7 @@ def info_cli(args):
 
 
 def list_cli(args):
-    models = _list_models(args)
+    models = _list_models(args, details=args.json)
 
     # If JSON output is requested
     if args.json:
@@ -369,9 +543,9 @@ def list_cli(args):
     modified_width = len("MODIFIED")
     size_width = len("SIZE")
     for model in models:
-        modified = human_duration(model["modified"]) + " ago"
+        model["modified"] = human_duration(model["modified"]) + " ago"
         name_width = max(name_width, len(model["name"]))
-        modified_width = max(modified_width, len(modified))
+        modified_width = max(modified_width, len(model["modified"]))
         size_width = max(size_width, len(model["size"]))
 
     if not args.quiet and not args.noheading and not args.json:
@@ -381,6 +555,7 @@ def list_cli(args):
         if args.quiet:
             print(model["name"])
         else:
+            modified = model["modified"]
             print(f"{model['name']:<{name_width}} {modified:<{modified_width}} {model['size']:<{size_width}}")
 
 
@@ -398,24 +573,99 @@ def help_cli(args):
 def pull_parser(subparsers):
     parser = subparsers.add_parser("pull", help="pull AI Model from Model registry to local storage")
     parser.add_argument("--authfile", help="path of the authentication file")
+    parser.add_argument(
+        "--connections",
+        type=int,
+        default=DEFAULT_CONNECTIONS,
+        help="number of parallel connections used to download each Model blob",
+    )
     parser.add_argument("--container", default=False, action="store_false", help=argparse.SUPPRESS)
+    parser.add_argument("-f", "--file", help="pull the Models listed in FILE, one per line")
+    parser.add_argument(
+        "--limit-rate",
+        dest="limitrate",
+        metavar="RATE",
+        type=parse_rate,
+        help="limit the total download bandwidth to RATE bytes per second, suffixes K, M and G are accepted",
+    )
+    parser.add_argument(
+        "--max-connections",
+        dest="maxconnections",
+        type=int,
+        default=DEFAULT_MAX_CONNECTIONS,
+        help="maximum number of concurrent connections used to download all Models",
+    )
+    parser.add_argument(
+        "--pull",
+        default="newer",
+        choices=["always", "missing", "never", "newer"],
+        help="pull the Model from the registry: always, if missing locally, never, or if the registry has a newer one",
+    )
     parser.add_argument(
         "--tls-verify",
         dest="tlsverify",
         default=True,
         help="require HTTPS and verify certificates when contacting registries",
     )
-    parser.add_argument("MODEL")  # positional argument
+    parser.add_argument(
+        "--verify",
+        default="cached",
+        choices=["always", "cached", "never"],
+        help="verify the checksum of the Model: always, when the file changed since last verified, or never",
+    )
+    parser.add_argument("MODELS", metavar="MODEL", nargs="*")
     parser.set_defaults(func=pull_cli)
 
 
-def pull_cli(args):
-    model = New(args.MODEL, args)
-    matching_files = glob.glob(f"{args.store}/models/*/{model}")
-    if matching_files:
-        return matching_files[0]
+def _read_models(path):
+    models = []
+    with open(path) as f:
+        for line in f:
+            line = line.split("#", 1)[0].strip()
+            if line:
+                models.append(line)
+
+    return models
+
 
-    return model.pull(args)
+def _pull_model(model, args):
+    symlink_path = model.pull(args)
+    add_model(args.store, symlink_path)
+    return symlink_path
+
+
+def pull_cli(args):
+    models = list(args.MODELS)
+    if args.file:
+        models += _read_models(args.file)
+    if not models:
+        raise IndexError("pull requires at least one MODEL or --file")
+
+    # Resolve every shortname before pulling anything, pulling a Model
+    # listed twice only once
+    models = list(dict.fromkeys(shortnames.resolve(model) or model for model in models))
+    download_scheduler.configure(args.maxconnections, args.limitrate)
+    if len(models) == 1:
+        return _pull_model(New(models[0], args), args)
+
+    failed = {}
+    with download_scheduler.batch(f"{len(models)} Models") as progress:
+        workers = min(len(models), args.maxconnections)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(_pull_model, New(model, args), args): model for model in models}
+            for future in concurrent.futures.as_completed(futures):
+                model = futures[future]
+                try:
+                    future.result()
+                    progress.write(f"Pulled {model}")
+                except Exception as e:
+                    failed[model] = str(e).strip("'")
+                    progress.write(f"Failed to pull {model}")
+
+    if failed:
+        for model, error in failed.items():
+            perror(f"{model}: {error}")
+        raise KeyError(f"failed to pull {len(failed)} of {len(models)} Models")
 
 
 def push_parser(subparsers):
@@ -466,6 +716,36 @@ def push_cli(args):
 def run_parser(subparsers):
     parser = subparsers.add_parser("run", help="run specified AI Model as a chatbot")
     parser.add_argument("-n", "--name", dest="name", help="name of container in which the Model will be run")
+    parser.add_argument(
+        "--batch",
+        metavar="FILE",
+        help="run the prompts of a JSONL file, one request per line, loading the Model once",
+    )
+    parser.add_argument(
+        "--output",
+        default="-",
+        metavar="FILE",
+        help="JSONL file the --batch results are appended to in input order, a rerun resumes after the last one",
+    )
+    parser.add_argument("--parallel", type=int, default=4, help="number of --batch prompts run at once")
+    parser.add_argument(
+        "--pull",
+        default="missing",
+        choices=["always", "missing", "never", "newer"],
+        help="pull the Model from the registry: always, if missing locally, never, or if the registry has a newer one",
+    )
+    parser.add_argument(
+        "--tune",
+        default="auto",
+        choices=["auto", "none"],
+        help="derive the llama.cpp parameters from the Model and the host, or use fixed defaults",
+    )
+    parser.add_argument(
+        "--verify",
+        default="cached",
+        choices=["always", "cached", "never"],
+        help="verify the checksum of the Model: always, when the file changed since last verified, or never",
+    )
     parser.add_argument("MODEL")  # positional argument
     parser.add_argument(
         "ARGS", nargs="*", help="Overrides the default prompt, and the output is returned without entering the chatbot"
@@ -474,6 +754,13 @@ def run_parser(subparsers):
 
 
 def run_cli(args):
+    if args.batch:
+        if args.ARGS:
+            raise IndexError("--batch does not take a prompt, the prompts are read from the file")
+        if args.parallel < 1:
+            raise IndexError("--parallel must be at least 1")
+        if not os.path.isfile(args.batch):
+            raise KeyError(f"{args.batch} does not exist")
     model = New(args.MODEL, args)
     model.run(args)
 
@@ -482,23 +769,139 @@ def serve_parser(subparsers):
     parser = subparsers.add_parser("serve", help="serve REST API on specified AI Model")
     parser.add_argument("-d", "--detach", action="store_true", dest="detach", help="run the container in detached mode")
     parser.add_argument("-n", "--name", dest="name", help="name of container in which the Model will be run")
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="answer repeated deterministic requests, with temperature 0, from a cache of the responses",
+    )
+    parser.add_argument(
+        "--cache-disk",
+        type=parse_size,
+        default="0",
+        help="spill the responses evicted from memory to the store, up to this size, e.g. 1G",
+    )
+    parser.add_argument("--cache-size", type=parse_size, default="256M", help="memory the cached responses may take")
+    parser.add_argument(
+        "--cache-ttl", type=int, default=3600, help="seconds a response is cached for, 0 until it is evicted"
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        type=int,
+        default=0,
+        help="stop the server of a Model idle for this many seconds, 0 never stops it, with several Models",
+    )
+    parser.add_argument(
+        "--max-models",
+        type=int,
+        default=0,
+        help="most Models to keep running at once, 0 for no limit, with several Models",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=parse_size,
+        help="memory the running Models may take, e.g. 24G, with several Models (default: the available memory)",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="serve Prometheus metrics of the requests and the servers on this port",
+    )
     parser.add_argument("-p", "--port", default="8080", help="port for AI Model server to listen on")
+    parser.add_argument(
+        "--preload",
+        default="none",
+        choices=["none", "read", "mlock"],
+        help="read the Model into the page cache before serving it, and with mlock lock it in memory",
+    )
+    parser.add_argument(
+        "--pull",
+        default="missing",
+        choices=["always", "missing", "never", "newer"],
+        help="pull the Model from the registry: always, if missing locally, never, or if the registry has a newer one",
+    )
     parser.add_argument(
         "--generate",
         choices=["quadlet", "kube"],
         help="generate specified configuration format for running the AI Model as a service",
     )
+    parser.add_argument(
+        "--replicas",
+        type=int,
+        default=1,
+        help="servers of every Model, balanced by outstanding requests and spread over the cores and NUMA nodes",
+    )
+    parser.add_argument(
+        "--tune",
+        default="auto",
+        choices=["auto", "none"],
+        help="derive the llama.cpp parameters from the Model and the host, or use fixed defaults",
+    )
+    parser.add_argument(
+        "--verify",
+        default="cached",
+        choices=["always", "cached", "never"],
+        help="verify the checksum of the Model: always, when the file changed since last verified, or never",
+    )
+    parser.add_argument(
+        "--warmup",
+        metavar="PROMPT",
+        help="complete PROMPT on every server before it is sent requests, /health reports ready afterwards",
+    )
     parser.add_argument("MODEL")  # positional argument
+    parser.add_argument("MODELS", metavar="MODEL", nargs="*", help="further Models, served behind a routing proxy")
     parser.set_defaults(func=serve_cli)
 
 
 def serve_cli(args):
     if not args.container:
         args.detach = False
+    if args.replicas < 1:
+        raise IndexError("--replicas must be at least 1")
+    if args.MODELS or args.replicas > 1 or args.cache or args.warmup or args.metrics_port:
+        return serve_proxy(args)
+
     model = New(args.MODEL, args)
     model.serve(args)
 
 
+def _model_names(name, resolved):
+    """Return the names a Model is requested by: as given, resolved, and without its transport."""
+    names = [name, resolved, resolved.split("://", 1)[-1]]
+    return [n for i, n in enumerate(names) if n not in names[:i]]
+
+
+def serve_proxy(args):
+    """Serve Models through the routing proxy, for several Models, replicas, the response cache, warm-up or metrics."""
+    if args.generate:
+        raise IndexError("--generate does not support several Models, --replicas, --cache, --warmup or --metrics-port")
+
+    models = []
+    unresolved = [getattr(args, "UNRESOLVED_MODEL", args.MODEL)] + args.MODELS
+    resolved = [args.MODEL] + [shortnames.resolve(model) or model for model in args.MODELS]
+    for name, model in zip(unresolved, resolved):
+        models.append(New(model, args).replicas(args, _model_names(name, model)))
+
+    if args.dryrun:
+        for model in models:
+            for backend in model.backends:
+                dry_run(backend.command("<port>"))
+        return
+
+    memory_budget = args.memory_budget
+    if memory_budget is None:
+        available = available_memory()
+        memory_budget = int(available * MEMORY_SHARE) if available else 0
+    router = Router(models, args.max_models, memory_budget, args.idle_timeout)
+    cache = None
+    if args.cache:
+        directory = os.path.join(args.store, "cache", "responses")
+        cache = ResponseCache(args.cache_size, args.cache_ttl, directory, args.cache_disk)
+    # Reachable through the published port inside a container, only locally otherwise
+    host = "0.0.0.0" if in_container() else "127.0.0.1"
+    metrics = Metrics(args.metrics_port) if args.metrics_port else None
+    serve(router, host, args.port, cache, metrics, debug=args.debug)
+
+
 def stop_parser(subparsers):
     parser = subparsers.add_parser("stop", help="stop named container that is running AI Model")
     parser.add_argument("--container", default=False, action="store_false", help=argparse.SUPPRESS)
@@ -547,6 +950,22 @@ def stop_container(args):
         _stop_container(args, i)
 
 
+def store_parser(subparsers):
+    parser = subparsers.add_parser("store", help="manage the local storage of AI Models")
+    parser.add_argument("--container", default=False, action="store_false", help=argparse.SUPPRESS)
+    store_subparsers = parser.add_subparsers(dest="store_command", metavar="COMMAND")
+    store_subparsers.required = True
+
+    reindex_parser = store_subparsers.add_parser("reindex", help="rebuild the index of Models from local storage")
+    reindex_parser.add_argument("--container", default=False, action="store_false", help=argparse.SUPPRESS)
+    reindex_parser.set_defaults(func=reindex_cli)
+
+
+def reindex_cli(args):
+    count = reindex(args.store)
+    print(f"Indexed {count} Models")
+
+
 def version_parser(subparsers):
     parser = subparsers.add_parser("version", help="display version of AI Model")
     # Do not run in a container
@@ -593,22 +1012,7 @@ def get_store():
 
 
 def get_gpu():
-    i = 0
-    gpu_num = 0
-    gpu_bytes = 0
-    for fp in sorted(glob.glob('/sys/bus/pci/devices/*/mem_info_vram_total')):
-        with open(fp, 'r') as file:
-            content = int(file.read())
-            if content > 1073741824 and content > gpu_bytes:
-                gpu_bytes = content
-                gpu_num = i
-
-        i += 1
-
-    if gpu_bytes:  # this is the ROCm/AMD case
-        return "HIP_VISIBLE_DEVICES", gpu_num
-
-    return None, None
+    return tuple(capabilities["gpu"])
 
 
 def run_container(args):
@@ -636,7 +1040,7 @@ def run_container(args):
     else:
         name = genname()
 
-    short_file = shortnames.create_shortname_file()
+    short_file = shortnames.shortname_file()
     wd = find_working_directory()
     conman_args = [
         conman,
@@ -668,12 +1072,24 @@ def run_container(args):
 
     if hasattr(args, "port"):
         conman_args += ["-p", f"{args.port}:{args.port}"]
+    if getattr(args, "metrics_port", None):
+        conman_args += ["-p", f"{args.metrics_port}:{args.metrics_port}"]
 
-    if os.path.exists("/dev/dri"):
-        conman_args += ["--device", "/dev/dri"]
+    # The --batch files are found at the same paths inside the container
+    if getattr(args, "batch", None):
+        cwd = os.getcwd()
+        conman_args += ["-w", cwd]
+        files = [path for path in [args.batch, args.output] if path != "-"]
+        for directory in sorted({cwd} | {os.path.dirname(os.path.abspath(path)) for path in files}):
+            conman_args += [f"-v{directory}:{directory}"]
 
-    if os.path.exists("/dev/kfd"):
-        conman_args += ["--device", "/dev/kfd"]
+    for device in capabilities["devices"]:
+        conman_args += ["--device", device]
+
+    # Spare the RamaLama process in the container probing the host again
+    if capabilities.path:
+        host_capabilities = os.path.relpath(capabilities.path, args.store)
+        conman_args += ["-e", f"RAMALAMA_HOST_CAPABILITIES=/var/lib/ramalama/{host_capabilities}"]
 
     gpu_type, gpu_num = get_gpu()
     if gpu_type == "HIP_VISIBLE_DEVICES":
@@ -695,25 +1111,9 @@ def run_container(args):
         dry_run(conman_args)
         return True
 
-    def cleanup():
-        os.remove(short_file)
-
-    atexit.register(cleanup)
-
     run_cmd(conman_args, stdout=None, debug=args.debug)
 
 
-def dry_run(args):
-    for arg in args:
-        if not arg:
-            continue
-        if " " in arg:
-            print('"%s"' % arg, end=" ")
-        else:
-            print("%s" % arg, end=" ")
-    print()
-
-
 def New(model, args):
     if model.startswith("huggingface://") or model.startswith("hf://"):
         return Huggingface(model)
@@ -1,16 +1,44 @@
 """ramalama common module."""
 
+import concurrent.futures
+import contextlib
+import fcntl
+import functools
 import hashlib
+import http.client
+import io
+import json
 import os
 import random
 import shutil
 import string
+import ssl
 import subprocess
 import sys
+import threading
+import time
+import urllib.parse
 import urllib.request
 
 x = False
 
+# Number of parallel connections used to download a blob
+DEFAULT_CONNECTIONS = 4
+# Blobs smaller than this per connection are downloaded over a single stream
+MIN_SEGMENT_SIZE = 16 * 1024 * 1024
+CHUNK_SIZE = 1024 * 1024
+SEGMENT_RETRIES = 3
+# Verified copies remembered per checksum
+VERIFIED_KEYS = 8
+# ioctl cloning a file on filesystems with reflink support
+FICLONE = 0x40049409
+# Seconds cached registry metadata is trusted by the "newer" pull policy
+METADATA_TTL = 600
+# Concurrent download streams across every blob being pulled
+DEFAULT_MAX_CONNECTIONS = 16
+# Seconds an HTTP connection waits to connect, or for data, before failing
+HTTP_TIMEOUT = 60
+
 
 def in_container():
     if os.path.exists("/run/.containerenv") or os.path.exists("/.dockerenv") or os.getenv("container"):
@@ -19,6 +47,7 @@ def in_container():
     return False
 
 
+@functools.cache
 def container_manager():
     engine = os.getenv("RAMALAMA_CONTAINER_ENGINE")
     if engine is not None:
@@ -76,6 +105,22 @@ def exec_cmd(args, stderr=True, debug=False):
         raise
 
 
+def dry_run(args):
+    for arg in args:
+        if not arg:
+            continue
+        if " " in arg:
+            print('"%s"' % arg, end=" ")
+        else:
+            print("%s" % arg, end=" ")
+    print()
+
+
+# Number of subprocesses spawned by run_cmd, reported with --debug
+spawned = 0
+_spawned_lock = threading.Lock()
+
+
 def run_cmd(args, cwd=None, stdout=subprocess.PIPE, ignore_stderr=False, debug=False):
     """
     Run the given command arguments.
@@ -84,9 +129,13 @@ def run_cmd(args, cwd=None, stdout=subprocess.PIPE, ignore_stderr=False, debug=F
     args: command line arguments to execute in a subprocess
     cwd: optional working directory to run the command from
     """
+    global spawned
     if debug:
         perror("run_cmd: ", *args)
 
+    with _spawned_lock:
+        spawned += 1
+
     stderr = None
     if ignore_stderr:
         stderr = subprocess.PIPE
@@ -94,6 +143,22 @@ def run_cmd(args, cwd=None, stdout=subprocess.PIPE, ignore_stderr=False, debug=F
     return subprocess.run(args, check=True, cwd=cwd, stdout=stdout, stderr=stderr)
 
 
+def report_spawned():
+    perror(f"run_cmd: {spawned} subprocesses spawned")
+
+
+def symlink(target, link_path):
+    """Atomically point link_path at target, replacing an existing link like ln -sf."""
+    dirname, basename = os.path.split(link_path)
+    tmp_path = os.path.join(dirname, f".{basename}.{os.getpid()}.{threading.get_ident()}")
+    os.symlink(target, tmp_path)
+    try:
+        os.replace(tmp_path, link_path)
+    except OSError:
+        os.remove(tmp_path)
+        raise
+
+
 def find_working_directory():
     return os.path.dirname(__file__)
 
@@ -108,7 +173,108 @@ def run_curl_cmd(args, filename):
             raise e
 
 
-def verify_checksum(filename):
+def blob_store_path(store, digest):
+    """Return the path of a blob in the store's content-addressed area."""
+    return os.path.join(store, "blobs", "sha256", digest.removeprefix("sha256:"))
+
+
+def link_blob(store, path, digest=None):
+    """
+    Populate path from the content-addressed copy of the blob, if there is one.
+
+    Transports keep their blobs in their own trees under repos/, this makes
+    path share the storage of a blob any transport already pulled.
+
+    Args:
+    store: store directory
+    path: transport path of the blob
+    digest: digest of the blob, defaults to the "sha256:<checksum>" name of path
+
+    Returns:
+    bool: True if path now shares the stored copy.
+    """
+    checksum = (digest or os.path.basename(path)).removeprefix("sha256:")
+    source = blob_store_path(store, checksum)
+    if not os.path.exists(source):
+        return False
+
+    if os.path.exists(path) and os.path.samefile(source, path):
+        return True
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    verified = _verified_key(source) in _verified_keys(store, checksum)
+    if not _share_file(source, path):
+        return False
+    if verified:
+        # Linking changed the ctime the verification was recorded with
+        _record_verified_key(store, checksum, _verified_key(path))
+
+    # Any partial download of the blob is obsolete
+    state_path = segments_path(path)
+    if os.path.exists(state_path):
+        os.remove(state_path)
+    return True
+
+
+def store_blob(store, path, digest=None):
+    """
+    Add the verified blob at path to the content-addressed area.
+
+    When the area already holds a valid copy of the blob, path is replaced
+    by the stored copy so the blob is only kept once on disk. A stored copy
+    failing verification is replaced by path.
+
+    Returns:
+    bool: True if path or the stored copy was replaced, changing the ctime
+          of the blob.
+    """
+    checksum = (digest or os.path.basename(path)).removeprefix("sha256:")
+    target = blob_store_path(store, checksum)
+    if os.path.exists(target):
+        if os.path.samefile(target, path):
+            return False
+        if _verified_key(target) in _verified_keys(store, checksum) or sha256sum(target) == checksum:
+            return _share_file(target, path)
+
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    return _share_file(path, target)
+
+
+def unshare_blob(store, path, digest=None):
+    """Remove path when it shares the content-addressed copy, so a download does not write to the copy."""
+    target = blob_store_path(store, digest or os.path.basename(path))
+    if os.path.exists(path) and os.path.exists(target) and os.path.samefile(target, path):
+        os.remove(path)
+
+
+def remove_blob(store, path, digest=None):
+    """Remove the blob at path, and the content-addressed copy of the blob with digest when given."""
+    if os.path.exists(path):
+        os.remove(path)
+        print(f"Deleted: {os.path.basename(path)}")
+    if digest and os.path.exists(blob_store_path(store, digest)):
+        os.remove(blob_store_path(store, digest))
+
+
+def _share_file(source, dest):
+    """Atomically replace dest by a hardlink, or failing that a reflink, of source."""
+    tmp_path = f"{dest}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.link(source, tmp_path)
+    except OSError:
+        try:
+            with open(source, "rb") as src, open(tmp_path, "wb") as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return False
+
+    os.replace(tmp_path, dest)
+    return True
+
+
+def verify_checksum(filename, policy="always", store=None):
     """
     Verifies if the SHA-256 checksum of a file matches the checksum provided in
     the filename.
@@ -116,6 +282,10 @@ def verify_checksum(filename):
     Args:
     filename (str): The filename containing the checksum prefix
                     (e.g., "sha256:<checksum>")
+    policy (str): "always" hashes the file contents, "cached" trusts an earlier
+                  verification of the unchanged file recorded in the store and
+                  "never" trusts the checksum in the filename.
+    store (str): store directory recording verified files
 
     Returns:
     bool: True if the checksum matches, False otherwise.
@@ -124,6 +294,10 @@ def verify_checksum(filename):
     if not os.path.exists(filename):
         return False
 
+    # A segmented download of this file is still in progress
+    if os.path.exists(segments_path(filename)):
+        return False
+
     # Check if the filename starts with "sha256:"
     fn_base = os.path.basename(filename)
     if not fn_base.startswith("sha256:"):
@@ -134,14 +308,418 @@ def verify_checksum(filename):
     if len(expected_checksum) != 64:
         raise ValueError("invalid checksum length in filename")
 
-    # Calculate the SHA-256 checksum of the file contents
+    if policy == "never":
+        return True
+
+    if policy == "cached" and store and _verified_key(filename) in _verified_keys(store, expected_checksum):
+        return True
+
+    # Compare the checksums
+    if sha256sum(filename) != expected_checksum:
+        return False
+
+    if store:
+        record_verified(filename, store)
+    return True
+
+
+def _verified_path(store, checksum):
+    return os.path.join(store, "cache", "verified", checksum)
+
+
+def _verified_key(filename):
+    # Any write to the file changes its size, mtime or ctime
+    st = os.stat(filename)
+    return [st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns]
+
+
+def _verified_keys(store, checksum):
+    try:
+        with open(_verified_path(store, checksum)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+
+def record_verified(filename, store):
+    """Record in the store that filename matches the checksum in its name."""
+    _record_verified_key(store, os.path.basename(filename).split(":")[1], _verified_key(filename))
+
+
+def _record_verified_key(store, checksum, key):
+    keys = [k for k in _verified_keys(store, checksum) if k[:2] != key[:2]]
+    keys.append(key)
+
+    path = _verified_path(store, checksum)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(keys[-VERIFIED_KEYS:], f)
+    os.replace(tmp_path, path)
+
+
+def sha256sum(filename, size=None):
+    """Return the SHA-256 hex digest of the first size bytes of filename, or of the whole file."""
     sha256_hash = hashlib.sha256()
+    _hash_file(sha256_hash, filename, size)
+    return sha256_hash.hexdigest()
+
+
+def _hash_file(sha256_hash, filename, size=None):
     with open(filename, "rb") as f:
-        for byte_block in iter(lambda: f.read(4096), b""):
+        while size is None or size > 0:
+            byte_block = f.read(CHUNK_SIZE if size is None else min(CHUNK_SIZE, size))
+            if not byte_block:
+                break
             sha256_hash.update(byte_block)
+            if size is not None:
+                size -= len(byte_block)
 
-    # Compare the checksums
-    return sha256_hash.hexdigest() == expected_checksum
+
+class HTTPResponse:
+    """Response of an HTTPClient request, the connection is reused once the body is consumed."""
+
+    def __init__(self, client, key, conn, response, url):
+        self.client = client
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.url = url
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+
+    def read(self, amt=None):
+        return self.response.read(amt)
+
+    def geturl(self):
+        return self.url
+
+    def close(self):
+        if self.conn is None:
+            return
+
+        if self.response.isclosed() and not self.response.will_close:
+            self.client._release(self.key, self.conn)
+        else:
+            self.response.close()
+            self.conn.close()
+        self.conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class HTTPClient:
+    """
+    HTTP client shared by every transport.
+
+    Connections are kept alive and pooled per host, so the manifest, config
+    and blob requests of a pull, and the segments of a download, reuse
+    connections instead of paying a TCP and TLS handshake per request.
+    Redirect targets are remembered for the lifetime of the client, so a
+    blob redirected to a CDN is only redirected once per pull. Connections
+    time out after HTTP_TIMEOUT seconds without progress, and a request
+    failing on a pooled connection is retried once on a new one.
+    """
+
+    redirect_codes = [301, 302, 303, 307, 308]
+    max_redirects = 10
+
+    def __init__(self):
+        self.debug = False
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.redirects = {}
+        self._context = None
+
+    @property
+    def context(self):
+        # Loading the CA certificates is slow, only do it for HTTPS requests
+        with self.lock:
+            if self._context is None:
+                self._context = ssl.create_default_context()
+            return self._context
+
+    def urlopen(self, request):
+        """
+        Perform request, a urllib.request.Request, following redirects.
+
+        Raises urllib.error.HTTPError for responses other than 2xx and
+        urllib.error.URLError when the server cannot be reached, like
+        urllib.request.urlopen.
+        """
+        url = request.full_url
+        if self._proxied(url):
+            return urllib.request.urlopen(request)
+
+        method = request.get_method()
+        data = request.data
+        headers = dict(request.header_items())
+        with self.lock:
+            cached = method == "GET" and url in self.redirects
+            target = self.redirects.get(url, url) if cached else url
+        for _ in range(self.max_redirects):
+            response = self._request(method, target, headers, data)
+            if response.status in self.redirect_codes and response.headers.get("Location"):
+                response.read()
+                response.close()
+                location = urllib.parse.urljoin(target, response.headers["Location"])
+                if urllib.parse.urlsplit(location).netloc != urllib.parse.urlsplit(target).netloc:
+                    headers.pop("Authorization", None)
+                if response.status == 303:
+                    method, data = "GET", None
+                target = location
+                continue
+
+            if response.status >= 300:
+                if cached and response.status >= 400:
+                    # The remembered redirect target expired, start over
+                    response.read()
+                    response.close()
+                    with self.lock:
+                        self.redirects.pop(url, None)
+                    return self.urlopen(request)
+
+                body = response.read()
+                response.close()
+                raise urllib.error.HTTPError(
+                    target, response.status, response.reason, response.headers, io.BytesIO(body)
+                )
+
+            if target != url and method == "GET":
+                with self.lock:
+                    self.redirects[url] = target
+            return response
+
+        raise urllib.error.URLError(f"too many redirects for {url}")
+
+    def _proxied(self, url):
+        scheme, netloc = urllib.parse.urlsplit(url)[:2]
+        proxies = urllib.request.getproxies()
+        return scheme in proxies and not urllib.request.proxy_bypass(netloc)
+
+    def _connection(self, key, reuse=True):
+        with self.lock:
+            connections = self.idle.get(key)
+            if reuse and connections:
+                return connections.pop(), True
+
+        scheme, host, port = key
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, port, timeout=HTTP_TIMEOUT, context=self.context), False
+        return http.client.HTTPConnection(host, port, timeout=HTTP_TIMEOUT), False
+
+    def _release(self, key, conn):
+        with self.lock:
+            self.idle.setdefault(key, []).append(conn)
+
+    def _request(self, method, url, headers, data):
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+
+        start = time.monotonic()
+        conn, reused = self._connection(key)
+        try:
+            try:
+                conn.request(method, path, body=data, headers=headers)
+                response = conn.getresponse()
+            except (OSError, http.client.HTTPException):
+                # The server closed the idle connection or it went stale, retry once on a new one
+                conn.close()
+                if not reused:
+                    raise
+                conn, reused = self._connection(key, reuse=False)
+                conn.request(method, path, body=data, headers=headers)
+                response = conn.getresponse()
+        except OSError as e:
+            conn.close()
+            raise urllib.error.URLError(e)
+
+        if self.debug:
+            elapsed = time.monotonic() - start
+            connection = "reused" if reused else "new"
+            perror(f"http: {method} {url} {response.status} {elapsed:.3f}s ({connection} connection)")
+
+        return HTTPResponse(self, key, conn, response, url)
+
+
+http_client = HTTPClient()
+
+
+class DownloadScheduler:
+    """
+    Share the network between every download of the process.
+
+    Each HTTP stream transferring a blob holds one of max_connections slots
+    and every chunk read is charged against a token bucket refilled at rate
+    bytes per second, so concurrent pulls stay within a global budget.
+    When progress is set, downloads report to that single progress bar
+    instead of displaying their own.
+    """
+
+    def __init__(self, max_connections=None, rate=None):
+        self.lock = threading.Lock()
+        self.progress = None
+        self.configure(max_connections, rate)
+
+    def configure(self, max_connections=None, rate=None):
+        self.slots = threading.BoundedSemaphore(max_connections) if max_connections else None
+        self.rate = rate
+        self.tokens = rate or 0
+        self.last = time.monotonic()
+
+    def acquire(self):
+        if self.slots:
+            self.slots.acquire()
+
+    def release(self):
+        if self.slots:
+            self.slots.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    @contextlib.contextmanager
+    def batch(self, desc):
+        """Report every download to a single progress bar while the context is active."""
+        progress = _progress_bar(desc, 0, 0, True)
+        self.progress = progress
+        try:
+            yield progress
+        finally:
+            self.progress = None
+            progress.close()
+
+    def throttle(self, size):
+        """Wait until size bytes fit in the bandwidth budget."""
+        if not self.rate:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate) - size
+            self.last = now
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if delay:
+            time.sleep(delay)
+
+
+download_scheduler = DownloadScheduler()
+
+_blob_locks = {}
+_blob_locks_lock = threading.Lock()
+
+
+def blob_lock(digest):
+    """
+    Return the lock serialising pulls of the blob with digest.
+
+    Models pulled concurrently often share blobs, the first pull downloads
+    the blob while the others wait and then reuse the verified copy.
+    """
+    digest = digest.removeprefix("sha256:")
+    with _blob_locks_lock:
+        return _blob_locks.setdefault(digest, threading.Lock())
+
+
+def parse_size(size):
+    """Convert a size such as 500K, 10M, 8G or 1T to bytes."""
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+    size = size.strip().upper().removesuffix("B")
+    try:
+        if size and size[-1] in units:
+            return int(float(size[:-1]) * units[size[-1]])
+        return int(size)
+    except ValueError:
+        raise ValueError(f"invalid size {size}")
+
+
+def parse_rate(rate):
+    """Convert a rate such as 500K, 10M or 1G to bytes per second."""
+    try:
+        return parse_size(rate)
+    except ValueError:
+        raise ValueError(f"invalid rate {rate}")
+
+
+def fetch_metadata(url, headers=None, store=None, policy="newer"):
+    """
+    Fetch registry metadata such as a manifest through the store's metadata cache.
+
+    Args:
+    url: URL of the metadata
+    headers: optional HTTP request headers
+    store: store directory holding the cache, no caching when None
+    policy: "never" only uses the cache, "missing" uses any cached copy,
+            "newer" uses a cached copy younger than METADATA_TTL and
+            revalidates older ones, "always" revalidates the cached copy.
+
+    Returns:
+    str: the metadata body.
+    """
+    headers = headers or {}
+    cached = None
+    cache_path = None
+    if store:
+        key = hashlib.sha256(json.dumps([url, headers], sort_keys=True).encode()).hexdigest()
+        cache_path = os.path.join(store, "cache", "metadata", key)
+        try:
+            with open(cache_path) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    if cached:
+        if policy in ["never", "missing"]:
+            return cached["body"]
+        if policy == "newer" and time.time() - cached["fetched"] < METADATA_TTL:
+            return cached["body"]
+    elif policy == "never":
+        raise KeyError(f"{url} is not available without pulling")
+
+    request = urllib.request.Request(url, headers=headers)
+    if cached and cached.get("etag"):
+        request.headers["If-None-Match"] = cached["etag"]
+    if cached and cached.get("last_modified"):
+        request.headers["If-Modified-Since"] = cached["last_modified"]
+
+    try:
+        with http_client.urlopen(request) as response:
+            cached = {
+                "body": response.read().decode(),
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+            }
+    except urllib.error.HTTPError as e:
+        if e.code != 304 or not cached:
+            raise e
+    except urllib.error.URLError as e:
+        if not cached:
+            raise e
+        perror(f"Warning: using cached {url}: {e.reason}")
+        return cached["body"]
+
+    if cache_path:
+        cached["fetched"] = time.time()
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(cached, f)
+        os.replace(tmp_path, cache_path)
+
+    return cached["body"]
 
 
 # default_image function should figure out which GPU the system uses t
@@ -153,14 +731,110 @@ def default_image():
     return "quay.io/ramalama/ramalama:latest"
 
 
+def human_readable_size(size):
+    for unit in ["B", "KB", "MB", "GB", "TB"]:
+        if size < 1024:
+            size = round(size, 2)
+            return f"{size} {unit}"
+
+        size /= 1024
+
+    return f"{size} PB"
+
+
 def genname():
     return "ramalama_" + "".join(random.choices(string.ascii_letters + string.digits, k=10))
 
 
-def download_file(url, dest_path, headers=None, show_progress=True):
+def download_file(
+    url, dest_path, headers=None, show_progress=True, connections=DEFAULT_CONNECTIONS, position=None, cancel=None
+):
+    """
+    Download url into dest_path, resuming a previous partial download.
+
+    When the server supports byte ranges and the blob is large enough, the
+    download is split into segments fetched over parallel connections, each
+    written at its offset into a preallocated file. Segment progress is kept
+    in a hidden state file next to dest_path so an interrupted download
+    resumes where every segment left off.
+
+    The SHA-256 digest of the blob is computed while it is downloaded, so the
+    caller can verify it without reading the whole file back afterwards.
+    Segments downloaded ahead of the hashed offset are still read back from
+    the file, about (n - 1) / n of the blob for n connections, as the
+    download progresses.
+
+    Args:
+    url: URL of the blob to download
+    dest_path: path the blob is written to
+    headers: optional HTTP request headers
+    show_progress: display a progress bar
+    connections: maximum number of concurrent connections
+    position: line of the progress bar when several downloads run concurrently
+    cancel: optional threading.Event, setting it stops the download and
+            raises InterruptedError, leaving it resumable
+
+    Returns:
+    str: the SHA-256 hex digest of the downloaded file.
+    """
+    headers = headers or {}
+    cancel = cancel or threading.Event()
+    if cancel.is_set():
+        raise InterruptedError(f"download of {url} cancelled")
+
+    state_path = segments_path(dest_path)
+    if connections > 1 or os.path.exists(state_path):
+        total_size = _range_size(url, headers)
+        if total_size:
+            connections = max(min(connections, total_size // MIN_SEGMENT_SIZE), 1)
+            if connections > 1 or os.path.exists(state_path):
+                return _download_segmented(
+                    url, dest_path, headers, show_progress, connections, total_size, position, cancel
+                )
+
+    # Segments left behind by a segmented download cannot be resumed by a
+    # single stream, start over.
+    if os.path.exists(state_path):
+        os.remove(state_path)
+        if os.path.exists(dest_path):
+            os.remove(dest_path)
+
+    return _download_single(url, dest_path, headers, show_progress, position, cancel)
+
+
+def segments_path(dest_path):
+    """Return the hidden file recording progress of a segmented download."""
+    dirname, basename = os.path.split(dest_path)
+    return os.path.join(dirname, f".{basename}.segments")
+
+
+class _SharedProgress:
+    """Report the progress of one download to the progress bar of a batch of downloads."""
+
+    def __init__(self, progress, total, initial):
+        self.progress = progress
+        with download_scheduler.lock:
+            progress.total = (progress.total or 0) + total - initial
+            progress.refresh()
+
+    def update(self, n):
+        with download_scheduler.lock:
+            self.progress.update(n)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+def _progress_bar(desc, total, initial, show_progress, position=None):
+    if download_scheduler.progress is not None:
+        return _SharedProgress(download_scheduler.progress, total, initial)
+
     try:
         from tqdm import tqdm
-    except FileNotFoundError:
+    except ImportError:
         raise NotImplementedError(
             """\
 Ollama models requires the tqdm modules.
@@ -170,52 +844,291 @@ pip install tqdm
 """
         )
 
+    bar_format = "Pulling {desc}: {percentage:3.0f}% ▕{bar:20}▏ {n_fmt}/{total_fmt} {rate_fmt} {remaining}"
+    return tqdm(
+        desc=desc,
+        total=total,
+        initial=initial,
+        unit="B",
+        unit_scale=True,
+        unit_divisor=1024,
+        bar_format=bar_format,
+        ascii=True,
+        disable=not show_progress,
+        position=position,
+    )
+
+
+def _range_size(url, headers):
+    """
+    Probe whether the server honours byte ranges for url.
+
+    Returns the total size of the blob, or None when ranges are not supported.
+    """
+    request = urllib.request.Request(url, headers=headers)
+    request.headers["Range"] = "bytes=0-0"
+    try:
+        with http_client.urlopen(request) as response:
+            content_range = response.headers.get("Content-Range", "")
+            if response.status != 206 or "/" not in content_range:
+                return None
+
+            response.read()
+            total = content_range.rsplit("/", 1)[1]
+            return int(total) if total.isdigit() else None
+    except urllib.error.HTTPError as e:
+        if e.code == 416:
+            return None
+        raise e
+
+
+def _download_single(url, dest_path, headers, show_progress, position, cancel):
     # Check if partially downloaded file exists
     if os.path.exists(dest_path):
         downloaded_size = os.path.getsize(dest_path)
     else:
         downloaded_size = 0
 
-    request = urllib.request.Request(url, headers=headers or {})
+    request = urllib.request.Request(url, headers=headers)
     request.headers["Range"] = f"bytes={downloaded_size}-"  # Set range header
 
-    filename = dest_path.split('/')[-1]
-
-    bar_format = "Pulling {desc}: {percentage:3.0f}% ▕{bar:20}▏ {n_fmt}/{total_fmt} {rate_fmt} {remaining}"
+    filename = os.path.basename(dest_path)
+    sha256_hash = hashlib.sha256()
     try:
-        with urllib.request.urlopen(request) as response:
+        with download_scheduler, http_client.urlopen(request) as response:
+            mode = "ab"
+            if response.status != 206:
+                # Server ignored the range, the whole blob is being sent
+                downloaded_size = 0
+                mode = "wb"
+
+            # Seed the digest with the bytes of the resumed download
+            if downloaded_size:
+                _hash_file(sha256_hash, dest_path, downloaded_size)
+
             total_size = int(response.headers.get("Content-Length", 0)) + downloaded_size
-            chunk_size = 8192  # 8 KB chunks
-
-            with open(dest_path, "ab") as file:
-                if show_progress:
-                    with tqdm(
-                        desc=filename,
-                        total=total_size,
-                        initial=downloaded_size,
-                        unit="B",
-                        unit_scale=True,
-                        unit_divisor=1024,
-                        bar_format=bar_format,
-                        ascii=True,
-                    ) as progress_bar:
-                        while True:
-                            chunk = response.read(chunk_size)
-                            if not chunk:
-                                break
-                            file.write(chunk)
-                            progress_bar.update(len(chunk))
-                else:
-                    # Download file without showing progress
+            with open(dest_path, mode) as file:
+                with _progress_bar(filename, total_size, downloaded_size, show_progress, position) as progress_bar:
                     while True:
-                        chunk = response.read(chunk_size)
+                        if cancel.is_set():
+                            raise InterruptedError(f"download of {url} cancelled")
+                        chunk = response.read(CHUNK_SIZE)
                         if not chunk:
                             break
+                        download_scheduler.throttle(len(chunk))
                         file.write(chunk)
+                        sha256_hash.update(chunk)
+                        progress_bar.update(len(chunk))
     except urllib.error.HTTPError as e:
         if e.code == 416:
             if show_progress:
                 # If we get a 416 error, it means the file is fully downloaded
                 print(f"File {url} already fully downloaded.")
+            return sha256sum(dest_path)
         else:
             raise e
+
+    return sha256_hash.hexdigest()
+
+
+class _SegmentHasher:
+    """
+    Compute the SHA-256 digest of a segmented download in file order.
+
+    Chunks written at the hashed offset are hashed straight from memory.
+    Bytes that segments downloaded ahead of the hashed offset, including
+    those restored from an interrupted download, are hashed from the file
+    once the hashed offset reaches them. With n evenly progressing segments
+    that is about (n - 1) / n of the blob, mostly served from the page
+    cache.
+
+    One segment thread at a time hashes, the others only write their
+    chunks, and the file is read back outside of the lock so segments
+    keep downloading while it is.
+    """
+
+    def __init__(self, fd, segments):
+        self.fd = fd
+        self.segments = sorted(segments)
+        self.offset = 0
+        self.hashing = False
+        self.sha256_hash = hashlib.sha256()
+        self.lock = threading.Lock()
+
+    def update(self, offset, chunk):
+        with self.lock:
+            if self.hashing:
+                # The hashing thread reads the chunk back once it reaches it
+                return
+            self.hashing = True
+
+        if offset == self.offset:
+            self.sha256_hash.update(chunk)
+            self.offset += len(chunk)
+        self._catch_up()
+
+    def hexdigest(self):
+        # Every segment is done, nothing else hashes
+        self._catch_up()
+        return self.sha256_hash.hexdigest()
+
+    def _catch_up(self):
+        while True:
+            with self.lock:
+                size = self._available()
+                if not size:
+                    self.hashing = False
+                    return
+
+            byte_block = os.pread(self.fd, min(CHUNK_SIZE, size), self.offset)
+            if not byte_block:
+                with self.lock:
+                    self.hashing = False
+                return
+            self.sha256_hash.update(byte_block)
+            self.offset += len(byte_block)
+
+    def _available(self):
+        """Return the number of bytes downloaded from the hashed offset on."""
+        for segment in self.segments:
+            start, position, end = segment[0], segment[1], segment[2]
+            if position <= self.offset:
+                if self.offset < end:
+                    return 0
+                continue
+
+            if start > self.offset:
+                return 0
+            return position - self.offset
+
+        return 0
+
+
+def _load_segments(dest_path, state_path, total_size, connections):
+    """
+    Return the [start, position, end] segments still to be downloaded.
+
+    Segments are restored from the state file of an interrupted segmented
+    download. A partial file left behind by a single stream download keeps
+    its prefix and only the remainder is split into segments.
+    """
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+        if state["size"] == total_size and os.path.getsize(dest_path) == total_size:
+            return state["segments"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    downloaded_size = 0
+    if os.path.exists(dest_path) and not os.path.exists(state_path):
+        downloaded_size = os.path.getsize(dest_path)
+        if downloaded_size > total_size:
+            downloaded_size = 0
+
+    segments = []
+    if downloaded_size:
+        segments.append([0, downloaded_size, downloaded_size])
+
+    segment_size = -(-(total_size - downloaded_size) // connections)
+    for start in range(downloaded_size, total_size, segment_size):
+        segments.append([start, start, min(start + segment_size, total_size)])
+
+    return segments
+
+
+def _save_segments(state_path, total_size, segments, lock):
+    with lock:
+        state = {"size": total_size, "segments": [list(segment) for segment in segments]}
+    tmp_path = state_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, state_path)
+
+
+def _download_segment(url, headers, fd, segment, progress_bar, lock, stop, hasher):
+    retries = 0
+    while segment[1] < segment[2] and not stop.is_set():
+        request = urllib.request.Request(url, headers=headers)
+        request.headers["Range"] = f"bytes={segment[1]}-{segment[2] - 1}"
+        try:
+            with download_scheduler, http_client.urlopen(request) as response:
+                if response.status != 206:
+                    raise ValueError(f"server ignored byte range request for {url}")
+
+                while segment[1] < segment[2] and not stop.is_set():
+                    chunk = response.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    download_scheduler.throttle(len(chunk))
+                    chunk = chunk[: segment[2] - segment[1]]
+                    offset = segment[1]
+                    os.pwrite(fd, chunk, offset)
+                    with lock:
+                        segment[1] += len(chunk)
+                        progress_bar.update(len(chunk))
+                    hasher.update(offset, chunk)
+                    retries = 0
+
+                if segment[1] < segment[2] and not stop.is_set():
+                    # The response ended before the segment, count it as a failed attempt
+                    raise http.client.IncompleteRead(b"", segment[2] - segment[1])
+        except urllib.error.HTTPError:
+            raise
+        except (urllib.error.URLError, http.client.HTTPException, ConnectionError, TimeoutError):
+            retries += 1
+            if retries > SEGMENT_RETRIES:
+                raise
+
+
+def _download_segmented(url, dest_path, headers, show_progress, connections, total_size, position, cancel):
+    state_path = segments_path(dest_path)
+    if not os.path.exists(state_path) and os.path.exists(dest_path) and os.path.getsize(dest_path) == total_size:
+        if show_progress:
+            print(f"File {url} already fully downloaded.")
+        return sha256sum(dest_path)
+
+    segments = _load_segments(dest_path, state_path, total_size, connections)
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    fd = os.open(dest_path, os.O_RDWR | os.O_CREAT, 0o644)
+    hasher = _SegmentHasher(fd, segments)
+    try:
+        # Preallocate the file so every segment can write at its offset
+        os.ftruncate(fd, total_size)
+        _save_segments(state_path, total_size, segments, lock)
+
+        initial = sum(segment[1] - segment[0] for segment in segments)
+        filename = os.path.basename(dest_path)
+        with _progress_bar(filename, total_size, initial, show_progress, position) as progress_bar:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=connections) as executor:
+                futures = [
+                    executor.submit(_download_segment, url, headers, fd, segment, progress_bar, lock, stop, hasher)
+                    for segment in segments
+                    if segment[1] < segment[2]
+                ]
+                try:
+                    pending = futures
+                    while pending:
+                        _, pending = concurrent.futures.wait(
+                            pending, timeout=1, return_when=concurrent.futures.FIRST_EXCEPTION
+                        )
+                        _save_segments(state_path, total_size, segments, lock)
+                        for future in futures:
+                            if future.done() and future.exception():
+                                raise future.exception()
+                        if cancel.is_set():
+                            raise InterruptedError(f"download of {url} cancelled")
+                except BaseException:
+                    stop.set()
+                    concurrent.futures.wait(futures)
+                    _save_segments(state_path, total_size, segments, lock)
+                    raise
+
+        digest = hasher.hexdigest()
+    finally:
+        os.close(fd)
+
+    os.remove(state_path)
+    return digest
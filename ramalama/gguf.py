@@ -0,0 +1,341 @@
+"""Reader of the metadata of GGUF Models."""
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+
+MAGIC = b"GGUF"
+
+# Arrays longer than this, like the vocabulary, are skipped rather than decoded
+MAX_ARRAY = 64
+
+# GGUF metadata value types: name, struct format
+value_types = {
+    0: ("uint8", "B"),
+    1: ("int8", "b"),
+    2: ("uint16", "H"),
+    3: ("int16", "h"),
+    4: ("uint32", "I"),
+    5: ("int32", "i"),
+    6: ("float32", "f"),
+    7: ("bool", "?"),
+    8: ("string", None),
+    9: ("array", None),
+    10: ("uint64", "Q"),
+    11: ("int64", "q"),
+    12: ("float64", "d"),
+}
+
+STRING = 8
+ARRAY = 9
+
+# ggml tensor types: name, elements per block, bytes per block
+tensor_types = {
+    0: ("F32", 1, 4),
+    1: ("F16", 1, 2),
+    2: ("Q4_0", 32, 18),
+    3: ("Q4_1", 32, 20),
+    6: ("Q5_0", 32, 22),
+    7: ("Q5_1", 32, 24),
+    8: ("Q8_0", 32, 34),
+    9: ("Q8_1", 32, 36),
+    10: ("Q2_K", 256, 84),
+    11: ("Q3_K", 256, 110),
+    12: ("Q4_K", 256, 144),
+    13: ("Q5_K", 256, 176),
+    14: ("Q6_K", 256, 210),
+    15: ("Q8_K", 256, 292),
+    16: ("IQ2_XXS", 256, 66),
+    17: ("IQ2_XS", 256, 74),
+    18: ("IQ3_XXS", 256, 98),
+    19: ("IQ1_S", 256, 50),
+    20: ("IQ4_NL", 32, 18),
+    21: ("IQ3_S", 256, 110),
+    22: ("IQ2_S", 256, 82),
+    23: ("IQ4_XS", 256, 136),
+    24: ("I8", 1, 1),
+    25: ("I16", 1, 2),
+    26: ("I32", 1, 4),
+    27: ("I64", 1, 8),
+    28: ("F64", 1, 8),
+    29: ("IQ1_M", 256, 56),
+    30: ("BF16", 1, 2),
+    34: ("TQ1_0", 256, 54),
+    35: ("TQ2_0", 256, 66),
+}
+
+# Values of general.file_type, the quantization of the Model as a whole
+file_types = {
+    0: "F32",
+    1: "F16",
+    2: "Q4_0",
+    3: "Q4_1",
+    7: "Q8_0",
+    8: "Q5_0",
+    9: "Q5_1",
+    10: "Q2_K",
+    11: "Q3_K_S",
+    12: "Q3_K_M",
+    13: "Q3_K_L",
+    14: "Q4_K_S",
+    15: "Q4_K_M",
+    16: "Q5_K_S",
+    17: "Q5_K_M",
+    18: "Q6_K",
+    19: "IQ2_XXS",
+    20: "IQ2_XS",
+    21: "Q2_K_S",
+    22: "IQ3_XS",
+    23: "IQ3_XXS",
+    24: "IQ1_S",
+    25: "IQ4_NL",
+    26: "IQ3_S",
+    27: "IQ3_M",
+    28: "IQ2_S",
+    29: "IQ2_M",
+    30: "IQ4_XS",
+    31: "IQ1_M",
+    32: "BF16",
+    36: "TQ1_0",
+    37: "TQ2_0",
+}
+
+
+class GGUF:
+    """
+    Metadata and tensor info table of a GGUF file.
+
+    The file is memory-mapped and only the header and the tensor info table
+    are parsed, so the pages holding the weights are never read.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.version = None
+        self.metadata = {}
+        self.tensors = []
+        self.data_offset = None
+        with open(path, "rb") as f:
+            try:
+                self._buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise ValueError(f"{path} is not a GGUF file")
+
+        try:
+            self._parse()
+        except struct.error:
+            raise ValueError(f"{path} is a truncated GGUF file")
+        finally:
+            self._buffer.close()
+
+    def _read(self, fmt):
+        values = struct.unpack_from(self._endian + fmt, self._buffer, self._offset)
+        self._offset += struct.calcsize(self._endian + fmt)
+        return values if len(values) > 1 else values[0]
+
+    def _string(self):
+        length = self._read("Q")
+        value = self._buffer[self._offset : self._offset + length]
+        if len(value) != length:
+            raise struct.error("string past the end of the file")
+        self._offset += length
+        return value.decode("utf-8", errors="replace")
+
+    def _value(self, value_type):
+        if value_type == STRING:
+            return self._string()
+        if value_type == ARRAY:
+            return self._array()
+        if value_type not in value_types:
+            raise ValueError(f"{self.path} has metadata of unknown type {value_type}")
+        return self._read(value_types[value_type][1])
+
+    def _array(self):
+        item_type, count = self._read("I"), self._read("Q")
+        if count <= MAX_ARRAY:
+            return [self._value(item_type) for _ in range(count)]
+
+        # Skip over the items, only keeping their type and count
+        if item_type == STRING:
+            for _ in range(count):
+                length = self._read("Q")
+                self._offset += length
+        elif item_type in value_types and value_types[item_type][1]:
+            self._offset += count * struct.calcsize(value_types[item_type][1])
+        else:
+            for _ in range(count):
+                self._value(item_type)
+        return {"type": value_types.get(item_type, ("unknown",))[0], "length": count}
+
+    def _parse(self):
+        self._offset = 0
+        if self._buffer[:4] != MAGIC:
+            raise ValueError(f"{self.path} is not a GGUF file")
+
+        # Big-endian files have a byte-swapped version
+        self._endian = "<"
+        self._offset = 4
+        self.version = self._read("I")
+        if self.version & 0xFFFF == 0:
+            self._endian = ">"
+            self.version = struct.unpack("<I", struct.pack(">I", self.version))[0]
+
+        if self.version == 1:
+            tensor_count, kv_count = self._read("II")
+        else:
+            tensor_count, kv_count = self._read("QQ")
+
+        for _ in range(kv_count):
+            key = self._string()
+            self.metadata[key] = self._value(self._read("I"))
+
+        for _ in range(tensor_count):
+            name = self._string()
+            n_dims = self._read("I")
+            shape = [self._read("Q") for _ in range(n_dims)]
+            tensor_type, offset = self._read("I"), self._read("Q")
+            self.tensors.append({"name": name, "shape": shape, "type": tensor_type, "offset": offset})
+
+        alignment = self.metadata.get("general.alignment", 32)
+        self.data_offset = self._offset + (-self._offset % alignment)
+
+    def get(self, key, default=None):
+        """Return the value of an architecture specific key, e.g. "context_length"."""
+        return self.metadata.get(f"{self.metadata.get('general.architecture')}.{key}", default)
+
+    def tensor_size(self, tensor):
+        """Return the bytes a tensor takes, or None for an unknown type."""
+        if tensor["type"] not in tensor_types:
+            return None
+
+        _, block_size, type_size = tensor_types[tensor["type"]]
+        elements = 1
+        for dim in tensor["shape"]:
+            elements *= dim
+        return elements // block_size * type_size
+
+    def quantization(self):
+        """Return the quantization of the Model, else the tensor type taking most space."""
+        file_type = self.metadata.get("general.file_type")
+        if file_type in file_types:
+            return file_types[file_type]
+
+        sizes = {}
+        for tensor in self.tensors:
+            name = tensor_types.get(tensor["type"], (str(tensor["type"]),))[0]
+            sizes[name] = sizes.get(name, 0) + (self.tensor_size(tensor) or 0)
+        return max(sizes, key=sizes.get) if sizes else None
+
+    def summary(self):
+        """Return the facts about the Model that matter to run it."""
+        parameters = 0
+        weights_size = 0
+        for tensor in self.tensors:
+            elements = 1
+            for dim in tensor["shape"]:
+                elements *= dim
+            parameters += elements
+            weights_size += self.tensor_size(tensor) or 0
+
+        tokens = self.metadata.get("tokenizer.ggml.tokens")
+        vocab_size = tokens["length"] if isinstance(tokens, dict) else len(tokens) if tokens else None
+        return {
+            "format": "gguf",
+            "version": self.version,
+            "architecture": self.metadata.get("general.architecture"),
+            "name": self.metadata.get("general.name"),
+            "parameters": parameters,
+            "quantization": self.quantization(),
+            "context_length": self.get("context_length"),
+            "embedding_length": self.get("embedding_length"),
+            "block_count": self.get("block_count"),
+            "head_count": self.get("attention.head_count"),
+            "head_count_kv": self.get("attention.head_count_kv"),
+            "key_length": self.get("attention.key_length"),
+            "value_length": self.get("attention.value_length"),
+            "vocab_size": vocab_size,
+            "tensor_count": len(self.tensors),
+            "weights_size": weights_size,
+        }
+
+    def to_dict(self):
+        tensors = []
+        for tensor in self.tensors:
+            tensors.append(
+                dict(
+                    tensor,
+                    type=tensor_types.get(tensor["type"], (str(tensor["type"]),))[0],
+                    size=self.tensor_size(tensor),
+                )
+            )
+
+        return {
+            "summary": self.summary(),
+            "metadata": self.metadata,
+            "data_offset": self.data_offset,
+            "tensors": tensors,
+        }
+
+
+def is_gguf(path):
+    try:
+        with open(path, "rb") as f:
+            return f.read(4) == MAGIC
+    except OSError:
+        return False
+
+
+def _cache_key(path):
+    # Blobs are named after their digest, other files are keyed by their inode
+    name = os.path.basename(path)
+    if name.startswith("sha256:") and len(name) == 71:
+        return name.replace(":", "-")
+
+    st = os.stat(path)
+    key = json.dumps([st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns])
+    return "file-" + hashlib.sha256(key.encode()).hexdigest()[:16]
+
+
+def summary(path, store=None):
+    """
+    Return the summary of the Model at path, or None when it is not a GGUF file.
+
+    With a store the summary is memoized in cache/gguf/ in the store, keyed
+    by the digest of the blob, so it is only parsed once per blob. Failed
+    parses are not memoized, the blob may be a partial or corrupt copy
+    replaced later under the same digest.
+    """
+    path = os.path.realpath(path)
+    cache_path = None
+    if store:
+        cache_path = os.path.join(store, "cache", "gguf", _cache_key(path) + ".json")
+        try:
+            with open(cache_path) as f:
+                info = json.load(f)
+            # Failed parses were memoized as null by earlier versions
+            if info is not None:
+                return info
+        except (OSError, ValueError):
+            pass
+
+    info = None
+    if is_gguf(path):
+        try:
+            info = GGUF(path).summary()
+        except ValueError:
+            pass
+
+    if cache_path and info is not None:
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            tmp_path = f"{cache_path}.{os.getpid()}"
+            with open(tmp_path, "w") as f:
+                json.dump(info, f)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            # A read-only store only costs parsing the file again
+            pass
+
+    return info
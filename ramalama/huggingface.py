@@ -1,6 +1,19 @@
 import os
-import urllib.request
-from ramalama.common import run_cmd, exec_cmd, download_file, verify_checksum
+from ramalama.capabilities import capabilities
+from ramalama.common import (
+    DEFAULT_CONNECTIONS,
+    blob_lock,
+    download_file,
+    exec_cmd,
+    fetch_metadata,
+    link_blob,
+    record_verified,
+    run_cmd,
+    store_blob,
+    symlink,
+    unshare_blob,
+    verify_checksum,
+)
 from ramalama.model import Model
 
 missing_huggingface = """
@@ -11,20 +24,23 @@ pip install huggingface_hub tqdm
 """
 
 
+def endpoint():
+    """Return the URL of the Hugging Face Hub, HF_ENDPOINT points huggingface-cli and RamaLama to a mirror."""
+    return os.getenv("HF_ENDPOINT", "https://huggingface.co").rstrip("/")
+
+
 def is_huggingface_cli_available():
     """Check if huggingface-cli is available on the system."""
-    try:
-        run_cmd(["huggingface-cli", "version"])
+    if capabilities.tool("huggingface-cli"):
         return True
-    except FileNotFoundError:
-        print("huggingface-cli not found. Some features may be limited.\n" + missing_huggingface)
-        return False
+
+    print("huggingface-cli not found. Some features may be limited.\n" + missing_huggingface)
+    return False
 
 
-def fetch_checksum_from_api(url):
+def fetch_checksum_from_api(url, store=None, policy="newer"):
     """Fetch the SHA-256 checksum from the model's metadata API."""
-    with urllib.request.urlopen(url) as response:
-        data = response.read().decode()
+    data = fetch_metadata(url, store=store, policy=policy)
     # Extract the SHA-256 checksum from the `oid sha256` line
     for line in data.splitlines():
         if line.startswith("oid sha256:"):
@@ -41,7 +57,10 @@ class Huggingface(Model):
         split = self.model.rsplit("/", 1)
         self.directory = split[0] if len(split) > 1 else ""
         self.filename = split[1] if len(split) > 1 else split[0]
-        self.hf_cli_available = is_huggingface_cli_available()
+
+    @property
+    def hf_cli_available(self):
+        return is_huggingface_cli_available()
 
     def login(self, args):
         if not self.hf_cli_available:
@@ -72,38 +91,59 @@ class Huggingface(Model):
         symlink_dir = os.path.dirname(symlink_path)
         os.makedirs(symlink_dir, exist_ok=True)
 
-        # Fetch the SHA-256 checksum from the API
-        checksum_api_url = f"https://huggingface.co/{self.directory}/raw/main/{self.filename}"
-        sha256_checksum = fetch_checksum_from_api(checksum_api_url)
+        policy = getattr(args, "pull", "missing")
+        if policy in ["never", "missing"] and os.path.exists(symlink_path):
+            target_path = os.path.realpath(symlink_path)
+            if verify_checksum(target_path, getattr(args, "verify", "cached"), args.store):
+                return symlink_path
 
-        target_path = os.path.join(directory_path, f"sha256:{sha256_checksum}")
+        if policy == "never":
+            raise KeyError(f"{self.model} is not available locally and --pull=never")
 
-        if os.path.exists(target_path) and verify_checksum(target_path):
-            relative_target_path = os.path.relpath(target_path, start=os.path.dirname(symlink_path))
-            if not self.check_valid_symlink_path(relative_target_path, symlink_path):
-                run_cmd(["ln", "-sf", relative_target_path, symlink_path], debug=args.debug)
-            return symlink_path
-
-        # Download the model file to the target path
-        url = f"https://huggingface.co/{self.directory}/resolve/main/{self.filename}"
-        download_file(url, target_path, headers={}, show_progress=True)
+        # Fetch the SHA-256 checksum from the API
+        checksum_api_url = f"{endpoint()}/{self.directory}/raw/main/{self.filename}"
+        sha256_checksum = fetch_checksum_from_api(checksum_api_url, args.store, policy)
 
-        if not verify_checksum(target_path):
-            print(f"Checksum mismatch for {target_path}, retrying download...")
-            os.remove(target_path)
-            download_file(url, target_path, headers={}, show_progress=True)
-            if not verify_checksum(target_path):
-                raise ValueError(f"Checksum verification failed for {target_path}")
+        target_path = os.path.join(directory_path, f"sha256:{sha256_checksum}")
+        with blob_lock(sha256_checksum):
+            self._pull_blob(target_path, sha256_checksum, args)
 
         relative_target_path = os.path.relpath(target_path, start=os.path.dirname(symlink_path))
         if self.check_valid_symlink_path(relative_target_path, symlink_path):
             # Symlink is already correct, no need to update it
             return symlink_path
 
-        run_cmd(["ln", "-sf", relative_target_path, symlink_path], debug=args.debug)
+        symlink(relative_target_path, symlink_path)
 
         return symlink_path
 
+    def _pull_blob(self, target_path, sha256_checksum, args):
+        verify = getattr(args, "verify", "cached")
+        if verify_checksum(target_path, verify, args.store) or (
+            link_blob(args.store, target_path) and verify_checksum(target_path, verify, args.store)
+        ):
+            # Linking changes the ctime the verification is recorded with, record it again
+            if store_blob(args.store, target_path) and verify != "never":
+                record_verified(target_path, args.store)
+            return
+
+        # Never download into a stored copy that failed verification
+        unshare_blob(args.store, target_path)
+        url = f"{endpoint()}/{self.directory}/resolve/main/{self.filename}"
+        connections = getattr(args, "connections", DEFAULT_CONNECTIONS)
+        digest = download_file(url, target_path, headers={}, show_progress=True, connections=connections)
+
+        if digest != sha256_checksum:
+            print(f"Checksum mismatch for {target_path}, retrying download...")
+            os.remove(target_path)
+            digest = download_file(url, target_path, headers={}, show_progress=True, connections=connections)
+            if digest != sha256_checksum:
+                raise ValueError(f"Checksum verification failed for {target_path}")
+
+        # Record the verification once every link is made, linking changes the ctime
+        store_blob(args.store, target_path)
+        record_verified(target_path, args.store)
+
     def push(self, source, args):
         if not self.hf_cli_available:
             print("huggingface-cli not available, skipping push.")
@@ -0,0 +1,287 @@
+"""Prometheus metrics of the Models served by ramalama serve."""
+
+import collections
+import http.client
+import http.server
+import json
+import threading
+
+# Upper bounds of the buckets of the request latency and time to first token histograms, in seconds
+latency_buckets = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]
+ttft_buckets = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+# Bytes at the end of a streamed response kept to read the timings of its last events from
+TAIL_SIZE = 65536
+
+
+def _labels(**labels):
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in labels.items()) + "}"
+
+
+def _value(value):
+    return f"{value:.6f}".rstrip("0").rstrip(".") if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, **labels):
+        for bound, count in zip(self.buckets, self.counts):
+            yield f"{name}_bucket{_labels(**labels, le=bound)} {count}"
+        yield f"{name}_bucket{_labels(**labels, le='+Inf')} {self.count}"
+        yield f"{name}_sum{_labels(**labels)} {_value(self.sum)}"
+        yield f"{name}_count{_labels(**labels)} {self.count}"
+
+
+def parse_timings(body, streamed):
+    """
+    Return the token counts and timings a server reports in a response.
+
+    llama-server adds its timings to the response, and to the last event of
+    a streamed one, OpenAI compatible servers only the usage. Returns {}
+    when the response reports neither.
+    """
+    if streamed:
+        events = [line[5:].strip() for line in bytes(body).split(b"\n") if line.startswith(b"data:")]
+    else:
+        events = [bytes(body)]
+
+    for event in reversed(events):
+        try:
+            data = json.loads(event)
+        except ValueError:
+            continue
+        if not isinstance(data, dict):
+            continue
+        usage = data.get("usage") or {}
+        timings = data.get("timings") or {}
+        if not usage and not timings:
+            continue
+
+        result = {
+            "prompt_tokens": timings.get("prompt_n", usage.get("prompt_tokens")),
+            "generated_tokens": timings.get("predicted_n", usage.get("completion_tokens")),
+        }
+        if timings.get("prompt_ms") is not None:
+            result["prompt_seconds"] = timings["prompt_ms"] / 1000
+        if timings.get("predicted_ms") is not None:
+            result["generation_seconds"] = timings["predicted_ms"] / 1000
+        return {key: value for key, value in result.items() if value is not None}
+
+    return {}
+
+
+def rss(pid):
+    """Return the resident memory of process pid in bytes, None when it is gone."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def slots(backend, timeout=1):
+    """Return the number of busy and total slots of a llama-server, None when it does not report them."""
+    try:
+        conn = backend.connection(timeout)
+        try:
+            conn.request("GET", "/slots")
+            response = conn.getresponse()
+            data = json.loads(response.read())
+        finally:
+            conn.close()
+    except (OSError, ValueError, http.client.HTTPException):
+        return None
+    if response.status != 200 or not isinstance(data, list):
+        return None
+
+    # Older llama-server releases report a state, 1 when processing
+    busy = sum(1 for slot in data if slot.get("is_processing", slot.get("state")))
+    return busy, len(data)
+
+
+class Metrics:
+    """
+    Metrics of the requests the proxy serves, rendered in the Prometheus
+    text format together with the state of the servers at scrape time.
+    """
+
+    def __init__(self, port):
+        self.port = port
+        self.lock = threading.Lock()
+        self.requests = collections.Counter()
+        self.latency = collections.defaultdict(lambda: Histogram(latency_buckets))
+        self.ttft = collections.defaultdict(lambda: Histogram(ttft_buckets))
+        self.totals = collections.defaultdict(collections.Counter)
+        self.rates = collections.defaultdict(dict)
+        self.waiting = collections.Counter()
+
+    def wait(self, model, delta):
+        """Count a request waiting for a server of model to be available, or no longer waiting."""
+        with self.lock:
+            self.waiting[model] += delta
+
+    def observe(self, model, code, duration, ttft=None, timings=None):
+        timings = timings or {}
+        with self.lock:
+            self.requests[model, code] += 1
+            self.latency[model].observe(duration)
+            if ttft is None and "generation_seconds" in timings:
+                # Without a stream the first token is not seen, generation started once the prompt was processed
+                ttft = max(duration - timings["generation_seconds"], 0)
+            if ttft is not None:
+                self.ttft[model].observe(ttft)
+
+            for key in ["prompt_tokens", "generated_tokens", "prompt_seconds", "generation_seconds"]:
+                self.totals[model][key] += timings.get(key, 0)
+            for tokens, seconds, rate in [
+                ("prompt_tokens", "prompt_seconds", "prompt"),
+                ("generated_tokens", "generation_seconds", "generation"),
+            ]:
+                if timings.get(tokens) and timings.get(seconds):
+                    self.rates[model][rate] = timings[tokens] / timings[seconds]
+
+    def render(self, router, cache=None):
+        """Return the metrics in the Prometheus text format."""
+        metrics = []
+        with self.lock:
+            requests = sorted(self.requests.items())
+            metrics.append(
+                (
+                    "ramalama_requests_total",
+                    "counter",
+                    "Requests served, by Model and HTTP status.",
+                    [f"ramalama_requests_total{_labels(model=m, code=c)} {n}" for (m, c), n in requests],
+                )
+            )
+            for name, histograms, help in [
+                (
+                    "ramalama_request_duration_seconds",
+                    self.latency,
+                    "Time from receiving a request to sending the end of its response.",
+                ),
+                (
+                    "ramalama_time_to_first_token_seconds",
+                    self.ttft,
+                    "Time from receiving a request to its first token.",
+                ),
+            ]:
+                samples = [sample for m, h in sorted(histograms.items()) for sample in h.samples(name, model=m)]
+                metrics.append((name, "histogram", help, samples))
+            for key, help in [
+                ("prompt_tokens", "Prompt tokens processed."),
+                ("generated_tokens", "Tokens generated."),
+                ("prompt_seconds", "Time spent processing prompts."),
+                ("generation_seconds", "Time spent generating tokens."),
+            ]:
+                name = f"ramalama_{key}_total"
+                samples = [f"{name}{_labels(model=m)} {_value(t[key])}" for m, t in sorted(self.totals.items())]
+                metrics.append((name, "counter", help, samples))
+            for rate, help in [
+                ("prompt", "Prompt tokens processed per second by the last request."),
+                ("generation", "Tokens generated per second by the last request."),
+            ]:
+                name = f"ramalama_{rate}_tokens_per_second"
+                rates = sorted(self.rates.items())
+                samples = [f"{name}{_labels(model=m)} {_value(r[rate])}" for m, r in rates if rate in r]
+                metrics.append((name, "gauge", help, samples))
+            waiting = dict(self.waiting)
+
+        with router.cond:
+            models = [(m.name, m.outstanding) for m in router.models]
+            servers = [
+                (m.name, i, b, b.process, b.outstanding)
+                for m in router.models
+                for i, b in enumerate(m.backends)
+                if b.state == "running" and b.process is not None
+            ]
+
+        # The servers are asked for their slots outside of the lock, it must not hold up requests
+        depth = collections.Counter(waiting)
+        busy, total, memory = [], [], []
+        for model, replica, backend, process, outstanding in servers:
+            labels = _labels(model=model, replica=replica)
+            used = slots(backend)
+            if used:
+                busy.append(f"ramalama_slots_busy{labels} {used[0]}")
+                total.append(f"ramalama_slots{labels} {used[1]}")
+                # Requests sent to the server beyond its busy slots wait in its own queue
+                depth[model] += max(outstanding - used[0], 0)
+            resident = rss(process.pid)
+            if resident is not None:
+                memory.append(f"ramalama_server_resident_memory_bytes{labels} {resident}")
+
+        for name, help, samples in [
+            (
+                "ramalama_queue_depth",
+                "Requests waiting for a server or a slot of it.",
+                [f"ramalama_queue_depth{_labels(model=m)} {depth[m]}" for m, _ in models],
+            ),
+            (
+                "ramalama_requests_running",
+                "Requests sent to the servers of a Model.",
+                [f"ramalama_requests_running{_labels(model=m)} {n}" for m, n in models],
+            ),
+            ("ramalama_slots_busy", "Slots of a server processing a request.", busy),
+            ("ramalama_slots", "Slots of a server.", total),
+            ("ramalama_server_resident_memory_bytes", "Resident memory of a server process.", memory),
+        ]:
+            metrics.append((name, "gauge", help, samples))
+
+        if cache:
+            stats = cache.stats()
+            for name, kind, help, value in [
+                ("ramalama_cache_hits_total", "counter", "Requests answered from the cache.", stats["hits"]),
+                ("ramalama_cache_misses_total", "counter", "Cacheable requests forwarded.", stats["misses"]),
+                ("ramalama_cache_size_bytes", "gauge", "Memory taken by the cached responses.", stats["size"]),
+            ]:
+                metrics.append((name, kind, help, [f"{name} {value}"]))
+
+        lines = []
+        for name, kind, help, samples in metrics:
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}"] + samples
+        return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        body = self.server.collect().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MetricsServer(http.server.ThreadingHTTPServer):
+    """Server of GET /metrics, collect returns the metrics to send."""
+
+    daemon_threads = True
+
+    def __init__(self, address, collect):
+        super().__init__(address, MetricsHandler)
+        self.collect = collect
@@ -1,6 +1,23 @@
+import copy
 import os
 import sys
-from ramalama.common import exec_cmd, default_image, in_container, genname
+import time
+from ramalama.common import (
+    default_image,
+    dry_run,
+    exec_cmd,
+    genname,
+    human_readable_size,
+    in_container,
+    perror,
+    remove_blob,
+    segments_path,
+)
+from ramalama.batch import Batch
+from ramalama.proxy import Backend, Replicas
+from ramalama.store import add_model, remove_model, used_blobs
+from ramalama.preload import readahead
+from ramalama.tune import available_memory, spread, static, tune
 from ramalama.version import version
 
 
@@ -18,17 +35,96 @@ with the default RamaLama image.
 """
 
 
+def garbage_collection(store, dry_run=False):
+    """
+    Remove the blobs in the store that no Model uses.
+
+    Mark: resolve every Model symlink once and mark the file it points to,
+    and the other blobs the index records for the Models.
+    Sweep: walk the transport blobs once and remove every blob whose inode
+    is not marked, so hardlinked copies of a used blob are kept. Then walk
+    the content-addressed area and remove every copy whose digest no kept
+    blob has. Copies are compared by digest as a reflinked copy does not
+    share the inode of the blob it copies.
+
+    Returns:
+    int: the number of bytes reclaimed, or reclaimable with dry_run.
+    """
+    repo_paths = ["huggingface", "oci", "ollama"]
+    marked = set()
+    for repo in repo_paths:
+        for root, dirs, files in os.walk(f"{store}/models/{repo}"):
+            for file in files + dirs:
+                path = os.path.join(root, file)
+                if os.path.islink(path) and os.path.exists(path):
+                    st = os.stat(path)
+                    marked.add((st.st_dev, st.st_ino))
+
+    digests = set()
+    for path, digest in used_blobs(store):
+        if os.path.exists(path):
+            st = os.stat(path)
+            marked.add((st.st_dev, st.st_ino))
+            if digest:
+                digests.add(digest)
+
+    unused = []
+    for repo in repo_paths:
+        for root, dirs, files in os.walk(f"{store}/repos/{repo}"):
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            for file in files:
+                if file.startswith(".") or not (file.startswith("sha256:") or file.endswith(".gguf")):
+                    continue
+
+                path = os.path.join(root, file)
+                st = os.lstat(path)
+                if (st.st_dev, st.st_ino) not in marked:
+                    unused.append((path, st))
+                elif file.startswith("sha256:"):
+                    digests.add(file)
+
+    for root, dirs, files in os.walk(f"{store}/blobs/sha256"):
+        dirs[:] = []
+        for file in files:
+            path = os.path.join(root, file)
+            if not file.startswith(".") and f"sha256:{file}" not in digests:
+                unused.append((path, os.lstat(path)))
+
+    # Space is only reclaimed once every link to a file is removed
+    links = {}
+    for path, st in unused:
+        links[(st.st_dev, st.st_ino)] = links.get((st.st_dev, st.st_ino), 0) + 1
+
+    reclaimed = 0
+    for path, st in unused:
+        name = os.path.basename(path)
+        if not name.startswith("sha256:") and not name.endswith(".gguf"):
+            name = "sha256:" + name
+
+        if dry_run:
+            print(f"Would delete: {name}")
+        else:
+            os.remove(path)
+            state_path = segments_path(path)
+            if os.path.exists(state_path):
+                os.remove(state_path)
+            print(f"Deleted: {name}")
+
+        if links[(st.st_dev, st.st_ino)] == st.st_nlink:
+            reclaimed += st.st_size
+            links[(st.st_dev, st.st_ino)] = 0
+
+    return reclaimed
+
+
 class Model:
     """Model super class"""
 
     model = ""
     type = "Model"
-    common_params = ["-c", "2048"]
 
     def __init__(self, model):
         self.model = model
-        if sys.platform == "darwin" or os.getenv("HIP_VISIBLE_DEVICES") or os.getenv("CUDA_VISIBLE_DEVICES"):
-            self.common_params += ["-ngl", "99"]
 
     def login(self, args):
         raise NotImplementedError(f"ramalama login for {self.type} not implemented")
@@ -45,35 +141,8 @@ class Model:
     def push(self, source, args):
         raise NotImplementedError(f"ramalama push for {self.type} not implemented")
 
-    def is_symlink_to(self, file_path, target_path):
-        if os.path.islink(file_path):
-            symlink_target = os.readlink(file_path)
-            abs_symlink_target = os.path.abspath(os.path.join(os.path.dirname(file_path), symlink_target))
-            abs_target_path = os.path.abspath(target_path)
-            return abs_symlink_target == abs_target_path
-
-        return False
-
     def garbage_collection(self, args):
-        repo_paths = ["huggingface", "oci", "ollama"]
-        for repo in repo_paths:
-            repo_dir = f"{args.store}/repos/{repo}"
-            model_dir = f"{args.store}/models/{repo}"
-            for root, dirs, files in os.walk(repo_dir):
-                file_has_a_symlink = False
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    if file.startswith("sha256:") or file.endswith(".gguf"):
-                        file_path = os.path.join(root, file)
-                        for model_root, model_dirs, model_files in os.walk(model_dir):
-                            for model_file in model_files:
-                                if self.is_symlink_to(os.path.join(root, model_root, model_file), file_path):
-                                    file_has_a_symlink = True
-
-                        if not file_has_a_symlink:
-                            os.remove(file_path)
-                            file_path = os.path.basename(file_path)
-                            print(f"Deleted: {file_path}")
+        return garbage_collection(args.store, getattr(args, "dry_run", False))
 
     def remove(self, args):
         symlink_path = self.symlink_path(args)
@@ -88,12 +157,68 @@ class Model:
             if not args.ignore:
                 raise KeyError(f"model {self.model} not found")
 
-        self.garbage_collection(args)
+        # Remove the blobs of the model no other model uses
+        for blob, digest in remove_model(args.store, symlink_path):
+            remove_blob(args.store, blob, digest)
 
     def symlink_path(self, args):
         raise NotImplementedError(f"symlink_path for {self.type} not implemented")
 
+    def _model_path(self, args):
+        """Return the path of the Model, pulling it unless this is a dry run."""
+        if not args.dryrun:
+            symlink_path = self.pull(args)
+            add_model(args.store, symlink_path, used=True)
+            return symlink_path
+
+        try:
+            return self.symlink_path(args)
+        except (OSError, KeyError):
+            return self.model
+
+    def common_params(self, args, model_path):
+        """Return the llama.cpp parameters for the Model, tuned to the host unless --tune=none."""
+        return self._tuning(args, model_path).params()
+
+    def _tuning(self, args, model_path, replicas=1, slots=1):
+        if getattr(args, "tune", "auto") == "none":
+            tuning = static(slots)
+        else:
+            tuning = tune(model_path, args.store, replicas, slots)
+
+        if getattr(args, "preload", None) == "mlock":
+            tuning.mlock = True
+        if args.debug:
+            perror(f"{tuning}")
+
+        plan = tuning.plan
+        if plan and (args.debug or not plan.fits):
+            perror("\n".join(plan.report()))
+        if plan and not plan.fits and not args.dryrun:
+            raise KeyError(
+                f"{self.model} needs {human_readable_size(plan.required)} of memory with a {plan.ctx} token context, "
+                f"{human_readable_size(plan.available)} is available, use --tune=none to run it anyway"
+            )
+        return tuning
+
+    def _exec(self, exec_args, args, stderr=True):
+        if args.dryrun:
+            return dry_run(exec_args)
+
+        try:
+            exec_cmd(exec_args, stderr, debug=args.debug)
+        except FileNotFoundError as e:
+            self._not_found(exec_args, e)
+
+    def _not_found(self, exec_args, e):
+        if in_container():
+            raise NotImplementedError(file_not_found_in_container % (exec_args[0], str(e).strip("'")))
+        raise NotImplementedError(file_not_found % (exec_args[0], exec_args[0], exec_args[0], str(e).strip("'")))
+
     def run(self, args):
+        if getattr(args, "batch", None):
+            return self.batch(args)
+
         prompt = "You are a helpful assistant"
         if args.ARGS:
             prompt = " ".join(args.ARGS)
@@ -104,7 +229,7 @@ class Model:
             input = sys.stdin.read()
             prompt = input + "\n\n" + prompt
 
-        symlink_path = self.pull(args)
+        symlink_path = self._model_path(args)
         exec_args = [
             "llama-cli",
             "-m",
@@ -116,35 +241,125 @@ class Model:
             "--no-display-prompt",
             "-p",
             prompt,
-        ] + self.common_params
+        ] + self.common_params(args, symlink_path)
         if not args.ARGS and sys.stdin.isatty():
             exec_args.append("-cnv")
 
+        self._exec(exec_args, args, stderr=False)
+
+    def batch(self, args):
+        """
+        Run the prompts of the --batch file through a server of the Model.
+
+        The Model is loaded once, by a llama-server processing --parallel
+        prompts at once, each slot with the context a single prompt gets.
+        """
+        symlink_path = self._model_path(args)
+        tuning = self._tuning(args, symlink_path, slots=args.parallel) if args.runtime != "vllm" else None
+
+        def command(port):
+            exec_args = self.server_args(args, symlink_path, port, host="127.0.0.1", tuning=tuning)
+            # vLLM batches concurrent requests on its own
+            if args.runtime != "vllm":
+                exec_args += ["--parallel", str(args.parallel)]
+            return exec_args
+
+        if args.dryrun:
+            return dry_run(command("<port>"))
+
+        backend = Backend(self.model, command, debug=args.debug)
         try:
-            exec_cmd(exec_args, False, debug=args.debug)
-        except FileNotFoundError as e:
-            if in_container():
-                raise NotImplementedError(file_not_found_in_container % (exec_args[0], str(e).strip("'")))
-            raise NotImplementedError(file_not_found % (exec_args[0], exec_args[0], exec_args[0], str(e).strip("'")))
+            try:
+                backend.start()
+            except FileNotFoundError as e:
+                self._not_found(command("<port>"), e)
+            backend.wait_ready()
+            Batch(backend, args.parallel).run(args.batch, args.output)
+        except OSError as e:
+            raise KeyError(f"running {self.model} failed: {e}")
+        finally:
+            backend.stop()
 
     def serve(self, args):
-        symlink_path = self.pull(args)
-        exec_args = ["llama-server", "--port", args.port, "-m", "/run/model"]
-        if args.runtime == "vllm":
-            exec_args = ["vllm", "serve", "--port", args.port, "/run/model"]
+        symlink_path = self._model_path(args)
+        if args.generate:
+            # Generated services mount the Model at /run/model and run
+            # wherever they are deployed, so they are not tuned to this host
+            exec_args = ["llama-server", "--port", args.port, "-m", "/run/model"]
+            if args.runtime == "vllm":
+                exec_args = ["vllm", "serve", "--port", args.port, "/run/model"]
 
-        if args.generate == "quadlet":
-            return self.quadlet(symlink_path, args, exec_args)
+            if args.generate == "quadlet":
+                return self.quadlet(symlink_path, args, exec_args)
 
-        if args.generate == "kube":
             return self.kube(symlink_path, args, exec_args)
 
-        try:
-            exec_cmd(exec_args, debug=args.debug)
-        except FileNotFoundError as e:
-            if in_container():
-                raise NotImplementedError(file_not_found_in_container % (exec_args[0], str(e).strip("'")))
-            raise NotImplementedError(file_not_found % (exec_args[0], exec_args[0], exec_args[0], str(e).strip("'")))
+        exec_args = self.server_args(args, symlink_path, args.port)
+        self._preload(args, symlink_path)
+        self._exec(exec_args, args)
+
+    def _preload(self, args, model_path):
+        """Read the Model into the page cache before serving it, unless --preload=none."""
+        if args.dryrun or getattr(args, "preload", "none") == "none" or not os.path.isfile(model_path):
+            return
+
+        size = os.path.getsize(model_path)
+        available = available_memory()
+        if available and size > available:
+            # The start of the file would be evicted by its end
+            if args.debug:
+                perror(f"not preloading {self.model}, {human_readable_size(size)} does not fit in the page cache")
+            return
+
+        start = time.monotonic()
+        readahead(model_path)
+        if args.debug:
+            perror(f"preloaded {human_readable_size(size)} of {self.model} in {time.monotonic() - start:.1f}s")
+
+    def server_args(self, args, model_path, port, host=None, tuning=None):
+        """Return the command line serving the Model at model_path on port."""
+        host_args = ["--host", host] if host else []
+        if args.runtime == "vllm":
+            return ["vllm", "serve"] + host_args + ["--port", str(port), model_path]
+
+        tuning = tuning or self._tuning(args, model_path)
+        return ["llama-server"] + host_args + ["--port", str(port), "-m", model_path] + tuning.params()
+
+    def replicas(self, args, names):
+        """
+        Return the proxy servers of the Model requested by names, --replicas of them.
+
+        The Model is pulled and tuned now, so a missing Model fails before
+        anything is served, and the memory the servers take is known. The
+        replicas memory-map the same file, sharing the page cache holding
+        the weights, and are pinned to their own cores, see tune.spread.
+        """
+        count = getattr(args, "replicas", 1)
+        symlink_path = self._model_path(args)
+        tuning = self._tuning(args, symlink_path, count) if args.runtime != "vllm" else None
+        memory = 0
+        if tuning and tuning.plan:
+            memory = tuning.plan.required
+        elif os.path.exists(symlink_path):
+            memory = os.path.getsize(symlink_path)
+
+        placements = spread(count) if tuning and count > 1 else None
+        backends = []
+        for cpus, cores in placements or [(None, None)] * count:
+            replica_tuning = tuning
+            if cores:
+                replica_tuning = copy.copy(tuning)
+                replica_tuning.threads = replica_tuning.threads_batch = min(cores, tuning.threads or cores)
+
+            def command(port, tuning=replica_tuning):
+                return self.server_args(args, symlink_path, port, host="127.0.0.1", tuning=tuning)
+
+            backends.append(Backend(names[0], command, cpus, debug=args.debug))
+
+        def preload():
+            self._preload(args, symlink_path)
+
+        return Replicas(names, backends, symlink_path, memory, preload, getattr(args, "warmup", None))
 
     def quadlet(self, model, args, exec_args):
         port_string = ""
@@ -3,8 +3,10 @@ import subprocess
 import sys
 import tempfile
 
+from ramalama.capabilities import capabilities
 from ramalama.model import Model
-from ramalama.common import run_cmd, exec_cmd, perror, available
+from ramalama.common import run_cmd, exec_cmd, perror, sha256sum, store_blob, symlink
+from ramalama.store import add_blobs
 
 prefix = "oci://"
 
@@ -14,7 +16,7 @@ class OCI(Model):
         super().__init__(model.removeprefix(prefix).removeprefix("docker://"))
         self.type = "OCI"
         self.conman = conman
-        if available("omlmd"):
+        if capabilities.tool("omlmd"):
             self.omlmd = "omlmd"
         else:
             for i in sys.path:
@@ -124,6 +126,14 @@ LABEL org.ramalama.type=ai.model
             reference = self.model
 
         reference_dir = reference.replace(":", "/")
+        policy = getattr(args, "pull", "missing")
+        if policy in ["never", "missing"]:
+            try:
+                return self.symlink_path(args)
+            except (OSError, KeyError, ValueError):
+                if policy == "never":
+                    raise KeyError(f"{self.model} is not available locally and --pull=never")
+
         outdir = f"{args.store}/repos/oci/{registry}/{reference_dir}"
         print(f"Downloading {self.model}...")
         # note: in the current way RamaLama is designed, cannot do Helper(OMLMDRegistry()).pull(target, outdir)
@@ -133,15 +143,22 @@ LABEL org.ramalama.type=ai.model
         if len(ggufs) != 1:
             raise KeyError(f"unable to identify .gguf file in: {outdir}")
 
+        # Keep a single copy of a model also pulled through another transport
+        gguf_path = f"{outdir}/{ggufs[0]}"
+        digest = "sha256:" + sha256sum(gguf_path)
+        store_blob(args.store, gguf_path, digest)
+
         directory = f"{args.store}/models/oci/{registry}/{reference_dir}"
         os.makedirs(directory, exist_ok=True)
         symlink_path = f"{directory}/{ggufs[0]}"
+        # The name of the gguf file is not its digest, record it for its content-addressed copy
+        add_blobs(args.store, symlink_path, [(gguf_path, digest)])
         relative_target_path = os.path.relpath(f"{outdir}/{ggufs[0]}", start=os.path.dirname(symlink_path))
         if os.path.exists(symlink_path) and os.readlink(symlink_path) == relative_target_path:
             # Symlink is already correct, no need to update it
             return symlink_path
 
-        run_cmd(["ln", "-sf", relative_target_path, symlink_path])
+        symlink(relative_target_path, symlink_path)
 
         return symlink_path
 
@@ -1,59 +1,118 @@
+import concurrent.futures
 import os
+import threading
 import urllib.request
 import json
-from ramalama.common import run_cmd, verify_checksum, download_file
+from ramalama.common import (
+    DEFAULT_CONNECTIONS,
+    blob_lock,
+    download_file,
+    fetch_metadata,
+    link_blob,
+    record_verified,
+    store_blob,
+    symlink,
+    unshare_blob,
+    verify_checksum,
+)
 from ramalama.model import Model
+from ramalama.store import add_blobs
 
+# Maximum number of blobs of a manifest pulled concurrently
+LAYER_WORKERS = 4
 
-def fetch_manifest_data(registry_head, model_tag, accept):
+
+def fetch_manifest_data(registry_head, model_tag, accept, store=None, policy="newer"):
     url = f"{registry_head}/manifests/{model_tag}"
     headers = {"Accept": accept}
 
-    request = urllib.request.Request(url, headers=headers)
-    with urllib.request.urlopen(request) as response:
-        manifest_data = json.load(response)
-    return manifest_data
+    return json.loads(fetch_metadata(url, headers=headers, store=store, policy=policy))
 
 
-def pull_config_blob(repos, accept, registry_head, manifest_data):
-    cfg_hash = manifest_data["config"]["digest"]
-    config_blob_path = os.path.join(repos, "blobs", cfg_hash)
+def pull_blob(repos, digest, accept, registry_head, args, show_progress=True, position=None, cancel=None):
+    """
+    Download the blob with the given digest unless a verified copy exists, return its path.
 
-    os.makedirs(os.path.dirname(config_blob_path), exist_ok=True)
+    Setting the optional cancel event stops the download.
+    """
+    with blob_lock(digest):
+        return _pull_blob(repos, digest, accept, registry_head, args, show_progress, position, cancel)
 
-    url = f"{registry_head}/blobs/{cfg_hash}"
-    headers = {"Accept": accept}
-    download_file(url, config_blob_path, headers=headers, show_progress=False)
 
+def _pull_blob(repos, digest, accept, registry_head, args, show_progress, position, cancel):
+    blob_path = os.path.join(repos, "blobs", digest)
+    verify = getattr(args, "verify", "cached")
+    if verify_checksum(blob_path, verify, args.store) or (
+        link_blob(args.store, blob_path) and verify_checksum(blob_path, verify, args.store)
+    ):
+        # Linking changes the ctime the verification is recorded with, record it again
+        if store_blob(args.store, blob_path) and verify != "never":
+            record_verified(blob_path, args.store)
+        return blob_path
 
-def pull_blob(repos, layer_digest, accept, registry_head, models, model_name, model_tag, symlink_path):
-    layer_blob_path = os.path.join(repos, "blobs", layer_digest)
-    url = f"{registry_head}/blobs/{layer_digest}"
+    # Never download into a stored copy that failed verification
+    unshare_blob(args.store, blob_path)
+    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+    url = f"{registry_head}/blobs/{digest}"
     headers = {"Accept": accept}
-    download_file(url, layer_blob_path, headers=headers, show_progress=True)
-
-    # Verify checksum after downloading the blob
-    if not verify_checksum(layer_blob_path):
-        print(f"Checksum mismatch for blob {layer_blob_path}, retrying download...")
-        os.remove(layer_blob_path)
-        download_file(url, layer_blob_path, headers=headers, show_progress=True)
-        if not verify_checksum(layer_blob_path):
-            raise ValueError(f"Checksum verification failed for blob {layer_blob_path}")
+    connections = getattr(args, "connections", DEFAULT_CONNECTIONS)
+    blob_digest = "sha256:" + download_file(url, blob_path, headers, show_progress, connections, position, cancel)
+
+    # Verify the checksum computed while downloading the blob
+    if blob_digest != digest:
+        print(f"Checksum mismatch for blob {blob_path}, retrying download...")
+        os.remove(blob_path)
+        blob_digest = "sha256:" + download_file(url, blob_path, headers, show_progress, connections, position, cancel)
+        if blob_digest != digest:
+            raise ValueError(f"Checksum verification failed for blob {blob_path}")
+
+    # Record the verification once every link is made, linking changes the ctime
+    store_blob(args.store, blob_path)
+    record_verified(blob_path, args.store)
+    return blob_path
+
+
+def init_pull(repos, accept, registry_head, model_name, model_tag, models, symlink_path, model, args):
+    policy = getattr(args, "pull", "missing")
+    manifest_data = fetch_manifest_data(registry_head, model_tag, accept, args.store, policy)
+    model_digest = None
+    for layer in manifest_data["layers"]:
+        if layer["mediaType"] == "application/vnd.ollama.image.model":
+            model_digest = layer["digest"]
+    if not model_digest:
+        raise KeyError(f"{model} does not contain a model layer")
+
+    # Pull the config and every layer concurrently, each with its own
+    # progress bar, so the pull takes as long as the largest blob.
+    cancel = threading.Event()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=LAYER_WORKERS) as executor:
+        config_digest = manifest_data["config"]["digest"]
+        futures = [executor.submit(pull_blob, repos, config_digest, accept, registry_head, args, False, None, cancel)]
+        for i, layer in enumerate(manifest_data["layers"]):
+            futures.append(
+                executor.submit(pull_blob, repos, layer["digest"], accept, registry_head, args, True, i, cancel)
+            )
 
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+        except BaseException:
+            # Stop the downloads in flight, leaving them resumable, so
+            # leaving the executor does not wait for them to complete
+            cancel.set()
+            for future in futures:
+                future.cancel()
+            raise
+
+    # Publish the model only once every blob is verified
     os.makedirs(models, exist_ok=True)
-    relative_target_path = os.path.relpath(layer_blob_path, start=os.path.dirname(symlink_path))
-    run_cmd(["ln", "-sf", relative_target_path, symlink_path])
+    model_blob_path = os.path.join(repos, "blobs", model_digest)
+    relative_target_path = os.path.relpath(model_blob_path, start=os.path.dirname(symlink_path))
+    symlink(relative_target_path, symlink_path)
 
-
-def init_pull(repos, accept, registry_head, model_name, model_tag, models, symlink_path, model):
-    manifest_data = fetch_manifest_data(registry_head, model_tag, accept)
-    pull_config_blob(repos, accept, registry_head, manifest_data)
-    for layer in manifest_data["layers"]:
-        layer_digest = layer["digest"]
-        if layer["mediaType"] != "application/vnd.ollama.image.model":
-            continue
-
-        pull_blob(repos, layer_digest, accept, registry_head, models, model_name, model_tag, symlink_path)
+    # Record the config, template, params and other layers so they are removed with the model
+    digests = [config_digest] + [layer["digest"] for layer in manifest_data["layers"]]
+    add_blobs(args.store, symlink_path, [(os.path.join(repos, "blobs", digest), digest) for digest in digests])
 
     return symlink_path
 
@@ -91,14 +150,21 @@ class Ollama(Model):
     def pull(self, args):
         repos = args.store + "/repos/ollama"
         symlink_path, models, model_base, model_name, model_tag = self._local(args)
-        if os.path.exists(symlink_path):
-            return symlink_path
+        policy = getattr(args, "pull", "missing")
+        if policy in ["never", "missing"] and os.path.exists(symlink_path):
+            if verify_checksum(os.path.realpath(symlink_path), getattr(args, "verify", "cached"), args.store):
+                return symlink_path
+
+        if policy == "never":
+            raise KeyError(f"{self.model} is not available locally and --pull=never")
 
-        registry = "https://registry.ollama.ai"
+        registry = os.getenv("RAMALAMA_OLLAMA_REGISTRY", "https://registry.ollama.ai").rstrip("/")
         accept = "Accept: application/vnd.docker.distribution.manifest.v2+json"
         registry_head = f"{registry}/v2/{model_name}"
         try:
-            return init_pull(repos, accept, registry_head, model_name, model_tag, models, symlink_path, self.model)
+            return init_pull(
+                repos, accept, registry_head, model_name, model_tag, models, symlink_path, self.model, args
+            )
         except urllib.error.HTTPError as e:
             raise KeyError(f"failed to pull {registry_head}: " + str(e).strip("'"))
 
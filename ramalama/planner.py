@@ -0,0 +1,106 @@
+"""Memory-fit planner, sizing the context and KV cache of a Model to the available memory."""
+
+from ramalama.common import human_readable_size
+
+# Bytes per element of the KV cache types llama.cpp supports, best first
+cache_types = {"f16": 2, "q8_0": 34 / 32, "q4_0": 18 / 32}
+
+# Smallest context worth running a Model with
+MIN_CTX = 512
+
+# Share of the available memory the Model may take, the rest is left to the system
+MEMORY_SHARE = 0.9
+
+# Memory llama.cpp takes besides the weights, the KV cache and the compute buffers
+OVERHEAD = 128 * 1024 * 1024
+
+
+def kv_cache_size(summary, ctx, cache_type="f16"):
+    """Return the bytes of the KV cache of ctx tokens, or None when the metadata lacks the shape."""
+    layers = summary.get("block_count")
+    heads = summary.get("head_count")
+    heads_kv = summary.get("head_count_kv") or heads
+    embedding = summary.get("embedding_length")
+    if not layers or not heads or not heads_kv:
+        return None
+
+    # Some architectures have a different number of KV heads per layer
+    if isinstance(heads_kv, list):
+        total_heads_kv = sum(heads_kv)
+    else:
+        total_heads_kv = heads_kv * layers
+
+    key_length = summary.get("key_length") or (embedding // heads if embedding else None)
+    value_length = summary.get("value_length") or key_length
+    if not key_length:
+        return None
+
+    return int(ctx * total_heads_kv * (key_length + value_length) * cache_types[cache_type])
+
+
+def compute_size(summary, ubatch):
+    """Return an estimate of the compute buffers, dominated by the logits and activations of a micro-batch."""
+    vocab = summary.get("vocab_size") or 0
+    embedding = summary.get("embedding_length") or 0
+    return OVERHEAD + ubatch * (vocab + 4 * embedding) * 4
+
+
+class Plan:
+    """Memory a Model takes with the chosen context and KV cache type."""
+
+    def __init__(self, ctx, cache_type, weights, kv_cache, compute, available, replicas=1):
+        self.ctx = ctx
+        self.cache_type = cache_type
+        self.weights = weights
+        self.kv_cache = kv_cache
+        self.compute = compute
+        self.available = available
+        self.replicas = replicas
+
+    @property
+    def required(self):
+        # Replicas share the page cache holding the weights, each has its own KV cache and compute buffers
+        return self.weights + ((self.kv_cache or 0) + self.compute) * self.replicas
+
+    @property
+    def fits(self):
+        return self.required <= self.available * MEMORY_SHARE
+
+    def report(self):
+        kv_cache = "unknown" if self.kv_cache is None else human_readable_size(self.kv_cache)
+        times = f" x {self.replicas} replicas" if self.replicas > 1 else ""
+        return [
+            f"Weights:   {human_readable_size(self.weights)}",
+            f"KV cache:  {kv_cache} ({self.ctx} tokens, {self.cache_type}){times}",
+            f"Compute:   {human_readable_size(self.compute)}{times}",
+            f"Required:  {human_readable_size(self.required)}",
+            f"Available: {human_readable_size(self.available)}"
+            f" ({MEMORY_SHARE:.0%} usable: {human_readable_size(self.available * MEMORY_SHARE)})",
+        ]
+
+
+def plan(summary, weights, ctx, ubatch, available, replicas=1):
+    """
+    Pick the largest context and best KV cache type that fit in memory.
+
+    With several replicas of the server, the weights are counted once and
+    the KV cache and compute buffers once per replica.
+
+    The context is kept and the KV cache quantized first, a q8_0 cache is
+    nearly lossless, before the context is halved down to MIN_CTX. When
+    nothing fits, the plan of the smallest footprint is returned, its fits
+    property is False.
+    """
+    compute = compute_size(summary, ubatch)
+    candidate = None
+    while True:
+        for cache_type in cache_types:
+            kv_cache = kv_cache_size(summary, ctx, cache_type)
+            candidate = Plan(ctx, cache_type, weights, kv_cache, compute, available, replicas)
+            # Without the shape of the KV cache, only the weights can be checked
+            if kv_cache is None or candidate.fits:
+                return candidate
+
+        if ctx <= MIN_CTX:
+            return candidate
+        ctx = max(ctx // 2, MIN_CTX)
@@ -0,0 +1,47 @@
+"""Preloading of Model files into the page cache before they are served."""
+
+import concurrent.futures
+import os
+
+# Bytes read at once by every reader
+CHUNK_SIZE = 8 * 1024 * 1024
+
+# Readers of a file, sequential readers of separate segments keep several requests in flight
+READERS = 4
+
+
+def readahead(path, readers=READERS):
+    """
+    Read the file at path into the page cache.
+
+    llama.cpp memory-maps the Model and its pages are otherwise faulted in
+    from disk one at a time by the first requests. The kernel is told the
+    whole file is needed with posix_fadvise, then readers read a segment
+    of the file each, sequentially, so the kernel's readahead keeps the
+    disk busy.
+
+    Returns:
+    int: the number of bytes read.
+    """
+    size = os.path.getsize(path)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fd, 0, size, os.POSIX_FADV_WILLNEED)
+
+        segment = max(-(-size // readers), CHUNK_SIZE)
+
+        def read(start):
+            done = 0
+            end = min(start + segment, size)
+            while start + done < end:
+                data = os.pread(fd, min(CHUNK_SIZE, end - start - done), start + done)
+                if not data:
+                    break
+                done += len(data)
+            return done
+
+        with concurrent.futures.ThreadPoolExecutor(readers) as pool:
+            return sum(pool.map(read, range(0, size, segment)))
+    finally:
+        os.close(fd)
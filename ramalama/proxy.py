@@ -0,0 +1,632 @@
+"""OpenAI compatible proxy in front of the AI Model servers started by ramalama serve."""
+
+import http.client
+import http.server
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from ramalama.cache import Entry
+from ramalama.common import perror
+from ramalama.metrics import TAIL_SIZE, MetricsServer, parse_timings
+
+# Headers about the connection rather than the message, they are not forwarded
+hop_by_hop = {"connection", "keep-alive", "proxy-connection", "te", "trailer", "transfer-encoding", "upgrade", "host"}
+
+# Seconds a server may take to load its Model
+START_TIMEOUT = 600
+
+# Seconds a request waits for a server to be started when the running ones are busy
+WAIT_TIMEOUT = 300
+
+# Seconds between health checks of the running servers
+HEALTH_INTERVAL = 5
+
+# Failed health checks in a row after which a server is restarted
+HEALTH_RETRIES = 3
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class Backend:
+    """
+    Server process of a Model, started on a free local port.
+
+    command is called with the port to listen on and returns the command
+    line of the server. cpus, when set, are the CPUs the server is pinned to.
+    """
+
+    def __init__(self, name, command, cpus=None, debug=False):
+        self.name = name
+        self.command = command
+        self.cpus = cpus
+        self.debug = debug
+        self.port = None
+        self.process = None
+        self.state = "stopped"
+        self.outstanding = 0
+        self.failures = 0
+
+    def start(self):
+        self.port = free_port()
+        cmd = self.command(self.port)
+        if self.debug:
+            perror("run_cmd: ", *cmd)
+        self.process = subprocess.Popen(cmd, stdin=subprocess.DEVNULL)
+        if self.cpus:
+            # Inherited by the threads llama-server starts once the Model is loaded
+            os.sched_setaffinity(self.process.pid, self.cpus)
+        self.state = "starting"
+        self.failures = 0
+
+    def wait_ready(self, timeout=START_TIMEOUT):
+        """Wait for the server to load its Model, raising OSError when it exits or times out."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if not self.alive:
+                raise OSError(f"{self.name} server exited with {self.process.returncode}")
+            if self.healthy():
+                return
+            time.sleep(0.1)
+
+        raise TimeoutError(f"{self.name} server did not start in {timeout} seconds")
+
+    def healthy(self, timeout=2):
+        # llama-server answers 503 while it loads the Model
+        try:
+            conn = self.connection(timeout)
+            try:
+                conn.request("GET", "/health")
+                return conn.getresponse().status == 200
+            finally:
+                conn.close()
+        except (OSError, http.client.HTTPException):
+            return False
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            try:
+                self.process.wait(10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+            if self.debug:
+                perror(f"stopped {self.name} server on port {self.port}")
+        self.process = None
+        self.state = "stopped"
+
+    def connection(self, timeout=600):
+        return http.client.HTTPConnection("127.0.0.1", self.port, timeout=timeout)
+
+    def warm_up(self, prompt):
+        """Send a completion of prompt, so buffers are allocated and pages faulted in before real requests."""
+        body = json.dumps({"prompt": prompt, "max_tokens": 1})
+        conn = self.connection()
+        try:
+            conn.request("POST", "/v1/completions", body=body, headers={"Content-Type": "application/json"})
+            response = conn.getresponse()
+            response.read()
+        except (OSError, http.client.HTTPException) as e:
+            perror(f"warm-up request to {self.name} server failed: {e}")
+            return
+        finally:
+            conn.close()
+
+        if response.status != 200:
+            perror(f"warm-up request to {self.name} server failed: HTTP {response.status} {response.reason}")
+
+
+class Replicas:
+    """
+    Servers of one Model, started and stopped together.
+
+    names are the names the Model is requested by, path the file it is
+    loaded from, memory the estimate of the memory the servers take once
+    the Model is loaded. preload is
+    called before the servers are started, and warmup is the prompt of
+    the request every server gets before it is sent others.
+    """
+
+    def __init__(self, names, backends, path=None, memory=0, preload=None, warmup=None):
+        self.names = names
+        self.name = names[0]
+        self.path = path
+        self.backends = backends
+        for backend in backends:
+            backend.replicas = self
+        self.memory = memory
+        self.preload = preload
+        self.warmup = warmup
+        self.state = "stopped"
+        self.outstanding = 0
+        self.last_used = 0
+
+    @property
+    def debug(self):
+        return self.backends[0].debug
+
+    def revision(self):
+        """Return the resolved path, size and mtime of the Model file, which change when it is pulled again."""
+        if not self.path:
+            return None
+        try:
+            path = os.path.realpath(self.path)
+            st = os.stat(path)
+        except OSError:
+            return None
+        return [path, st.st_size, st.st_mtime_ns]
+
+    def start(self):
+        """Start every server, returning once they are all ready."""
+        try:
+            if self.preload:
+                self.preload()
+            for backend in self.backends:
+                backend.start()
+            for backend in self.backends:
+                self.ready(backend)
+        except BaseException:
+            self.stop()
+            raise
+
+    def ready(self, backend):
+        """Wait for a started server to load the Model and warm it up."""
+        backend.wait_ready()
+        if self.warmup:
+            backend.warm_up(self.warmup)
+        backend.state = "running"
+
+    def stop(self):
+        for backend in self.backends:
+            backend.stop()
+        self.state = "stopped"
+
+    def pick(self):
+        """Return the ready server with the fewest outstanding requests, None when none is ready."""
+        ready = [backend for backend in self.backends if backend.state == "running" and backend.alive]
+        return min(ready, key=lambda backend: backend.outstanding, default=None)
+
+
+class Router:
+    """
+    Route requests to the servers of their Model, starting them on demand.
+
+    The servers of at most max_models Models run at once, and the memory
+    they take stays within memory_budget; 0 lifts either limit. To start
+    another Model, the least recently used idle ones are stopped, and when
+    every running Model is busy the request waits for one to finish.
+    Models idle for idle_timeout seconds are stopped too.
+
+    A Model served by several replicas sends each request to the replica
+    with the fewest outstanding requests. Replicas that exit, or fail
+    HEALTH_RETRIES health checks in a row while idle, are restarted.
+    """
+
+    def __init__(self, models, max_models=0, memory_budget=0, idle_timeout=0):
+        self.models = models
+        self.max_models = max_models
+        self.memory_budget = memory_budget
+        self.idle_timeout = idle_timeout
+        self.aliases = {}
+        for model in models:
+            for name in model.names:
+                self.aliases.setdefault(name, model)
+        self.cond = threading.Condition()
+        self.closed = threading.Event()
+        threading.Thread(target=self._monitor, daemon=True).start()
+
+    def lookup(self, name):
+        """Return the Model served as name, the only one when a single Model is served."""
+        if not name and len(self.models) == 1:
+            return self.models[0]
+        return self.aliases.get(name)
+
+    def acquire(self, model, timeout=WAIT_TIMEOUT):
+        """Return the server to send a request for model to, starting the Model first if needed."""
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while True:
+                if model.state == "running":
+                    backend = model.pick()
+                    if backend:
+                        backend.outstanding += 1
+                        model.outstanding += 1
+                        model.last_used = time.monotonic()
+                        return backend
+                elif model.state == "stopped" and self._make_room(model):
+                    model.state = "starting"
+                    break
+
+                # Wait for the Model to start, a replica to restart or memory to free up
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"no server of {model.name} is available")
+                self.cond.wait(remaining)
+
+        try:
+            model.start()
+        except BaseException:
+            with self.cond:
+                model.state = "stopped"
+                self.cond.notify_all()
+            raise
+
+        with self.cond:
+            model.state = "running"
+            self.cond.notify_all()
+        return self.acquire(model, max(deadline - time.monotonic(), 0))
+
+    def release(self, backend, failed=False):
+        with self.cond:
+            model = backend.replicas
+            backend.outstanding -= 1
+            model.outstanding -= 1
+            model.last_used = time.monotonic()
+            if failed:
+                backend.failures += 1
+            self.cond.notify_all()
+
+    def _make_room(self, model):
+        """Stop idle Models until model fits, return False when it cannot fit yet."""
+        while True:
+            running = [m for m in self.models if m.state != "stopped"]
+            if not running:
+                # A Model larger than the budget still runs on its own
+                return True
+
+            count_ok = not self.max_models or len(running) < self.max_models
+            memory = sum(m.memory for m in running) + model.memory
+            memory_ok = not self.memory_budget or memory <= self.memory_budget
+            if count_ok and memory_ok:
+                return True
+
+            idle = [m for m in running if m.state == "running" and not m.outstanding]
+            if not idle:
+                return False
+            lru = min(idle, key=lambda m: m.last_used)
+            if lru.debug:
+                perror(f"evicting {lru.name} to start {model.name}")
+            self._stop(lru)
+            if model.state != "stopped":
+                # Another request started the Model meanwhile
+                return False
+
+    def _stop(self, model):
+        """
+        Stop model, called with the lock held. Stopping waits for the
+        servers to exit, the lock is released meanwhile so requests for
+        other Models are not held up.
+        """
+        model.state = "stopping"
+        self.cond.release()
+        try:
+            model.stop()
+        finally:
+            self.cond.acquire()
+            if model.state == "stopping":
+                model.state = "stopped"
+            self.cond.notify_all()
+
+    def _monitor(self):
+        interval = min(self.idle_timeout or HEALTH_INTERVAL, HEALTH_INTERVAL)
+        while not self.closed.wait(interval):
+            with self.cond:
+                now = time.monotonic()
+                for model in self.models:
+                    idle = model.state == "running" and not model.outstanding
+                    if self.idle_timeout and idle and now - model.last_used >= self.idle_timeout:
+                        self._stop(model)
+                running = [b for m in self.models if m.state == "running" for b in m.backends]
+
+            for backend in running:
+                if backend.state == "stopped":
+                    # Its last restart failed
+                    self._restart(backend)
+                elif backend.state != "running":
+                    continue
+                elif not backend.alive:
+                    backend.failures = HEALTH_RETRIES
+                elif not backend.outstanding:
+                    # Busy servers may be slow to answer, only idle ones are probed
+                    backend.failures = 0 if backend.healthy() else backend.failures + 1
+                if backend.failures >= HEALTH_RETRIES:
+                    self._restart(backend)
+
+    def _restart(self, backend):
+        with self.cond:
+            if backend.state not in ("running", "stopped"):
+                return
+            if backend.state == "running":
+                perror(f"{backend.name} server on port {backend.port} is unhealthy, restarting it")
+            backend.state = "restarting"
+
+        def restart():
+            # Requests already sent to it fail, new ones go to the other replicas
+            backend.stop()
+            try:
+                backend.start()
+                backend.replicas.ready(backend)
+            except OSError as e:
+                perror(f"restarting {backend.name} server failed: {e}")
+                backend.stop()
+            with self.cond:
+                # The Model may have been stopped meanwhile
+                if self.closed.is_set() or backend.replicas.state != "running":
+                    backend.stop()
+                self.cond.notify_all()
+
+        threading.Thread(target=restart, daemon=True).start()
+
+    def list(self):
+        return [{"id": model.name, "object": "model", "owned_by": "ramalama"} for model in self.models]
+
+    def close(self):
+        self.closed.set()
+        with self.cond:
+            for model in self.models:
+                model.stop()
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Relay every streamed token right away
+    disable_nagle_algorithm = True
+    first_token = None
+
+    def log_message(self, format, *args):
+        if self.server.debug:
+            super().log_message(format, *args)
+
+    def send_response(self, code, message=None):
+        self.status = code
+        super().send_response(code, message)
+
+    def _reply(self, status, body):
+        body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, status, message, error_type="invalid_request_error"):
+        self._reply(status, {"error": {"message": message, "type": error_type, "code": status}})
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path == "/health":
+            if not self.server.ready.is_set():
+                return self._error(503, "Loading model", "unavailable_error")
+            return self._reply(200, {"status": "ok"})
+        if path == "/v1/models":
+            return self._reply(200, {"object": "list", "data": self.server.router.list()})
+        if path == "/cache" and self.server.cache:
+            return self._reply(200, self.server.cache.stats())
+        self._route(None, b"")
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            request = json.loads(body)
+        except ValueError:
+            request = None
+        self._route(request, body)
+
+    def _route(self, request, body):
+        name = request.get("model") if isinstance(request, dict) else None
+        model = self.server.router.lookup(name)
+        if model is None:
+            if not name:
+                return self._error(400, "the model field is required when several Models are served")
+            return self._error(404, f"model {name} not found")
+
+        metrics = self.server.metrics
+        if not metrics:
+            return self._cached(model, request, body)
+
+        self.started = time.monotonic()
+        self.status = None
+        self.first_token = None
+        self.timings = None
+        try:
+            self._cached(model, request, body)
+        except ConnectionError:
+            # The client closed the connection before the response was complete, nothing is left to send
+            self.status = 499
+            self.close_connection = True
+        except BaseException:
+            if self.status is None:
+                self.status = 500
+            raise
+        finally:
+            duration = time.monotonic() - self.started
+            ttft = self.first_token - self.started if self.first_token else None
+            metrics.observe(model.name, self.status, duration, ttft, self.timings)
+
+    def _cached(self, model, request, body):
+        cache = self.server.cache
+        cache_key = cache.key(model.name, self.path, request, model.revision()) if cache and request else None
+        if not cache_key:
+            return self._serve(model, body)
+
+        entry = cache.get(cache_key)
+        if entry:
+            return self._replay(entry)
+        try:
+            self._serve(model, body, cache_key)
+        finally:
+            cache.done(cache_key)
+
+    def _serve(self, model, body, cache_key=None):
+        router = self.server.router
+        metrics = self.server.metrics
+        if metrics:
+            metrics.wait(model.name, 1)
+        try:
+            backend = router.acquire(model)
+        except OSError as e:
+            return self._error(503, str(e), "server_error")
+        finally:
+            if metrics:
+                metrics.wait(model.name, -1)
+
+        failed = False
+        try:
+            failed = not self._forward(backend, body, cache_key)
+        finally:
+            router.release(backend, failed)
+
+    def _forward(self, backend, body, cache_key=None):
+        """Forward the request to backend, return False when the server failed to answer."""
+        headers = {key: value for key, value in self.headers.items() if key.lower() not in hop_by_hop}
+        conn = backend.connection()
+        try:
+            try:
+                conn.request(self.command, self.path, body=body or None, headers=headers)
+                response = conn.getresponse()
+            except (OSError, http.client.HTTPException) as e:
+                self._error(502, f"{backend.name} server failed: {e}", "server_error")
+                return False
+
+            self.send_response(response.status, response.reason)
+            for key, value in response.getheaders():
+                # send_response already sent its own Server and Date headers
+                if key.lower() not in hop_by_hop and key.lower() not in ("server", "date"):
+                    self.send_header(key, value)
+            chunked = response.getheader("Content-Length") is None
+            if chunked:
+                self.send_header("Transfer-Encoding", "chunked")
+            if cache_key:
+                self.send_header("X-Cache", "MISS")
+            self.end_headers()
+
+            # Only successful responses are cached, once they are complete
+            record = bytearray() if cache_key and response.status == 200 else None
+            # The token counts and timings are in the body, at the end of a stream
+            tail = bytearray() if self.server.metrics and response.status == 200 else None
+            self._relay(response, chunked, record, tail)
+            if record is not None:
+                entry = Entry(response.status, response.getheader("Content-Type"), record, streamed=chunked)
+                self.server.cache.put(cache_key, entry)
+            if tail is not None:
+                self.timings = parse_timings(tail, streamed=chunked)
+            return True
+        finally:
+            conn.close()
+
+    def _relay(self, response, chunked, record=None, tail=None):
+        """
+        Copy the response to the client as it arrives, so streamed tokens are
+        not held back. record keeps the whole response, tail the end of a
+        streamed one and the whole of others.
+        """
+        while True:
+            data = response.read1(65536)
+            if not data:
+                break
+            if chunked and self.first_token is None:
+                self.first_token = time.monotonic()
+            if record is not None:
+                record += data
+            if tail is not None:
+                tail += data
+                if chunked:
+                    del tail[:-TAIL_SIZE]
+            if chunked:
+                data = f"{len(data):x}\r\n".encode() + data + b"\r\n"
+            self.wfile.write(data)
+            self.wfile.flush()
+
+        if chunked:
+            self.wfile.write(b"0\r\n\r\n")
+
+    def _replay(self, entry):
+        """Send a cached response, a streamed one is replayed as the complete event stream at once."""
+        self.send_response(entry.status)
+        self.send_header("Content-Type", entry.content_type or "application/json")
+        self.send_header("Content-Length", str(len(entry.body)))
+        self.send_header("X-Cache", "HIT")
+        self.end_headers()
+        self.wfile.write(entry.body)
+
+
+class Proxy(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, router, cache=None, metrics=None, debug=False):
+        super().__init__(address, Handler)
+        self.router = router
+        self.cache = cache
+        self.metrics = metrics
+        self.debug = debug
+        self.ready = threading.Event()
+
+
+def sd_notify(state):
+    """Send state to systemd when it supervises the service with Type=notify."""
+    path = os.getenv("NOTIFY_SOCKET")
+    if not path:
+        return
+
+    # Abstract socket
+    if path.startswith("@"):
+        path = "\0" + path[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as s:
+            s.connect(path)
+            s.sendall(state.encode())
+    except OSError as e:
+        perror(f"notifying systemd failed: {e}")
+
+
+def serve(router, host, port, cache=None, metrics=None, debug=False):
+    """
+    Serve the proxy until interrupted, then stop every server.
+
+    A single Model is started right away, the proxy answers /health with
+    503 until it is loaded and warmed up. Several Models are started on
+    demand, so the proxy is ready at once. systemd is notified once ready.
+    With metrics, they are served on their own port.
+    """
+    proxy = Proxy((host, int(port)), router, cache, metrics, debug)
+    # Stop the servers on SIGTERM too, e.g. from podman stop
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    thread = threading.Thread(target=proxy.serve_forever, daemon=True)
+    thread.start()
+    metrics_server = None
+    if metrics:
+        metrics_server = MetricsServer((host, metrics.port), lambda: metrics.render(router, cache))
+        threading.Thread(target=metrics_server.serve_forever, daemon=True).start()
+    try:
+        if len(router.models) == 1:
+            try:
+                router.release(router.acquire(router.models[0]))
+            except OSError as e:
+                raise KeyError(f"starting {router.models[0].name} failed: {e}")
+        proxy.ready.set()
+        sd_notify("READY=1")
+        thread.join()
+    finally:
+        proxy.shutdown()
+        proxy.server_close()
+        if metrics_server:
+            metrics_server.shutdown()
+            metrics_server.server_close()
+        router.close()
+        if cache:
+            stats = cache.stats()
+            perror(f"Response cache: {stats['hits']} hits, {stats['misses']} misses")
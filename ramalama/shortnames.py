@@ -1,4 +1,7 @@
+import atexit
 import configparser
+import hashlib
+import json
 import os
 import tempfile
 
@@ -6,27 +9,90 @@ import tempfile
 class Shortnames:
     """Shortnames utility class"""
 
-    shortnames = {}
+    file_paths = [
+        "/usr/share/ramalama/shortnames.conf",
+        "/etc/ramalama/shortnames.conf",
+        os.path.expanduser("~/.local/share/ramalama/shortnames.conf"),
+        os.path.expanduser("~/.config/ramalama/shortnames.conf"),
+        os.path.expanduser("~/.local/pipx/venvs/ramalama/share/ramalama/shortnames.conf"),
+        "./shortnames/shortnames.conf",  # for development
+        "./shortnames.conf",  # for development
+    ]
 
     def __init__(self):
-        file_paths = [
-            "/usr/share/ramalama/shortnames.conf",
-            "/etc/ramalama/shortnames.conf",
-            os.path.expanduser("~/.local/share/ramalama/shortnames.conf"),
-            os.path.expanduser("~/.config/ramalama/shortnames.conf"),
-            os.path.expanduser("~/.local/pipx/venvs/ramalama/share/ramalama/shortnames.conf"),
-            "./shortnames/shortnames.conf",  # for development
-            "./shortnames.conf",  # for development
-        ]
-
-        for file_path in file_paths:
+        self.store = None
+        self._shortnames = None
+        self._cache_path = None
+
+    @property
+    def shortnames(self):
+        """
+        The merged shortname table, loaded on first use.
+
+        The table is compiled into cache/shortnames/ in the store and
+        reused as long as the modification times and sizes of the
+        shortnames.conf files are unchanged.
+        """
+        if self._shortnames is None:
+            self._shortnames = self._load()
+        return self._shortnames
+
+    def _sources(self):
+        sources = []
+        for file_path in self.file_paths:
+            try:
+                st = os.stat(file_path)
+            except OSError:
+                continue
+            sources.append([os.path.abspath(file_path), st.st_mtime_ns, st.st_size])
+
+        return sources
+
+    def _load(self):
+        sources = self._sources()
+        if self.store:
+            paths = json.dumps([source[0] for source in sources])
+            digest = hashlib.sha256(paths.encode()).hexdigest()
+            self._cache_path = os.path.join(self.store, "cache", "shortnames", digest[:16])
+            try:
+                with open(self._cache_path + ".json") as f:
+                    cache = json.load(f)
+                if cache["sources"] == sources:
+                    return cache["shortnames"]
+            except (OSError, ValueError, KeyError):
+                pass
+
+        shortnames = {}
+        for source in sources:
             config = configparser.ConfigParser(delimiters=("="))
-            config.read(file_path)
+            config.read(source[0])
             if "shortnames" in config:
-                self.shortnames.update(config["shortnames"])
+                shortnames.update(config["shortnames"])
 
         # Remove leading and trailing quotes from keys and values
-        self.shortnames = {self._strip_quotes(key): self._strip_quotes(value) for key, value in self.shortnames.items()}
+        shortnames = {self._strip_quotes(key): self._strip_quotes(value) for key, value in shortnames.items()}
+        if self._cache_path:
+            try:
+                self._write(".conf", self._conf(shortnames))
+                self._write(".json", json.dumps({"sources": sources, "shortnames": shortnames}))
+            except OSError:
+                # A read-only store only costs parsing the files again
+                pass
+
+        return shortnames
+
+    def _write(self, extension, content):
+        os.makedirs(os.path.dirname(self._cache_path), exist_ok=True)
+        tmp_path = f"{self._cache_path}{extension}.{os.getpid()}"
+        with open(tmp_path, "w") as f:
+            f.write(content)
+        os.replace(tmp_path, self._cache_path + extension)
+
+    def _conf(self, shortnames):
+        lines = ['[shortnames]\n']
+        for shortname, model in shortnames.items():
+            lines.append('"%s"="%s"\n' % (shortname, model))
+        return "".join(lines)
 
     def _strip_quotes(self, s):
         return s.strip("'\"")
@@ -34,11 +100,25 @@ class Shortnames:
     def resolve(self, model):
         return self.shortnames.get(model)
 
-    def create_shortname_file(self):
-        shortnamefile = tempfile.NamedTemporaryFile(prefix='RamaLama_shortname_', delete=False)
-        # Open the file for writing.
-        with open(shortnamefile.name, 'w') as c:
-            c.write('[shortnames]\n')
-            for shortname in self.shortnames:
-                c.write('"%s"="%s"\n' % (shortname, self.shortnames.get(shortname)))
-        return shortnamefile.name
+    def shortname_file(self):
+        """
+        Return a shortnames.conf file holding the merged shortname table.
+
+        The file lives next to the compiled table in the store and is only
+        rewritten when the table is recompiled, so it can be mounted into
+        the container as is. Without a store, or when it is read-only, the
+        table is written to a temporary file removed on exit.
+        """
+        shortnames = self.shortnames
+        if self._cache_path:
+            try:
+                if not os.path.exists(self._cache_path + ".conf"):
+                    self._write(".conf", self._conf(shortnames))
+                return self._cache_path + ".conf"
+            except OSError:
+                pass
+
+        with tempfile.NamedTemporaryFile("w", prefix="RamaLama_shortname_", delete=False) as f:
+            f.write(self._conf(shortnames))
+        atexit.register(os.remove, f.name)
+        return f.name
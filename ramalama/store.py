@@ -0,0 +1,207 @@
+"""Index of the Models in a RamaLama store."""
+
+import os
+import sqlite3
+import time
+
+transports = ["huggingface", "oci", "ollama"]
+
+schema = """
+CREATE TABLE IF NOT EXISTS models (
+    name TEXT PRIMARY KEY,
+    transport TEXT NOT NULL,
+    path TEXT NOT NULL,
+    blob TEXT,
+    digest TEXT,
+    size INTEGER NOT NULL,
+    pulled REAL NOT NULL,
+    last_used REAL
+);
+CREATE INDEX IF NOT EXISTS models_blob ON models (blob);
+CREATE TABLE IF NOT EXISTS blobs (
+    path TEXT NOT NULL,
+    blob TEXT NOT NULL,
+    digest TEXT,
+    PRIMARY KEY (path, blob)
+);
+CREATE INDEX IF NOT EXISTS blobs_blob ON blobs (blob);
+CREATE INDEX IF NOT EXISTS blobs_digest ON blobs (digest);
+CREATE VIEW IF NOT EXISTS model_blobs AS
+    SELECT path, blob, digest FROM models WHERE blob IS NOT NULL
+    UNION SELECT path, blob, digest FROM blobs;
+"""
+
+
+def connect(store):
+    """
+    Open the index of the store, building it from the store when it does not exist.
+
+    The index records every Model symlink under models/ with the blob it
+    points to, and the other blobs of the Model, so listing and removing
+    Models does not walk the store.
+    """
+    path = os.path.join(store, "store.db")
+    exists = os.path.exists(path)
+    db = _open(path)
+    if not exists:
+        reindex(store, db)
+    return db
+
+
+def _open(path):
+    db = sqlite3.connect(path, timeout=30)
+    db.executescript(schema)
+    return db
+
+
+def _record(store, symlink_path, pulled=None):
+    relative_path = os.path.relpath(symlink_path, os.path.join(store, "models"))
+    transport, model = relative_path.split(os.sep, 1)
+    blob = os.path.realpath(symlink_path)
+    digest = os.path.basename(blob)
+    if not digest.startswith("sha256:"):
+        digest = None
+
+    st = os.stat(symlink_path)
+    if pulled is None:
+        pulled = os.lstat(symlink_path).st_mtime
+    return {
+        "name": f"{transport}://{model}",
+        "transport": transport,
+        "path": relative_path,
+        "blob": os.path.relpath(blob, store),
+        "digest": digest,
+        "size": st.st_size,
+        "pulled": pulled,
+    }
+
+
+def add_model(store, symlink_path, used=False):
+    """Record the Model pulled to symlink_path, optionally marking it used now."""
+    record = _record(store, symlink_path)
+    record["last_used"] = time.time() if used else None
+    with connect(store) as db:
+        db.execute(
+            """
+            INSERT INTO models (name, transport, path, blob, digest, size, pulled, last_used)
+            VALUES (:name, :transport, :path, :blob, :digest, :size, :pulled, :last_used)
+            ON CONFLICT (name) DO UPDATE SET
+                blob = excluded.blob,
+                digest = excluded.digest,
+                size = excluded.size,
+                pulled = excluded.pulled,
+                last_used = COALESCE(excluded.last_used, last_used)
+            """,
+            record,
+        )
+
+
+def add_blobs(store, symlink_path, blobs):
+    """
+    Record the blobs of the Model at symlink_path besides its model file,
+    such as the config and template of an Ollama Model.
+
+    Args:
+    store: store directory
+    symlink_path: path of the Model symlink
+    blobs: (path, digest) of every blob, replacing those recorded before
+    """
+    relative_path = os.path.relpath(symlink_path, os.path.join(store, "models"))
+    rows = [(relative_path, os.path.relpath(path, store), digest) for path, digest in blobs]
+    with connect(store) as db:
+        db.execute("DELETE FROM blobs WHERE path = ?", (relative_path,))
+        db.executemany("INSERT OR IGNORE INTO blobs (path, blob, digest) VALUES (?, ?, ?)", rows)
+
+
+def remove_model(store, symlink_path):
+    """
+    Forget the Model at symlink_path.
+
+    Returns:
+    list: (path, digest) of every blob of the Model no other Model uses.
+          The digest is None when another Model uses a copy of the blob
+          under another path, its content-addressed copy is still used.
+    """
+    relative_path = os.path.relpath(symlink_path, os.path.join(store, "models"))
+    with connect(store) as db:
+        blobs = {}
+        for blob, digest in db.execute("SELECT blob, digest FROM model_blobs WHERE path = ?", (relative_path,)):
+            blobs[blob] = blobs.get(blob) or digest
+        db.execute("DELETE FROM models WHERE path = ?", (relative_path,))
+        db.execute("DELETE FROM blobs WHERE path = ?", (relative_path,))
+
+        unused = []
+        for blob, digest in blobs.items():
+            if db.execute("SELECT 1 FROM model_blobs WHERE blob = ?", (blob,)).fetchone():
+                continue
+            if digest and db.execute("SELECT 1 FROM model_blobs WHERE digest = ?", (digest,)).fetchone():
+                digest = None
+            unused.append((os.path.join(store, blob), digest))
+
+        return unused
+
+
+def used_blobs(store):
+    """Return the (path, digest) of every blob of the recorded Models."""
+    db = connect(store)
+    with db:
+        rows = db.execute("SELECT path, blob, digest FROM model_blobs").fetchall()
+
+    blobs = []
+    for path, blob, digest in rows:
+        # Drop Models removed behind the index's back
+        if not os.path.lexists(os.path.join(store, "models", path)):
+            with db:
+                db.execute("DELETE FROM models WHERE path = ?", (path,))
+                db.execute("DELETE FROM blobs WHERE path = ?", (path,))
+            continue
+
+        blobs.append((os.path.join(store, blob), digest))
+
+    db.close()
+    return blobs
+
+
+def list_models(store):
+    """Return the recorded Models, most recently pulled first."""
+    db = connect(store)
+    db.row_factory = sqlite3.Row
+    with db:
+        rows = db.execute("SELECT * FROM models ORDER BY pulled DESC").fetchall()
+
+    models = []
+    for row in rows:
+        # Drop Models removed behind the index's back
+        if not os.path.lexists(os.path.join(store, "models", row["path"])):
+            with db:
+                db.execute("DELETE FROM models WHERE name = ?", (row["name"],))
+            continue
+
+        models.append(dict(row))
+
+    db.close()
+    return models
+
+
+def reindex(store, db=None):
+    """Rebuild the index from the Model symlinks in the store."""
+    records = []
+    for transport in transports:
+        for root, dirs, files in os.walk(os.path.join(store, "models", transport)):
+            for file in files + dirs:
+                symlink_path = os.path.join(root, file)
+                if os.path.islink(symlink_path) and os.path.exists(symlink_path):
+                    records.append(_record(store, symlink_path))
+
+    db = db or _open(os.path.join(store, "store.db"))
+    with db:
+        db.execute("DELETE FROM models")
+        db.executemany(
+            """
+            INSERT INTO models (name, transport, path, blob, digest, size, pulled)
+            VALUES (:name, :transport, :path, :blob, :digest, :size, :pulled)
+            """,
+            records,
+        )
+        db.execute("DELETE FROM blobs WHERE path NOT IN (SELECT path FROM models)")
+    return len(records)
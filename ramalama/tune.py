@@ -0,0 +1,304 @@
+"""Tuning of the llama.cpp parameters for a Model on this host."""
+
+import glob
+import math
+import os
+import resource
+import sys
+
+from ramalama import gguf, planner
+from ramalama.capabilities import capabilities
+
+# Context size used when the Model does not tell its own, and the largest one picked
+DEFAULT_CTX = 2048
+MAX_CTX = 4096
+
+# llama.cpp defaults of the logical and physical batch sizes
+MAX_BATCH = 2048
+MAX_UBATCH = 512
+
+
+def _read_int(path):
+    try:
+        with open(path) as f:
+            value = f.read().split()[0]
+    except (OSError, IndexError):
+        return None
+
+    return int(value) if value.isdigit() else None
+
+
+def _cgroup_path(controller):
+    """Return the directory of the cgroup of this process for controller, v2 first."""
+    try:
+        with open("/proc/self/cgroup") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return None, None
+
+    for line in lines:
+        _, controllers, path = line.split(":", 2)
+        if controllers == "":
+            return 2, os.path.join("/sys/fs/cgroup", path.lstrip("/"))
+        if controller in controllers.split(","):
+            return 1, os.path.join("/sys/fs/cgroup", controllers, path.lstrip("/"))
+
+    return None, None
+
+
+def available_memory():
+    """
+    Return the bytes of memory available to this process.
+
+    That is the memory the kernel reports available, capped by the room
+    left under the memory limit of the cgroup, e.g. of the container.
+    """
+    available = None
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    available = int(line.split()[1]) * 1024
+                    break
+    except OSError:
+        pass
+
+    if available is None:
+        try:
+            available = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+        except (ValueError, OSError):
+            return None
+
+    version, path = _cgroup_path("memory")
+    if version == 2:
+        limit, usage = _read_int(f"{path}/memory.max"), _read_int(f"{path}/memory.current")
+    elif version == 1:
+        limit, usage = _read_int(f"{path}/memory.limit_in_bytes"), _read_int(f"{path}/memory.usage_in_bytes")
+    else:
+        limit = usage = None
+
+    # cgroup v1 reports no limit as a huge number
+    if limit and usage is not None and limit < 1 << 60:
+        available = min(available, max(limit - usage, 0))
+    return available
+
+
+def physical_cores():
+    """
+    Return the number of CPU cores to run threads on.
+
+    Physical cores rather than SMT siblings, limited to the CPUs this
+    process may run on and to the CPU quota of its cgroup.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        # Count the cores of the allowed CPUs, not the CPUs, SMT siblings share a core
+        cores = sum(len(node) for node in numa_nodes())
+    else:
+        cores = capabilities["cpu_cores"] or os.cpu_count() or 1
+
+    version, path = _cgroup_path("cpu")
+    quota = None
+    if version == 2:
+        try:
+            with open(f"{path}/cpu.max") as f:
+                limit, period = f.read().split()
+            if limit != "max":
+                quota = int(limit) / int(period)
+        except (OSError, ValueError):
+            pass
+    elif version == 1:
+        limit, period = _read_int(f"{path}/cpu.cfs_quota_us"), _read_int(f"{path}/cpu.cfs_period_us")
+        if limit and period:
+            quota = limit / period
+
+    if quota:
+        cores = min(cores, math.ceil(quota))
+    return max(cores, 1)
+
+
+def _cpu_list(text):
+    """Parse a kernel CPU list such as 0-3,8-11."""
+    cpus = []
+    for part in text.strip().split(","):
+        if part:
+            low, _, high = part.partition("-")
+            cpus += range(int(low), int(high or low) + 1)
+    return cpus
+
+
+def _read_cpu_list(path):
+    try:
+        with open(path) as f:
+            return _cpu_list(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def numa_nodes():
+    """
+    Return the physical cores this process may run on, by NUMA node.
+
+    Every node is a list of cores, every core the list of its SMT siblings.
+    Hosts without NUMA information are a single node.
+    """
+    allowed = os.sched_getaffinity(0)
+    nodes = []
+    paths = glob.glob("/sys/devices/system/node/node[0-9]*")
+    for path in sorted(paths, key=lambda path: int(path.rsplit("node", 1)[1])):
+        cpus = set(_read_cpu_list(f"{path}/cpulist") or []) & allowed
+        if cpus:
+            nodes.append(cpus)
+    if not nodes:
+        nodes = [allowed]
+
+    cores = []
+    for cpus in nodes:
+        siblings = {}
+        for cpu in sorted(cpus):
+            core = _read_cpu_list(f"/sys/devices/system/cpu/cpu{cpu}/topology/thread_siblings_list") or [cpu]
+            siblings.setdefault(tuple(core), []).append(cpu)
+        cores.append(list(siblings.values()))
+    return cores
+
+
+def spread(replicas):
+    """
+    Return the CPUs to pin each of replicas servers to and the number of
+    physical cores among them, or None when CPU affinity is not supported.
+
+    Replicas go round-robin over the NUMA nodes, and the physical cores of a
+    node are split between the replicas on it, so replicas neither share
+    cores nor cross nodes. With more replicas than cores, replicas share
+    cores.
+    """
+    if not hasattr(os, "sched_getaffinity"):
+        return None
+
+    nodes = numa_nodes()
+    placements = []
+    for i in range(replicas):
+        cores = nodes[i % len(nodes)]
+        # Replicas on this node, and the rank of this one among them
+        count = len(range(i % len(nodes), replicas, len(nodes)))
+        rank = i // len(nodes)
+        if count > len(cores):
+            share = [cores[rank % len(cores)]]
+        else:
+            share = cores[rank * len(cores) // count : (rank + 1) * len(cores) // count]
+        placements.append(({cpu for core in share for cpu in core}, len(share)))
+    return placements
+
+
+def has_gpu():
+    return bool(sys.platform == "darwin" or os.getenv("HIP_VISIBLE_DEVICES") or os.getenv("CUDA_VISIBLE_DEVICES"))
+
+
+class Tuning:
+    """llama.cpp parameters chosen for a Model, None leaves the llama.cpp default."""
+
+    fields = ["ctx", "cache_type", "ngl", "threads", "threads_batch", "batch", "ubatch", "mmap", "mlock"]
+
+    def __init__(self, **kwargs):
+        self.source = kwargs.pop("source", "auto")
+        self.plan = kwargs.pop("plan", None)
+        for field in self.fields:
+            setattr(self, field, kwargs.get(field))
+
+    def params(self):
+        """Return the llama.cpp command line options."""
+        params = []
+        for option, value in [
+            ("-c", self.ctx),
+            ("-ngl", self.ngl),
+            ("--threads", self.threads),
+            ("--threads-batch", self.threads_batch),
+            ("--batch-size", self.batch),
+            ("--ubatch-size", self.ubatch),
+        ]:
+            if value is not None:
+                params += [option, str(value)]
+
+        if self.cache_type and self.cache_type != "f16":
+            # llama.cpp only quantizes the V cache with flash attention
+            params += ["--cache-type-k", self.cache_type, "--cache-type-v", self.cache_type, "--flash-attn"]
+        if self.mmap is False:
+            params.append("--no-mmap")
+        if self.mlock:
+            params.append("--mlock")
+        return params
+
+    def __str__(self):
+        values = [f"{field}={getattr(self, field)}" for field in self.fields if getattr(self, field) is not None]
+        return " ".join([f"tune={self.source}"] + values)
+
+
+def static(slots=1):
+    """Return the parameters used without tuning."""
+    return Tuning(source="none", ctx=DEFAULT_CTX * slots, ngl=99 if has_gpu() else None)
+
+
+def tune(model_path, store=None, replicas=1, slots=1):
+    """
+    Derive the llama.cpp parameters from the Model's metadata and the host.
+
+    replicas is the number of servers of the Model run side by side, they
+    split the cores and the memory between them. slots is the number of
+    requests a server processes in parallel, they split its context.
+
+    - ctx: the context the Model was trained with, up to MAX_CTX, for
+      every slot.
+    - cache_type: the KV cache is quantized, and failing that the context
+      reduced, until the Model fits in the available memory, see planner.
+    - ngl: every layer is offloaded when a GPU is available.
+    - threads, threads_batch: the physical cores available to the process,
+      SMT siblings share execution units and slow generation down.
+    - batch, ubatch: the llama.cpp defaults, no larger than the context.
+    - mlock: CPU inference locks the Model in memory when it takes less
+      than half of the available memory and RLIMIT_MEMLOCK allows, so the
+      weights are never paged out.
+    - mmap: disabled when every layer is offloaded to a discrete GPU, the
+      weights are then read once instead of kept mapped in host memory.
+
+    The memory plan is only made when the Model runs in host memory, the
+    memory of discrete GPUs is not known.
+    """
+    summary = {}
+    weights = 0
+    if model_path and os.path.exists(model_path):
+        summary = gguf.summary(model_path, store) or {}
+        weights = summary.get("weights_size") or os.path.getsize(model_path)
+
+    ctx = min(summary.get("context_length") or DEFAULT_CTX, MAX_CTX) * slots
+    gpu = has_gpu()
+    discrete_gpu = gpu and sys.platform != "darwin"
+    ngl = None
+    if gpu:
+        ngl = summary["block_count"] + 1 if summary.get("block_count") else 99
+
+    plan = None
+    memory = available_memory()
+    if weights and memory and not discrete_gpu:
+        plan = planner.plan(summary, weights, ctx, min(MAX_UBATCH, ctx), memory, replicas)
+        ctx = plan.ctx
+
+    cores = max(physical_cores() // replicas, 1)
+    batch = min(MAX_BATCH, ctx)
+    tuning = Tuning(
+        ctx=ctx,
+        cache_type=plan.cache_type if plan else None,
+        ngl=ngl,
+        threads=cores,
+        threads_batch=cores,
+        batch=batch,
+        ubatch=min(MAX_UBATCH, batch),
+        mmap=not discrete_gpu,
+        mlock=False,
+        plan=plan,
+    )
+
+    if plan and not gpu:
+        soft, _ = resource.getrlimit(resource.RLIMIT_MEMLOCK)
+        lockable = soft == resource.RLIM_INFINITY or soft >= plan.weights
+        tuning.mlock = plan.required < memory / 2 and lockable
+
+    return tuning
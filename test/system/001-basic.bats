@@ -22,4 +22,39 @@ function setup() {
     is "$output" "ramalama version .*"               "'Version line' in output with -v "
 }
 
+@test "ramalama ls startup" {
+    # Listing Models must not detect the container engine, which runs
+    # podman machine list on macOS
+    fakebin=${BATS_TEST_TMPDIR}/fakebin
+    mkdir -p $fakebin
+    for engine in podman docker; do
+        printf '#!/bin/sh\ntouch %s/%s.called\nexit 1\n' $fakebin $engine >$fakebin/$engine
+        chmod +x $fakebin/$engine
+    done
+    PATH=$fakebin:$PATH run_ramalama ls
+    for engine in podman docker; do
+        test ! -e $fakebin/$engine.called || die "ramalama ls ran $engine"
+    done
+
+    local import_target=${RAMALAMA_IMPORT_TARGET_MS:-300}
+    PYTHONPROFILEIMPORTTIME=1 run_ramalama ls
+    import_us=$(sed -n 's/^import time: *[0-9]* | *\([0-9]*\) | ramalama$/\1/p' <<<"$output")
+    test -n "$import_us" || die "no import time reported for the ramalama module"
+    (( import_us / 1000 <= import_target )) || \
+        die "importing ramalama took $((import_us / 1000))ms, target is ${import_target}ms"
+
+    # Best of three runs, to ignore a cold cache
+    local ls_target=${RAMALAMA_LS_TARGET_MS:-1000}
+    best=
+    for i in 1 2 3; do
+        start=$(date +%s%N)
+        run_ramalama ls
+        elapsed=$(( ($(date +%s%N) - start) / 1000000 ))
+        if [[ -z "$best" ]] || (( elapsed < best )); then
+            best=$elapsed
+        fi
+    done
+    (( best <= ls_target )) || die "ramalama ls took ${best}ms, target is ${ls_target}ms"
+}
+
 # vim: filetype=sh
@@ -30,6 +30,10 @@ load helpers
 name              | [a-z0-9A-Z:/]\\\+
 modified          | [0-9]\\\+
 size              | [0-9]\\\+
+architecture      | llama
+parameters        | [0-9]\\\+
+quantization      | [A-Z0-9_]\\\+
+context_length    | [0-9]\\\+
 "
 
     run_ramalama pull ollama://tinyllama
@@ -57,4 +61,51 @@ size              | [0-9]\\\+
     is "$output" ""
 }
 
+@test "ramalama store reindex" {
+    run_ramalama pull ollama://tinyllama
+    run_ramalama info
+    store=$(jq -r .Store <<<"$output")
+    rm -f ${store}/store.db
+    run_ramalama store reindex
+    is "$output" "Indexed [0-9]\+ Models"
+    run_ramalama list --noheading
+    is "$output" ".*ollama://tinyllama:latest" "reindexed model is listed"
+
+    run_ramalama 2 store
+    is "$output" ".*the following arguments are required: COMMAND"
+}
+
+@test "ramalama gc" {
+    run_ramalama pull ollama://tinyllama
+    run_ramalama info
+    store=$(jq -r .Store <<<"$output")
+    blob=sha256:$(printf "%064d" 0)
+    echo unused > ${store}/repos/ollama/blobs/${blob}
+
+    run_ramalama gc --dry-run
+    is "$output" ".*Would delete: ${blob}" "unused blob is reported"
+    is "$output" ".*Reclaimable: [0-9.]\+ [KMG]\?B"
+    test -e ${store}/repos/ollama/blobs/${blob}
+
+    run_ramalama gc
+    is "$output" ".*Deleted: ${blob}" "unused blob is removed"
+    test ! -e ${store}/repos/ollama/blobs/${blob}
+    run_ramalama list --noheading
+    is "$output" ".*ollama://tinyllama:latest" "used model is kept"
+}
+
+@test "ramalama rm removes every blob of the Model" {
+    run_ramalama rm -a
+    run_ramalama gc
+    run_ramalama pull ollama://tinyllama
+    run_ramalama info
+    store=$(jq -r .Store <<<"$output")
+    run ls ${store}/repos/ollama/blobs
+    assert "${#lines[@]}" -gt 1 "config and layers are pulled"
+
+    run_ramalama rm ollama://tinyllama
+    run find ${store}/repos/ollama/blobs ${store}/blobs/sha256 -type f
+    is "$output" "" "no blob is left behind"
+}
+
 # vim: filetype=sh
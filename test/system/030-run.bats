@@ -30,6 +30,79 @@ load helpers
     is "$output" ".*${image} python3 /usr/bin/ramalama" "verify image name"
 }
 
+@test "ramalama --nocontainer --dryrun run tuning" {
+    model=m_$(safename)
+
+    run_ramalama --nocontainer --dryrun run ${model} hello </dev/null
+    is "$output" "llama-cli -m .*${model}.* -c [0-9]\+ .*--threads [0-9]\+ --threads-batch [0-9]\+ .*" "tuned parameters"
+
+    run_ramalama --nocontainer --dryrun run --tune none ${model} hello </dev/null
+    is "$output" "llama-cli -m .*${model}.* -c 2048" "fixed parameters"
+    assert "$output" !~ "--threads" "threads are not tuned"
+
+    run_ramalama --nocontainer --debug --dryrun run ${model} hello </dev/null
+    is "$output" ".*tune=auto ctx=[0-9]\+ threads=[0-9]\+" "debug prints the chosen values"
+}
+
+@test "ramalama run refuses a Model larger than memory" {
+    store=${RAMALAMA_TMPDIR}/store
+    blob=${store}/repos/ollama/blobs/sha256:$(printf '%064d' 0)
+    mkdir -p $(dirname ${blob}) ${store}/models/ollama
+    python3 $BATS_TEST_DIRNAME/make-gguf.py --weights $((1 << 42)) ${blob}
+    ln -s ${blob} ${store}/models/ollama/huge:latest
+
+    run_ramalama 1 --store ${store} --nocontainer run --pull never --verify never ollama://huge hello </dev/null
+    is "$output" ".*Weights: *4.0 TB" "weights are reported"
+    is "$output" ".*Error: huge needs .* of memory with a 512 token context, .* is available, use --tune=none to run it anyway"
+
+    run_ramalama --store ${store} --nocontainer --dryrun run ollama://huge hello </dev/null
+    is "$output" ".* -c 512 .*--cache-type-k q4_0 --cache-type-v q4_0 --flash-attn" "smallest footprint"
+}
+
+@test "ramalama run --batch" {
+    store=${RAMALAMA_TMPDIR}/store
+    blob=${store}/repos/ollama/blobs/sha256:$(printf '%064d' 1)
+    mkdir -p $(dirname ${blob}) ${store}/models/ollama ${RAMALAMA_TMPDIR}/bin
+    python3 $BATS_TEST_DIRNAME/make-gguf.py --weights $((1 << 20)) --context-length 512 ${blob}
+    ln -s ${blob} ${store}/models/ollama/tiny:latest
+    cat > ${RAMALAMA_TMPDIR}/bin/llama-server <<EOF
+#!/bin/sh
+exec python3 $BATS_TEST_DIRNAME/stub-server.py "\$@"
+EOF
+    chmod +x ${RAMALAMA_TMPDIR}/bin/llama-server
+    export PATH=${RAMALAMA_TMPDIR}/bin:$PATH
+
+    prompts=${RAMALAMA_TMPDIR}/prompts.jsonl
+    results=${RAMALAMA_TMPDIR}/results.jsonl
+    cat > ${prompts} <<EOF
+{"id": "a", "prompt": "Hello", "max_tokens": 3}
+"a prompt on its own"
+
+{"id": "c", "messages": [{"role": "user", "content": "Hi"}], "max_tokens": 1}
+[1, 2]
+EOF
+
+    run_ramalama --store ${store} --nocontainer --dryrun run --batch ${prompts} --parallel 2 ollama://tiny
+    is "$output" "llama-server --host 127.0.0.1 --port <port> -m .*tiny:latest -c 1024 .*--parallel 2" "context of every slot"
+
+    run_ramalama 22 --store ${store} --nocontainer run --batch ${prompts} ollama://tiny hello
+    is "$output" "Error: --batch does not take a prompt, the prompts are read from the file"
+
+    run_ramalama --store ${store} --nocontainer run --pull never --verify never --batch ${prompts} --output ${results} ollama://tiny
+    is "$output" "Completed 3 prompts, 1 failed"
+    is "$(jq -r .line ${results} | tr '\n' ' ')" "1 2 4 5 " "results in input order"
+    is "$(jq -r '.response.choices[0].text' ${results} | head -1)" "token token token" "completion"
+    is "$(jq -r '.id' ${results} | tr '\n' ' ')" "a null c null " "ids"
+    is "$(jq -r '.error' ${results} | tail -1)" "invalid input: expected a JSON object or string"
+
+    # Rerun after an interruption cut off the second result
+    { head -1 ${results}; sed -n 2p ${results} | head -c 20; } > ${results}.cut
+    mv ${results}.cut ${results}
+    run_ramalama --store ${store} --nocontainer run --pull never --verify never --batch ${prompts} --output ${results} ollama://tiny
+    is "${lines[0]}" "Resuming after line 1 of ${prompts}"
+    is "$(jq -r .line ${results} | tr '\n' ' ')" "1 2 4 5 " "resumed"
+}
+
 # FIXME no way to run this reliably without flakes in CI/CD system
 #@test "ramalama run granite with prompt" {
 #    run_ramalama run --name foobar granite "How often to full moons happen"
@@ -1,6 +1,7 @@
 #!/usr/bin/env bats
 
 load helpers
+load helpers.network
 
 verify_begin=".*run --rm -i --label RAMALAMA --security-opt=label=disable -e RAMALAMA_TRANSPORT --name"
 
@@ -135,4 +136,206 @@ verify_begin=".*run --rm -i --label RAMALAMA --security-opt=label=disable -e RAM
     is "$output" ".*containerPort: 1234" "Should container container port"
 }
 
+# Serve the stub in place of llama-server, and Models made of a GGUF header
+function fake_models() {
+    mkdir -p ${RAMALAMA_TMPDIR}/bin
+    cat > ${RAMALAMA_TMPDIR}/bin/llama-server <<EOF
+#!/bin/sh
+exec python3 $BATS_TEST_DIRNAME/stub-server.py "\$@"
+EOF
+    chmod +x ${RAMALAMA_TMPDIR}/bin/llama-server
+    export PATH=${RAMALAMA_TMPDIR}/bin:$PATH
+
+    store=${RAMALAMA_TMPDIR}/store
+    mkdir -p ${store}/repos/ollama/blobs ${store}/models/ollama
+    for name in "$@"; do
+        blob=${store}/repos/ollama/blobs/sha256:$(echo ${name} | sha256sum | cut -d' ' -f1)
+        python3 $BATS_TEST_DIRNAME/make-gguf.py --weights $((1 << 20)) --context-length 512 ${blob}
+        ln -s ${blob} ${store}/models/ollama/${name}:latest
+    done
+}
+
+function start_serve() {
+    port=$(random_free_port)
+    $RAMALAMA --store ${store} --nocontainer serve --pull never --verify never --port ${port} "$@" &
+    serve_pid=$!
+    wait_for_port 127.0.0.1 ${port} 10
+}
+
+function teardown() {
+    if [[ -n "$serve_pid" ]]; then
+        kill $serve_pid
+        wait $serve_pid || true
+    fi
+}
+
+# Names of the Models the stub servers run serve
+function stub_servers() {
+    ps -eo args | grep "[s]tub-server.py" | sed -e 's/.* -m \([^ ]*\).*/\1/' | xargs -r -n1 basename | sort | tr '\n' ' '
+}
+
+@test "ramalama serve several Models" {
+    fake_models first second
+
+    run_ramalama --store ${store} --nocontainer --dryrun serve ollama://first ollama://second
+    is "${lines[0]}" "llama-server --host 127.0.0.1 --port <port> -m .*first:latest -c 512 .*" "first server"
+    is "${lines[1]}" "llama-server --host 127.0.0.1 --port <port> -m .*second:latest -c 512 .*" "second server"
+
+    run_ramalama 22 --store ${store} serve --generate kube ollama://first ollama://second
+    is "$output" "Error: --generate does not support several Models, --replicas, --cache, --warmup or --metrics-port"
+
+    start_serve --max-models 1 ollama://first ollama://second
+    run curl -s http://127.0.0.1:${port}/v1/models
+    is "$(jq -r '.data[].id' <<<$output | tr '\n' ' ')" "ollama://first ollama://second " "served Models"
+    is "$(stub_servers)" "" "servers start on demand"
+
+    run curl -s http://127.0.0.1:${port}/v1/completions -d '{"model": "first", "max_tokens": 4}'
+    is "$(jq -r '.choices[0].text' <<<$output)" "token token token token" "routed to first"
+    is "$(stub_servers)" "first:latest " "first server started"
+
+    run curl -s http://127.0.0.1:${port}/v1/completions -d '{"model": "ollama://second", "max_tokens": 2, "stream": true}'
+    is "$output" ".*data: \[DONE\]" "streamed from second"
+    is "$(stub_servers)" "second:latest " "least recently used server evicted"
+
+    run curl -s http://127.0.0.1:${port}/v1/completions -d '{"model": "third"}'
+    is "$(jq -r .error.message <<<$output)" "model third not found"
+}
+
+@test "ramalama serve --replicas" {
+    fake_models first
+
+    run_ramalama --store ${store} --nocontainer --dryrun serve --replicas 2 ollama://first
+    is "${#lines[@]}" "2" "one server per replica"
+    is "${lines[1]}" "llama-server --host 127.0.0.1 --port <port> -m .*first:latest .*--threads [0-9]\+ .*" "replica threads"
+
+    run_ramalama 22 --store ${store} serve --replicas 0 ollama://first
+    is "$output" "Error: --replicas must be at least 1"
+
+    start_serve --replicas 2 ollama://first
+    run curl -s http://127.0.0.1:${port}/v1/completions -d '{"max_tokens": 2}'
+    is "$(jq -r '.choices[0].text' <<<$output)" "token token" "served without a model field"
+    is "$(stub_servers)" "first:latest first:latest " "replicas started"
+
+    # An exited replica is restarted by the health checks
+    killed=$(ps -eo pid,args | grep "[s]tub-server.py" | head -1 | awk '{print $1}')
+    kill -9 ${killed}
+    for i in $(seq 1 30); do
+        pids=$(ps -eo pid,args | grep "[s]tub-server.py" | awk '{print $1}')
+        if [[ $(wc -w <<<${pids}) == 2 ]] && ! grep -qw ${killed} <<<${pids}; then
+            break
+        fi
+        sleep 1
+    done
+    is "$(stub_servers)" "first:latest first:latest " "replica restarted"
+    is "$(grep -cw ${killed} <<<${pids})" "0" "killed replica replaced"
+
+    run curl -s http://127.0.0.1:${port}/v1/completions -d '{"model": "first", "max_tokens": 2}'
+    is "$(jq -r '.choices[0].text' <<<$output)" "token token" "served after the restart"
+}
+
+@test "ramalama serve --cache" {
+    fake_models first
+
+    start_serve --cache ollama://first
+    request='{"model": "first", "max_tokens": 4, "temperature": 0}'
+    run curl -si http://127.0.0.1:${port}/v1/completions -d "${request}"
+    is "$output" ".*X-Cache: MISS" "first request is forwarded"
+    first="${lines[-1]}"
+
+    run curl -si http://127.0.0.1:${port}/v1/completions -d "${request/first/ollama:\/\/first}"
+    is "$output" ".*X-Cache: HIT" "same request under another name of the Model is a hit"
+    is "${lines[-1]}" "${first}" "same response"
+
+    run curl -si http://127.0.0.1:${port}/v1/completions -d '{"model": "first", "max_tokens": 4}'
+    assert "$output" !~ "X-Cache" "sampled requests are not cached"
+
+    request='{"model": "first", "max_tokens": 2, "temperature": 0, "stream": true}'
+    run curl -s http://127.0.0.1:${port}/v1/chat/completions -d "${request}"
+    streamed="$output"
+    run curl -si http://127.0.0.1:${port}/v1/chat/completions -d "${request}"
+    is "$output" ".*Content-Type: text/event-stream.*X-Cache: HIT.*" "streamed response is replayed"
+    is "$(grep -c '^data: ' <<<$output)" "4" "every event is replayed"
+    is "$(grep '^data: ' <<<$output)" "$(grep '^data: ' <<<$streamed)" "same events"
+
+    run curl -s http://127.0.0.1:${port}/cache
+    is "$(jq -r '"\(.hits) \(.misses) \(.entries)"' <<<$output)" "2 2 2" "hits and misses"
+
+    # Pull the Model again
+    blob=${store}/repos/ollama/blobs/sha256:$(echo first again | sha256sum | cut -d' ' -f1)
+    python3 $BATS_TEST_DIRNAME/make-gguf.py --weights $((1 << 20)) --context-length 512 ${blob}
+    ln -sf ${blob} ${store}/models/ollama/first:latest
+    request='{"model": "first", "max_tokens": 4, "temperature": 0}'
+    run curl -si http://127.0.0.1:${port}/v1/completions -d "${request}"
+    is "$output" ".*X-Cache: MISS" "responses of the previous weights are not replayed"
+}
+
+@test "ramalama serve --warmup" {
+    fake_models first
+
+    run_ramalama --store ${store} --nocontainer --dryrun serve --preload mlock ollama://first
+    is "$output" "llama-server --port 8080 -m .*first:latest .*--mlock.*" "locked in memory"
+
+    start_serve --warmup "Hello" ollama://first
+    # /health answers 503 until the Model is loaded and warmed up
+    for i in $(seq 1 30); do
+        run curl -s -o /dev/null -w "%{http_code}" http://127.0.0.1:${port}/health
+        [[ "$output" == "503" ]] || break
+        sleep 1
+    done
+    is "$output" "200" "ready"
+    is "$(stub_servers)" "first:latest " "single Model started before the first request"
+
+    run curl -s http://127.0.0.1:${port}/v1/completions -d '{"max_tokens": 2}'
+    is "$(jq -r '.choices[0].text' <<<$output)" "token token" "served after the warm-up"
+}
+
+@test "ramalama serve --metrics-port" {
+    fake_models first
+
+    metrics_port=$(random_free_port)
+    start_serve --metrics-port ${metrics_port} ollama://first
+    run curl -s http://127.0.0.1:${port}/v1/completions -d '{"prompt": "Hello there", "max_tokens": 4}'
+    run curl -s http://127.0.0.1:${port}/v1/chat/completions -d '{"max_tokens": 2, "stream": true}'
+
+    run curl -s http://127.0.0.1:${metrics_port}/metrics
+    labels='{model="ollama://first"}'
+    is "$(grep ^ramalama_requests_total <<<$output)" 'ramalama_requests_total{model="ollama://first",code="200"} 2'
+    is "$(grep ^ramalama_request_duration_seconds_count <<<$output)" "ramalama_request_duration_seconds_count${labels} 2"
+    is "$(grep ^ramalama_time_to_first_token_seconds_count <<<$output)" \
+       "ramalama_time_to_first_token_seconds_count${labels} 2" "time to first token of both requests"
+    is "$(grep ^ramalama_prompt_tokens_total <<<$output)" "ramalama_prompt_tokens_total${labels} 2" "prompt tokens"
+    is "$(grep ^ramalama_generated_tokens_total <<<$output)" "ramalama_generated_tokens_total${labels} 6" \
+       "generated tokens read from the timings, at the end of the stream too"
+    is "$(grep ^ramalama_queue_depth <<<$output)" "ramalama_queue_depth${labels} 0"
+    is "$(grep ^ramalama_slots <<<$output | tr '\n' ' ')" \
+       'ramalama_slots_busy{model="ollama://first",replica="0"} 0 ramalama_slots{model="ollama://first",replica="0"} 1 '
+    is "$(grep ^ramalama_server_resident_memory_bytes <<<$output)" \
+       'ramalama_server_resident_memory_bytes{model="ollama://first",replica="0"} [1-9][0-9]*' "server memory"
+}
+
+@test "ramalama serve --metrics-port counts aborted requests" {
+    fake_models first
+    # Slow tokens, so the client gives up in the middle of the stream
+    cat > ${RAMALAMA_TMPDIR}/bin/llama-server <<EOF
+#!/bin/sh
+exec python3 $BATS_TEST_DIRNAME/stub-server.py --token-delay 0.05 "\$@"
+EOF
+
+    metrics_port=$(random_free_port)
+    start_serve --metrics-port ${metrics_port} ollama://first
+    run curl -s --max-time 1 http://127.0.0.1:${port}/v1/completions -d '{"max_tokens": 100, "stream": true}'
+    for i in $(seq 1 50); do
+        run curl -s http://127.0.0.1:${metrics_port}/metrics
+        grep -q '^ramalama_requests_total' <<<$output && break
+        sleep 0.2
+    done
+    is "$(grep ^ramalama_requests_total <<<$output)" 'ramalama_requests_total{model="ollama://first",code="499"} 1' \
+       "request the client closed"
+
+    run curl -s http://127.0.0.1:${port}/v1/completions -d '{"max_tokens": 2}'
+    run curl -s http://127.0.0.1:${metrics_port}/metrics
+    is "$(grep ^ramalama_requests_total <<<$output | tr '\n' ' ')" \
+       'ramalama_requests_total{model="ollama://first",code="200"} 1 ramalama_requests_total{model="ollama://first",code="499"} 1 '
+}
+
 # vim: filetype=sh
@@ -1,13 +1,55 @@
 #!/usr/bin/env bats
 
 load helpers
+load helpers.network
 load helpers.registry
 load setup_suite
 
+# Serve the Models written by registry_model as ollama://NAME and hf://ORG/REPO/NAME.gguf
+function start_stub_registry() {
+    registry_port=$(random_free_port)
+    python3 $BATS_TEST_DIRNAME/stub-registry.py --port ${registry_port} --dir ${RAMALAMA_TMPDIR}/registry \
+            --log ${RAMALAMA_TMPDIR}/registry.log "$@" &
+    registry_pid=$!
+    wait_for_port 127.0.0.1 ${registry_port} 10
+    export RAMALAMA_OLLAMA_REGISTRY=http://127.0.0.1:${registry_port}
+    export HF_ENDPOINT=http://127.0.0.1:${registry_port}
+}
+
+function teardown() {
+    if [[ -n "$registry_pid" ]]; then
+        kill $registry_pid || true
+        wait $registry_pid || true
+    fi
+}
+
+# Write a Model of random bytes, of size $2, served as $1
+function registry_model() {
+    mkdir -p ${RAMALAMA_TMPDIR}/registry
+    head -c $2 /dev/urandom > ${RAMALAMA_TMPDIR}/registry/$1.gguf
+    digest=$(sha256sum ${RAMALAMA_TMPDIR}/registry/$1.gguf | cut -d' ' -f1)
+    store=${RAMALAMA_TMPDIR}/store
+    blob=${store}/repos/ollama/blobs/sha256:${digest}
+}
+
+# Whether the verification of $1 recorded in the store still holds, so --verify=cached does not hash it
+function verified() {
+    python3 - $1 ${store}/cache/verified/${digest} <<EOF
+import json, os, sys
+st = os.stat(sys.argv[1])
+print([st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns] in json.load(open(sys.argv[2])))
+EOF
+}
+
+# Ranged requests of the blob, other than the probe of range support
+function blob_ranges() {
+    grep "/blobs/sha256:${digest} bytes=" ${RAMALAMA_TMPDIR}/registry.log | grep -v "bytes=0-0 "
+}
+
 # bats test_tags=distro-integration
 @test "ramalama pull no model" {
-    run_ramalama 2 pull
-    is "$output" ".*ramalama pull: error: the following arguments are required: MODEL" "MODEL should be required"
+    run_ramalama 22 pull
+    is "$output" "Error: pull requires at least one MODEL or --file" "MODEL should be required"
 }
 
 # bats test_tags=distro-integration
@@ -29,6 +71,34 @@ load setup_suite
     is "$output" "Error: failed to pull https://registry.ollama.ai/v2/library/${random_image_name}: HTTP Error 404: Not Found" "image does not exist"
 }
 
+# bats test_tags=distro-integration
+@test "ramalama pull multiple models" {
+    run_ramalama pull ollama://tinyllama tiny
+    run_ramalama list
+    is "$output" ".*ollama://tinyllama:latest" "image was actually pulled locally"
+
+    modelfile=${RAMALAMA_TMPDIR}/models.txt
+    random_image_name=i_$(safename)
+    cat >$modelfile <<EOF
+# comment
+ollama://tinyllama:1.1b
+${random_image_name}
+EOF
+    run_ramalama 1 pull -f $modelfile
+    is "$output" ".*${random_image_name}: failed to pull" "failed model is reported"
+    is "$output" ".*Error: failed to pull 1 of 2 Models"
+    run_ramalama list
+    is "$output" ".*ollama://tinyllama:1.1b" "other models are still pulled"
+    run_ramalama rm ollama://tinyllama ollama://tinyllama:1.1b
+}
+
+@test "ramalama pull spawns no subprocesses" {
+    run_ramalama --debug pull ollama://tinyllama
+    is "$output" ".*run_cmd: 0 subprocesses spawned" "pull runs in process"
+    run_ramalama --debug rm ollama://tinyllama
+    is "$output" ".*run_cmd: 0 subprocesses spawned" "rm runs in process"
+}
+
 # bats test_tags=distro-integration
 @test "ramalama pull huggingface" {
     run_ramalama pull hf://afrideva/Tiny-Vicuna-1B-GGUF/tiny-vicuna-1b.q2_k.gguf
@@ -60,6 +130,97 @@ load setup_suite
     run_ramalama rm oci://quay.io/mmortari/gguf-py-example:v1
 }
 
+@test "ramalama pull downloads segments in parallel and resumes them" {
+    registry_model first $((80 << 20))
+
+    # The registry goes away half way through the download
+    start_stub_registry --exit-after $((48 << 20))
+    run_ramalama 1 --store ${store} pull --connections 4 ollama://first
+    wait $registry_pid || true
+    run jq '.segments | length' ${store}/repos/ollama/blobs/.sha256:${digest}.segments
+    is "$output" "4" "progress of the segments of the interrupted download is kept"
+
+    rm ${RAMALAMA_TMPDIR}/registry.log
+    start_stub_registry
+    run_ramalama --store ${store} pull --connections 4 ollama://first
+    is "$(sha256sum ${blob} | cut -d' ' -f1)" "${digest}" "resumed download is complete"
+    assert "$(ls -a ${store}/repos/ollama/blobs)" !~ "segments" "progress is removed once complete"
+    run awk '{ n += $5 } END { print n }' <<<"$(blob_ranges)"
+    assert "$output" -lt $((80 << 20)) "downloaded segments are not downloaded again"
+}
+
+@test "ramalama pull retries truncated segments" {
+    registry_model first $((64 << 20))
+
+    start_stub_registry --truncate 2
+    run_ramalama --store ${store} pull --connections 4 ollama://first
+    is "$(sha256sum ${blob} | cut -d' ' -f1)" "${digest}" "download is complete"
+    is "$(blob_ranges | wc -l)" "6" "truncated segments are downloaded again"
+}
+
+@test "ramalama pull hashes segments completing out of order" {
+    registry_model first $((64 << 20))
+
+    # The first segment completes last, the others are hashed from the file
+    start_stub_registry --slow-start 2
+    run_ramalama --store ${store} pull --connections 4 ollama://first
+    is "$(blob_ranges | tail -1)" ".* bytes=0-[0-9]* 206 .*" "first segment completed last"
+    is "$(sha256sum ${blob} | cut -d' ' -f1)" "${digest}" "digest computed while downloading matches"
+}
+
+@test "ramalama pull records verified blobs once they are linked" {
+    registry_model first $((1 << 20))
+    hf_blob=${store}/repos/huggingface/org/repo/first.gguf/sha256:${digest}
+
+    start_stub_registry
+    run_ramalama --store ${store} pull ollama://first
+    is "$(verified ${blob})" "True" "downloaded blob is recorded with its ctime once linked into the store"
+
+    run_ramalama --store ${store} pull hf://org/repo/first.gguf
+    is "$(grep -c /resolve/ ${RAMALAMA_TMPDIR}/registry.log)" "0" "blob pulled by another transport is linked"
+    is "$(verified ${hf_blob})" "True" "linked blob is recorded with its new ctime"
+    is "$(verified ${blob})" "True" "so is the other link"
+}
+
+@test "ramalama pull reuses connections" {
+    registry_model first $((1 << 20))
+
+    start_stub_registry
+    run_ramalama --store ${store} --debug pull ollama://first
+    assert "$output" =~ "http: GET .*/blobs/.*\(reused connection\)" "blob requests reuse the connections"
+    run_ramalama --store ${store} rm ollama://first
+
+    # The registry closes every connection after a request, without telling
+    kill $registry_pid
+    wait $registry_pid || true
+    start_stub_registry --max-requests 1
+    run_ramalama --store ${store} --debug pull ollama://first
+    assert "$output" !~ "reused connection" "closed connections are retried on a new one"
+    is "$(sha256sum ${blob} | cut -d' ' -f1)" "${digest}" "download is complete"
+}
+
+@test "ramalama pull keeps a single copy of a Model pulled through several transports" {
+    registry_model first $((1 << 20))
+    # omlmd pulls the same GGUF from an OCI registry
+    mkdir -p ${RAMALAMA_TMPDIR}/bin
+    cat > ${RAMALAMA_TMPDIR}/bin/omlmd <<EOF
+#!/bin/sh
+mkdir -p \$4
+cp ${RAMALAMA_TMPDIR}/registry/first.gguf \$4/first.gguf
+EOF
+    chmod +x ${RAMALAMA_TMPDIR}/bin/omlmd
+    export PATH=${RAMALAMA_TMPDIR}/bin:$PATH
+
+    start_stub_registry
+    run_ramalama --store ${store} pull ollama://first
+    run_ramalama --store ${store} pull hf://org/repo/first.gguf
+    run_ramalama --store ${store} pull oci://localhost/first:latest
+    inode=$(stat -c %i ${store}/blobs/sha256/${digest})
+    for model in ollama/first:latest huggingface/org/repo/first.gguf oci/localhost/first/latest/first.gguf; do
+        is "$(stat -L -c %i ${store}/models/${model})" "${inode}" "${model} shares the stored copy"
+    done
+}
+
 @test "ramalama use registry" {
     skip_if_darwin
     skip_if_docker
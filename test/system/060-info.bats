@@ -19,6 +19,7 @@ load helpers
 Image   | "quay.io/ramalama/ramalama:latest"
 Runtime | "llama.cpp"
 Version | "${version}"
+Capabilities.cpu_cores | [0-9]\\\+
 Store   | \\\("${HOME}/.local/share/ramalama"\\\|"/var/lib/ramalama"\\\)
 "
 
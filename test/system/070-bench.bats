@@ -0,0 +1,49 @@
+#!/usr/bin/env bats
+
+load helpers
+load helpers.network
+
+function start_stub_server() {
+    port=$(random_free_port)
+    python3 $BATS_TEST_DIRNAME/stub-server.py --port $port --token-delay 0.001 &
+    stub_pid=$!
+    wait_for_port 127.0.0.1 $port
+}
+
+function teardown() {
+    if [[ -n "$stub_pid" ]]; then
+        kill $stub_pid
+        wait $stub_pid || true
+    fi
+}
+
+@test "ramalama bench" {
+    start_stub_server
+
+    run_ramalama --store $RAMALAMA_TMPDIR bench --url http://127.0.0.1:$port --concurrency 2 --requests 10 --output-tokens 8-16
+    is "$output" "Requests: *10 (0 failed).*" "all requests succeed"
+    is "$output" ".*TTFT (ms).*" "time to first token is reported"
+    is "$output" ".*ITL (ms).*" "inter-token latency is reported"
+
+    run_ramalama --store $RAMALAMA_TMPDIR bench --url http://127.0.0.1:$port --requests 4 --output-tokens 8 --label stub --json
+    is "$(jq -r .requests <<<$output)" "4" "requests in json"
+    is "$(jq -r .total_output_tokens <<<$output)" "32" "output tokens in json"
+    is "$(jq -r .label <<<$output)" "stub" "label in json"
+    is "$(jq -r '.ttft.p50 > 0' <<<$output)" "true" "ttft in json"
+
+    run_ramalama --store $RAMALAMA_TMPDIR bench --history
+    is "${lines[0]}" "TIME *LABEL *CONCURRENCY *TOKENS/S *TTFT P50 *TTFT P95 *ITL P50 *ITL P99" "history heading"
+    is "${lines[2]}" ".* stub .*" "label in history"
+
+    run_ramalama --store $RAMALAMA_TMPDIR bench --history --json
+    is "$(jq length <<<$output)" "2" "history keeps every run"
+}
+
+@test "ramalama bench unreachable server" {
+    port=$(random_free_port)
+    run_ramalama 1 bench --url http://127.0.0.1:$port --requests 2
+    is "$output" ".*Requests: *0 (2 failed).*" "failed requests are counted"
+    is "$output" ".*Error: no request to http://127.0.0.1:$port succeeded" "no request succeeded"
+}
+
+# vim: filetype=sh
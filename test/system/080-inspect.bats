@@ -0,0 +1,35 @@
+#!/usr/bin/env bats
+
+load helpers
+
+@test "ramalama inspect" {
+    run_ramalama pull tiny
+    run_ramalama inspect tiny
+    is "$output" ".*Architecture: *llama" "architecture"
+    is "$output" ".*Parameters: *1.1B" "parameters"
+    is "$output" ".*tokenizer.ggml.tokens: \[32000 string values\]" "large arrays are summarized"
+    assert "$output" !~ "blk.0.attn_q.weight" "tensors are only listed with --all"
+
+    run_ramalama inspect --all tiny
+    is "$output" ".*blk.0.attn_q.weight: " "tensors"
+
+    run_ramalama inspect --json tiny
+    is "$(jq -r .summary.architecture <<<$output)" "llama" "json architecture"
+    is "$(jq -r .summary.block_count <<<$output)" "22" "json block count"
+    is "$(jq -r '.tensors | length' <<<$output)" "0" "json tensors only with --all"
+
+    run_ramalama inspect --all --json tiny
+    is "$(jq -r '.tensors | length' <<<$output)" "$(jq -r .summary.tensor_count <<<$output)" "json tensors"
+}
+
+@test "ramalama inspect errors" {
+    run_ramalama 1 inspect ollama://nonexistent_$(safename)
+    is "$output" "Error: .* does not exist in local storage"
+
+    notgguf=${RAMALAMA_TMPDIR}/model.gguf
+    echo "not a model" > $notgguf
+    run_ramalama 1 inspect $notgguf
+    is "$output" "Error: unable to inspect $notgguf: $notgguf is not a GGUF file"
+}
+
+# vim: filetype=sh
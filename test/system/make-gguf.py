@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+"""
+Write the header of a GGUF Model for tests.
+
+The tensor info table declares weights of --weights bytes but no tensor
+data is written, so the file stays small whatever the size of the Model.
+"""
+
+import argparse
+import struct
+
+
+def string(value):
+    value = value.encode()
+    return struct.pack("<Q", len(value)) + value
+
+
+def uint32(key, value):
+    return string(key) + struct.pack("<II", 4, value)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--weights", type=int, default=1 << 30, help="bytes of F16 weights")
+    parser.add_argument("--context-length", type=int, default=4096)
+    parser.add_argument("--block-count", type=int, default=32)
+    parser.add_argument("--embedding-length", type=int, default=4096)
+    parser.add_argument("--head-count", type=int, default=32)
+    parser.add_argument("--head-count-kv", type=int, default=8)
+    parser.add_argument("PATH")
+    args = parser.parse_args()
+
+    metadata = [
+        string("general.architecture") + struct.pack("<I", 8) + string("llama"),
+        uint32("llama.context_length", args.context_length),
+        uint32("llama.block_count", args.block_count),
+        uint32("llama.embedding_length", args.embedding_length),
+        uint32("llama.attention.head_count", args.head_count),
+        uint32("llama.attention.head_count_kv", args.head_count_kv),
+    ]
+    # One F16 tensor holding every weight
+    tensor = string("weights") + struct.pack("<IQIQ", 1, args.weights // 2, 1, 0)
+    with open(args.PATH, "wb") as f:
+        f.write(b"GGUF" + struct.pack("<IQQ", 3, 1, len(metadata)) + b"".join(metadata) + tensor)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Stub of the Ollama and Hugging Face registries, for tests.
+
+Every DIR/NAME.gguf file is served as the ollama://NAME Model and as the
+hf://ORG/REPO/NAME.gguf file of any repository, with byte range support.
+Failures are injected with the options, and every response is appended
+to --log once it is sent: method, path, range, status and body bytes.
+"""
+
+import argparse
+import hashlib
+import http.server
+import json
+import os
+import re
+import threading
+import time
+
+CONFIG = b'{"model_format": "gguf"}'
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        self.requests = 0
+
+    def do_GET(self):
+        self.requests += 1
+        if self.server.max_requests and self.requests > self.server.max_requests:
+            # Close the kept-alive connection without answering, like a server timing it out
+            self.close_connection = True
+            return
+
+        match = re.fullmatch(r"/v2/library/([^/]+)/manifests/([^/]+)", self.path)
+        if match:
+            return self._manifest(match.group(1))
+        match = re.fullmatch(r"/v2/library/([^/]+)/blobs/sha256:([0-9a-f]{64})", self.path)
+        if match:
+            if match.group(2) == hashlib.sha256(CONFIG).hexdigest():
+                return self._reply(200, CONFIG)
+            return self._blob(self.server.digests.get(match.group(2)))
+        match = re.fullmatch(r"/[^/]+/[^/]+/(raw|resolve)/main/([^/]+)", self.path)
+        if match:
+            path = os.path.join(self.server.dir, match.group(2))
+            if not os.path.isfile(path):
+                return self._reply(404, b"not found")
+            if match.group(1) == "resolve":
+                return self._blob(path)
+            pointer = f"version https://git-lfs.github.com/spec/v1\noid sha256:{digest(path)}\n"
+            return self._reply(200, pointer.encode())
+        self._reply(404, b"not found")
+
+    def _manifest(self, name):
+        path = os.path.join(self.server.dir, f"{name}.gguf")
+        if not os.path.isfile(path):
+            return self._reply(404, b"not found")
+        manifest = {
+            "schemaVersion": 2,
+            "config": {"digest": "sha256:" + hashlib.sha256(CONFIG).hexdigest(), "size": len(CONFIG)},
+            "layers": [
+                {
+                    "mediaType": "application/vnd.ollama.image.model",
+                    "digest": "sha256:" + digest(path),
+                    "size": os.path.getsize(path),
+                }
+            ],
+        }
+        self._reply(200, json.dumps(manifest).encode(), "application/vnd.docker.distribution.manifest.v2+json")
+
+    def _blob(self, path):
+        if not path:
+            return self._reply(404, b"not found")
+
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), end) if match.group(2) else end
+            if start >= size:
+                return self._reply(416, b"")
+
+        length = end - start + 1
+        self.send_response(206 if match else 200)
+        if match:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.send_header("Content-Length", str(length))
+        self.end_headers()
+
+        probe = match and length == 1
+        if not probe and start == 0 and self.server.slow_start:
+            # Let the other segments of the blob complete first
+            time.sleep(self.server.slow_start)
+        if not probe and match and self.server.take("truncate") is not None:
+            # End the response half way, closing the connection
+            length //= 2
+            self.close_connection = True
+
+        sent = 0
+        with open(path, "rb") as f:
+            f.seek(start)
+            while sent < length:
+                data = f.read(min(1024 * 1024, length - sent))
+                if self.server.take("exit_after", len(data)) == 0:
+                    os._exit(0)
+                self.wfile.write(data)
+                sent += len(data)
+        self._log(206 if match else 200, sent)
+
+    def _reply(self, status, body, content_type="text/plain"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self._log(status, len(body))
+
+    def _log(self, status, size):
+        if not self.server.log:
+            return
+        with self.server.lock, open(self.server.log, "a") as f:
+            f.write(f"{self.command} {self.path} {self.headers.get('Range', '-')} {status} {size}\n")
+
+
+class Registry(http.server.ThreadingHTTPServer):
+    def take(self, name, amount=1):
+        """Consume amount of the budget of a failure, return what is left or None when there is none."""
+        with self.lock:
+            left = getattr(self, name)
+            if not left:
+                return None
+            setattr(self, name, max(left - amount, 0))
+            return getattr(self, name)
+
+
+def digest(path):
+    sha256_hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        for byte_block in iter(lambda: f.read(1024 * 1024), b""):
+            sha256_hash.update(byte_block)
+    return sha256_hash.hexdigest()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--dir", required=True, help="directory of the served .gguf files")
+    parser.add_argument("--log", help="file every response is logged to")
+    parser.add_argument("--exit-after", type=int, help="exit abruptly once this many blob bytes are sent")
+    parser.add_argument("--truncate", type=int, default=0, help="end the first ranged responses half way")
+    parser.add_argument("--slow-start", type=float, default=0, help="seconds ranges of the start of a blob wait")
+    parser.add_argument("--max-requests", type=int, default=0, help="requests answered per connection")
+    args = parser.parse_args()
+
+    server = Registry((args.host, args.port), Handler)
+    server.dir = args.dir
+    server.log = args.log
+    server.exit_after = args.exit_after
+    server.truncate = args.truncate
+    server.slow_start = args.slow_start
+    server.max_requests = args.max_requests
+    server.lock = threading.Lock()
+    server.digests = {}
+    for name in os.listdir(args.dir):
+        path = os.path.join(args.dir, name)
+        if os.path.isfile(path):
+            server.digests[digest(path)] = path
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
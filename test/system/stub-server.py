@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Stub of the OpenAI compatible API served by llama-server, for tests.
+
+Accepts the llama-server options tests pass and ignores the others. Every
+completion generates max_tokens tokens, one word per token, spaced by
+--token-delay seconds, and reports llama-server's timings.
+"""
+
+import argparse
+import http.server
+import json
+import threading
+import time
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Send every streamed token right away, like llama-server
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body, content_type="application/json"):
+        body = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/health":
+            return self._reply(200, json.dumps({"status": "ok"}))
+        if self.path == "/slots":
+            slots = [{"id": i, "is_processing": i < self.server.busy} for i in range(self.server.parallel)]
+            return self._reply(200, json.dumps(slots))
+        if self.path == "/v1/models":
+            return self._reply(200, json.dumps({"object": "list", "data": [{"id": self.server.model}]}))
+        self._reply(404, json.dumps({"error": "not found"}))
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        chat = self.path == "/v1/chat/completions"
+        if self.path != "/v1/completions" and not chat:
+            return self._reply(404, json.dumps({"error": "not found"}))
+
+        with self.server.lock:
+            self.server.busy += 1
+        try:
+            self._complete(request, chat)
+        finally:
+            with self.server.lock:
+                self.server.busy -= 1
+
+    def _complete(self, request, chat):
+        tokens = int(request.get("max_tokens") or 16)
+        model = request.get("model") or self.server.model
+        timings = {
+            "prompt_n": len(str(request.get("prompt", "")).split()),
+            "prompt_ms": 1.0,
+            "predicted_n": tokens,
+            "predicted_ms": self.server.token_delay * tokens * 1000,
+        }
+        if not request.get("stream"):
+            time.sleep(self.server.token_delay * tokens)
+            text = " ".join(["token"] * tokens)
+            choice = {"index": 0, "finish_reason": "length"}
+            choice.update({"message": {"role": "assistant", "content": text}} if chat else {"text": text})
+            usage = {"prompt_tokens": timings["prompt_n"], "completion_tokens": tokens}
+            response = {"model": model, "choices": [choice], "usage": usage, "timings": timings}
+            return self._reply(200, json.dumps(response))
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for i in range(tokens):
+            time.sleep(self.server.token_delay)
+            text = "token "
+            choice = {"index": 0, "delta": {"content": text}} if chat else {"index": 0, "text": text}
+            self._chunk(f"data: {json.dumps({'model': model, 'choices': [choice]})}\n\n")
+        choice = {"index": 0, "finish_reason": "length"}
+        choice.update({"delta": {}} if chat else {"text": ""})
+        self._chunk(f"data: {json.dumps({'model': model, 'choices': [choice], 'timings': timings})}\n\n")
+        self._chunk("data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _chunk(self, data):
+        data = data.encode()
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("-m", "--model", default="stub")
+    parser.add_argument("-np", "--parallel", type=int, default=1)
+    parser.add_argument("--token-delay", type=float, default=0.001)
+    args, _ = parser.parse_known_args()
+
+    server = http.server.ThreadingHTTPServer((args.host, args.port), Handler)
+    server.model = args.model
+    server.token_delay = args.token_delay
+    server.parallel = args.parallel
+    server.busy = 0
+    server.lock = threading.Lock()
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()